@@ -0,0 +1,76 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Comprobación: un aviso descartado no vuelve a salir en el mismo tramo.
+--
+-- Un aviso que agota push_reintentos_max queda 'descartado' sin escribir
+-- push_envios. Antes de 2026-10-17l el usuario seguía saliendo en
+-- push_candidatos_tick y push_proximo_evento() devolvía now(), así que el
+-- notificador en modo eventos despertaba cada NOTIF_ESPERA_MIN hasta que
+-- cambiaba el tramo.
+--
+-- Para una BBDD de desarrollo: desactiva temporalmente las demás
+-- suscripciones y lo pendiente de la outbox para aislar el caso. Todo va
+-- en una transacción que acaba en ROLLBACK, así que no deja nada. Si algo
+-- falla, el ASSERT corta con el motivo.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+UPDATE push_suscripciones SET activa = false WHERE activa;
+UPDATE push_outbox SET estado = 'descartado' WHERE estado = 'pendiente';
+
+DO $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_max int   := (v_cfg->>'reintentos_max')::int;
+    v_uid uuid;
+    v_n   int;
+    v_t   timestamptz;
+BEGIN
+    INSERT INTO usuarios(username) VALUES ('comprobacion_push_' || gen_random_uuid())
+    RETURNING id INTO v_uid;
+    INSERT INTO push_suscripciones(endpoint, usuario_id, p256dh, auth)
+    VALUES ('https://push.invalid/' || v_uid, v_uid, 'x', 'x');
+
+    -- Candidato a los dos avisos: un mes sin entrar y min_vencidas repasos
+    -- vencidos.
+    INSERT INTO usuario_gamificacion(usuario_id, ultimo_dia_activo)
+    VALUES (v_uid, current_date - 30)
+    ON CONFLICT (usuario_id) DO UPDATE SET ultimo_dia_activo = EXCLUDED.ultimo_dia_activo;
+    WITH p AS (
+        INSERT INTO preguntas(enunciado, opciones)
+        SELECT format('comprobación push %s %s', v_uid, i), '[]'::jsonb
+          FROM generate_series(1, GREATEST(v_min, 1)) i
+        RETURNING id
+    )
+    INSERT INTO repasos(usuario_id, pregunta_id, ultima_en, proximo_repaso)
+    SELECT v_uid, p.id, now() - interval '30 days', now() - interval '1 day' FROM p;
+
+    v_n := push_encolar_tick(NULL);
+    ASSERT v_n = 2, format('se esperaban 2 avisos encolados (repaso e inactividad), hay %s', v_n);
+
+    -- Los dos agotan los reintentos con un error transitorio.
+    UPDATE push_outbox SET intentos = v_max WHERE usuario_id = v_uid;
+    PERFORM push_outbox_fallo(o.id, 'timeout') FROM push_outbox o WHERE o.usuario_id = v_uid;
+    ASSERT (SELECT bool_and(estado = 'descartado') FROM push_outbox WHERE usuario_id = v_uid),
+           'push_outbox_fallo no descartó tras push_reintentos_max intentos';
+    ASSERT NOT EXISTS (SELECT 1 FROM push_envios WHERE usuario_id = v_uid),
+           'un descartado no debe contar como enviado';
+
+    ASSERT NOT EXISTS (SELECT 1 FROM push_candidatos_tick(NULL) WHERE o_usuario_id = v_uid),
+           'el usuario con avisos descartados sigue saliendo en push_candidatos_tick';
+    v_n := push_encolar_tick(NULL);
+    ASSERT v_n = 0, format('push_encolar_tick volvió a encolar %s avisos', v_n);
+
+    -- El próximo evento es el fin del primer tramo (o más tarde, si cae
+    -- fuera de la ventana horaria), nunca now().
+    v_t := push_proximo_evento();
+    ASSERT v_t >= LEAST(push_ventana(v_int) + make_interval(hours => GREATEST(v_int, 1)),
+                        push_ventana(v_cd)  + make_interval(hours => GREATEST(v_cd, 1))),
+           format('push_proximo_evento() = %s: el notificador giraría en vacío', v_t);
+
+    RAISE NOTICE 'push_outbox_descartado: ok (próximo evento %)', v_t;
+END $$;
+
+ROLLBACK;
@@ -16,6 +16,7 @@
 CREATE EXTENSION IF NOT EXISTS pgcrypto;    -- gen_random_uuid, crypt, hmac, bcrypt
 CREATE EXTENSION IF NOT EXISTS pg_trgm;     -- búsqueda textual difusa (similarity, %>)
 CREATE EXTENSION IF NOT EXISTS vector;      -- pgvector para embeddings
+CREATE EXTENSION IF NOT EXISTS unaccent;    -- plegar(): texto sin tildes
 
 
 -- =============================================================================
@@ -113,6 +114,28 @@ CREATE INDEX catalogo_etiquetas_emb_idx
 CREATE INDEX catalogo_etiquetas_padre_idx
     ON catalogo_etiquetas (padre);
 
+-- Pasajes de los apuntes de teoría (markdown/texto de /ficheros) para la
+-- búsqueda semántica. Los trocea y sincroniza teoria.py del servicio de
+-- embeddings; el worker los vectoriza por la cola (entidad 'teoria').
+-- Una fila por (fichero, contenido): si el texto de un pasaje no cambia,
+-- su embedding se conserva aunque cambie de posición o de fichero.
+CREATE TABLE teoria_pasajes (
+    id              bigserial PRIMARY KEY,
+    ruta            text NOT NULL,               -- '/Tema 1/apuntes.md'
+    orden           int  NOT NULL,               -- posición en el fichero
+    titulo          text NOT NULL DEFAULT '',    -- encabezados que lo contienen
+    texto           text NOT NULL,
+    embedding       vector(1024),                -- BAAI/bge-m3
+    actualizado_en  timestamptz NOT NULL DEFAULT now(),
+    -- Lo que se vectoriza es titulo + texto.
+    hash_contenido  text GENERATED ALWAYS AS
+                    (md5(titulo || E'\n' || texto)) STORED,
+    UNIQUE (ruta, hash_contenido)
+);
+
+CREATE INDEX teoria_pasajes_emb_idx  ON teoria_pasajes USING hnsw (embedding vector_cosine_ops);
+CREATE INDEX teoria_pasajes_hash_idx ON teoria_pasajes (hash_contenido);
+
 
 -- ─────────────────────────── Tests ──────────────────────────────────────────
 
@@ -200,12 +223,17 @@ CREATE UNIQUE INDEX marcadores_unico ON marcadores
 
 CREATE TABLE cola_embeddings (
     id            bigserial PRIMARY KEY,
-    entidad       text NOT NULL CHECK (entidad IN ('pregunta','etiqueta')),
-    entidad_id    text NOT NULL,                 -- uuid en pregunta, nombre en etiqueta
+    entidad       text NOT NULL CHECK (entidad IN ('pregunta','etiqueta','teoria')),
+    entidad_id    text NOT NULL,                 -- uuid en pregunta, nombre en etiqueta, id en teoria
+    -- Carril: 0 = edición interactiva, 1 = importación, 2 = reconstrucción
+    -- completa. Ver reclamar_cola_embeddings() para el reparto.
+    prioridad     smallint NOT NULL DEFAULT 0 CHECK (prioridad BETWEEN 0 AND 2),
     encolado_en   timestamptz NOT NULL DEFAULT now(),
     procesado_en  timestamptz
 );
-CREATE INDEX cola_emb_pendiente ON cola_embeddings (encolado_en)
+CREATE INDEX cola_emb_pendiente ON cola_embeddings (prioridad, encolado_en)
+    WHERE procesado_en IS NULL;
+CREATE INDEX cola_emb_entidad_pendiente ON cola_embeddings (entidad, entidad_id)
     WHERE procesado_en IS NULL;
 
 
@@ -225,9 +253,11 @@ CREATE TABLE preferencias_usuario (
 
 
 -- ─────────────────────────── Motor de repasos (Leitner) ─────────────────────
--- Estado por (usuario, pregunta). La fecha del próximo repaso se DERIVA al
--- vuelo como ultima_en + intervalo(caja, ritmo_del_usuario); no se
--- materializa para no desincronizarse al cambiar el ritmo.
+-- Estado por (usuario, pregunta). proximo_repaso = ultima_en + intervalo(caja,
+-- ritmo_del_usuario), materializada para que las pantallas de repaso lean
+-- por rango de índice. La mantienen registrar_respuesta y los triggers de
+-- preferencias_usuario.ritmo_repaso y config('ritmos_repaso')
+-- (_recalcular_proximos_repasos).
 
 CREATE TABLE repasos (
     usuario_id   uuid NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
@@ -236,9 +266,13 @@ CREATE TABLE repasos (
     aciertos     int  NOT NULL DEFAULT 0,
     fallos       int  NOT NULL DEFAULT 0,
     ultima_en    timestamptz NOT NULL DEFAULT now(),
+    proximo_repaso timestamptz NOT NULL DEFAULT now(),
     PRIMARY KEY (usuario_id, pregunta_id)
 );
 CREATE INDEX repasos_usuario_idx ON repasos (usuario_id, ultima_en);
+-- INCLUDE para que las listas de repaso sean index-only.
+CREATE INDEX repasos_proximo_idx ON repasos (usuario_id, proximo_repaso)
+    INCLUDE (pregunta_id, caja);
 
 
 -- ─────────────────────────── Ficheros vistos (teoría) ───────────────────────
@@ -351,6 +385,33 @@ CREATE TABLE push_envios (
     PRIMARY KEY (usuario_id, tipo)
 );
 
+-- Outbox del notificador: una fila por (candidato, suscripción) a enviar.
+-- Cada tick la rellena por conjuntos y los emisores la vacían con FOR UPDATE
+-- SKIP LOCKED, así que varias réplicas se reparten el trabajo y un fallo
+-- transitorio se reintenta con espera exponencial sin recalcular
+-- candidatos. `ventana` es el inicio del tramo de cooldown del tipo: con
+-- el UNIQUE, el mismo aviso no se encola dos veces en un tramo.
+CREATE TABLE push_outbox (
+    id              bigserial PRIMARY KEY,
+    usuario_id      uuid NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
+    tipo            text NOT NULL CHECK (tipo IN ('repaso','inactividad','reto')),
+    ventana         timestamptz NOT NULL,
+    endpoint        text NOT NULL REFERENCES push_suscripciones(endpoint) ON DELETE CASCADE,
+    medida          int  NOT NULL,
+    estado          text NOT NULL DEFAULT 'pendiente'
+                      CHECK (estado IN ('pendiente','enviado','descartado')),
+    intentos        int  NOT NULL DEFAULT 0,
+    proximo_intento timestamptz NOT NULL DEFAULT now(),
+    ultimo_error    text,
+    creado_en       timestamptz NOT NULL DEFAULT now(),
+    actualizado_en  timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (usuario_id, tipo, ventana, endpoint)
+);
+CREATE INDEX push_outbox_turno_idx
+    ON push_outbox (proximo_intento) WHERE estado = 'pendiente';
+CREATE INDEX push_outbox_usuario_pendiente_idx
+    ON push_outbox (usuario_id, tipo) WHERE estado = 'pendiente';
+
 
 -- =============================================================================
 --                              ROLES Y GRANTS
@@ -427,6 +488,7 @@ ALTER TABLE logros_usuario        ENABLE ROW LEVEL SECURITY;
 ALTER TABLE usuario_gamificacion  ENABLE ROW LEVEL SECURITY;
 ALTER TABLE push_suscripciones    ENABLE ROW LEVEL SECURITY;
 ALTER TABLE push_envios           ENABLE ROW LEVEL SECURITY;
+ALTER TABLE push_outbox           ENABLE ROW LEVEL SECURITY;
 
 -- Las políticas usan jwt_usuario_id(), tiene_permiso() y es_admin(), que se
 -- definen a continuación.
@@ -606,6 +668,8 @@ CREATE POLICY push_sus_propias ON push_suscripciones
 -- cliente (útil para debug); el worker usa el rol aprentix con bypass RLS.
 CREATE POLICY push_env_admin ON push_envios FOR ALL TO web_user
     USING (es_admin()) WITH CHECK (es_admin());
+CREATE POLICY push_outbox_admin ON push_outbox FOR ALL TO web_user
+    USING (es_admin()) WITH CHECK (es_admin());
 
 
 -- =============================================================================
@@ -632,24 +696,111 @@ ALTER TABLE push_suscripciones   ALTER COLUMN usuario_id SET DEFAULT jwt_usuario
 -- SECURITY DEFINER para que puedan insertar en cola_embeddings aunque el
 -- cliente solo tenga UPDATE en preguntas/catalogo_etiquetas.
 
+-- Encola una entidad para (re)vectorizar. El carril sale de la variable de
+-- sesión aprentix.cola_prioridad (0 si no está fijada): las funciones de
+-- importación la fijan a 1 con `SET` en su cabecera. Si la entidad ya tiene
+-- una fila pendiente y libre, no se duplica: solo se sube su prioridad.
+-- Una fila bloqueada la está procesando un worker con el texto anterior,
+-- así que en ese caso sí hace falta una nueva.
+CREATE OR REPLACE FUNCTION _encolar_embedding(p_entidad text, p_entidad_id text) RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+DECLARE
+    v_prio smallint := COALESCE(
+        NULLIF(current_setting('aprentix.cola_prioridad', true), '')::smallint, 0);
+    v_id   bigint;
+BEGIN
+    SELECT id INTO v_id FROM cola_embeddings
+     WHERE entidad = p_entidad AND entidad_id = p_entidad_id
+       AND procesado_en IS NULL
+     LIMIT 1
+     FOR UPDATE SKIP LOCKED;
+    IF FOUND THEN
+        UPDATE cola_embeddings SET prioridad = LEAST(prioridad, v_prio) WHERE id = v_id;
+    ELSE
+        INSERT INTO cola_embeddings(entidad, entidad_id, prioridad)
+        VALUES (p_entidad, p_entidad_id, v_prio);
+    END IF;
+    -- Las ediciones puntuales avisan con el id para que el worker las
+    -- atienda primero; el resto avisa 'bulk', que Postgres colapsa en un
+    -- único NOTIFY por transacción.
+    IF v_prio = 0 THEN
+        PERFORM pg_notify('embeddings', p_entidad || ':' || p_entidad_id);
+    ELSE
+        PERFORM pg_notify('embeddings', 'bulk');
+    END IF;
+END $$;
+
+-- Solo para los triggers y funciones de importación/sincronización (que
+-- corren como dueño): desde /rpc cualquiera podría llenar la cola con ids
+-- arbitrarios.
+REVOKE EXECUTE ON FUNCTION _encolar_embedding(text, text) FROM PUBLIC;
+
 CREATE OR REPLACE FUNCTION encolar_embedding_pregunta() RETURNS trigger
 LANGUAGE plpgsql SECURITY DEFINER AS $$
 BEGIN
-    INSERT INTO cola_embeddings(entidad, entidad_id)
-    VALUES ('pregunta', NEW.id::text);
-    PERFORM pg_notify('embeddings', 'pregunta:' || NEW.id::text);
+    PERFORM _encolar_embedding('pregunta', NEW.id::text);
     RETURN NEW;
 END $$;
 
 CREATE OR REPLACE FUNCTION encolar_embedding_etiqueta() RETURNS trigger
 LANGUAGE plpgsql SECURITY DEFINER AS $$
 BEGIN
-    INSERT INTO cola_embeddings(entidad, entidad_id)
-    VALUES ('etiqueta', NEW.nombre);
-    PERFORM pg_notify('embeddings', 'etiqueta:' || NEW.nombre);
+    PERFORM _encolar_embedding('etiqueta', NEW.nombre);
     RETURN NEW;
 END $$;
 
+-- Reclama hasta p_n filas pendientes para un worker (FOR UPDATE SKIP
+-- LOCKED, dentro de su transacción). Primero cada carril hasta su cuota
+-- (60 % interactivo, 30 % importación, 10 % reconstrucción) para que el
+-- trabajo masivo siga avanzando aunque no paren de llegar ediciones;
+-- después se rellena por prioridad y antigüedad. Las cuotas nunca pasan
+-- del presupuesto que queda, así que las entidades distintas reclamadas son
+-- como mucho p_n. Aparte se reclaman las filas pendientes duplicadas de
+-- esas mismas entidades (pueden hacer que se devuelvan más de p_n filas),
+-- que no suponen trabajo extra: se vectoriza cada entidad una sola vez.
+CREATE OR REPLACE FUNCTION reclamar_cola_embeddings(p_n int)
+RETURNS TABLE(id bigint, entidad text, entidad_id text)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_ids  bigint[] := '{}';
+    v_prio int;
+BEGIN
+    FOREACH v_prio IN ARRAY ARRAY[0, 1, 2] LOOP
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.prioridad = v_prio
+             ORDER BY c.encolado_en
+             LIMIT LEAST(
+                 p_n - cardinality(v_ids),
+                 GREATEST(1, floor(p_n * (ARRAY[0.6, 0.3, 0.1])[v_prio + 1]))::int)
+             FOR UPDATE SKIP LOCKED
+        );
+    END LOOP;
+
+    IF cardinality(v_ids) < p_n THEN
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+             ORDER BY c.prioridad, c.encolado_en
+             LIMIT p_n - cardinality(v_ids)
+             FOR UPDATE SKIP LOCKED
+        );
+    END IF;
+
+    v_ids := v_ids || ARRAY(
+        SELECT c.id FROM cola_embeddings c
+          JOIN cola_embeddings r
+            ON r.id = ANY(v_ids)
+           AND r.entidad = c.entidad AND r.entidad_id = c.entidad_id
+         WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+         FOR UPDATE OF c SKIP LOCKED
+    );
+
+    RETURN QUERY
+        SELECT c.id, c.entidad, c.entidad_id FROM cola_embeddings c WHERE c.id = ANY(v_ids);
+END $$;
+
 CREATE TRIGGER preguntas_emb_ai
     AFTER INSERT ON preguntas
     FOR EACH ROW EXECUTE FUNCTION encolar_embedding_pregunta();
@@ -676,6 +827,25 @@ CREATE TRIGGER catalogo_etiquetas_emb_au
     )
     EXECUTE FUNCTION encolar_embedding_etiqueta();
 
+-- Avisa al clasificador en memoria del worker (embeddings/clasificador.py)
+-- de que una etiqueta del catálogo ha cambiado; recarga solo esa fila.
+CREATE OR REPLACE FUNCTION notificar_cambio_catalogo() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('embeddings', 'catalogo:' || OLD.nombre);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.nombre <> OLD.nombre) THEN
+        PERFORM pg_notify('embeddings', 'catalogo:' || NEW.nombre);
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER catalogo_etiquetas_clasif_aiud
+    AFTER INSERT OR DELETE OR UPDATE OF nombre, palabras_clave, embedding
+    ON catalogo_etiquetas
+    FOR EACH ROW EXECUTE FUNCTION notificar_cambio_catalogo();
+
 
 -- =============================================================================
 --                                    AUTH
@@ -1130,6 +1300,101 @@ BEGIN
     RETURN make_interval(hours => v_horas::int);
 END $$;
 
+-- Curva de repaso expandida: una fila por (ritmo, caja) con su intervalo,
+-- con el mismo recorte de caja que intervalo_repaso. Las consultas que
+-- cuentan vencidas para muchos usuarios la cruzan por join en vez de llamar
+-- a intervalo_repaso() fila a fila.
+CREATE OR REPLACE FUNCTION curvas_repaso() RETURNS TABLE (
+    ritmo     text,
+    caja      int,
+    intervalo interval
+)
+LANGUAGE sql STABLE AS $$
+    SELECT k.key,
+           c.caja,
+           make_interval(hours => (k.value->>(LEAST(c.caja, jsonb_array_length(k.value)) - 1))::numeric::int)
+      FROM config cfg
+     CROSS JOIN LATERAL jsonb_each(cfg.valor) k
+     CROSS JOIN generate_series(1, 7) AS c(caja)
+     WHERE cfg.clave = 'ritmos_repaso'
+       AND jsonb_typeof(k.value) = 'array'
+       AND jsonb_array_length(k.value) > 0;
+$$;
+
+-- Recalcula repasos.proximo_repaso de un usuario (o de todos, con NULL) a
+-- partir de su ritmo actual y la curva vigente. Solo escribe las filas que
+-- cambian. SECURITY DEFINER: el trigger de config la llama para todos los
+-- usuarios aunque quien edite la config solo vea sus propios repasos.
+CREATE OR REPLACE FUNCTION _recalcular_proximos_repasos(p_usuario_id uuid DEFAULT NULL)
+RETURNS int
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+DECLARE
+    v_n int;
+BEGIN
+    WITH curvas AS MATERIALIZED (
+        SELECT * FROM curvas_repaso()
+    ),
+    ritmos AS (
+        SELECT DISTINCT c.ritmo FROM curvas c
+    ),
+    nuevos AS (
+        SELECT r.usuario_id, r.pregunta_id, r.ultima_en + c.intervalo AS proximo
+          FROM repasos r
+          LEFT JOIN preferencias_usuario p ON p.usuario_id = r.usuario_id
+          LEFT JOIN ritmos rt ON rt.ritmo = p.ritmo_repaso
+          JOIN curvas c ON c.ritmo = COALESCE(rt.ritmo, 'normal') AND c.caja = r.caja
+         WHERE p_usuario_id IS NULL OR r.usuario_id = p_usuario_id
+    )
+    UPDATE repasos r
+       SET proximo_repaso = n.proximo
+      FROM nuevos n
+     WHERE r.usuario_id = n.usuario_id
+       AND r.pregunta_id = n.pregunta_id
+       AND r.proximo_repaso IS DISTINCT FROM n.proximo;
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+-- Solo la llaman los triggers de abajo: con SECURITY DEFINER y sin filtro
+-- de usuario, desde /rpc cualquiera podría reescribir toda la tabla.
+REVOKE EXECUTE ON FUNCTION _recalcular_proximos_repasos(uuid) FROM PUBLIC;
+
+CREATE OR REPLACE FUNCTION config_ritmos_repaso_au() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    -- El WHEN de un trigger con INSERT no puede mirar OLD: se compara aquí.
+    IF TG_OP = 'UPDATE' AND NEW.valor IS NOT DISTINCT FROM OLD.valor THEN
+        RETURN NULL;
+    END IF;
+    PERFORM _recalcular_proximos_repasos(NULL);
+    RETURN NULL;
+END $$;
+
+-- Cambiar la curva de config('ritmos_repaso') reprograma todos los repasos,
+-- también si llega por INSERT o upsert.
+CREATE TRIGGER config_ritmos_repaso_au
+    AFTER INSERT OR UPDATE OF valor ON config
+    FOR EACH ROW WHEN (NEW.clave = 'ritmos_repaso')
+    EXECUTE FUNCTION config_ritmos_repaso_au();
+
+CREATE OR REPLACE FUNCTION preferencias_ritmo_aiud() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM _recalcular_proximos_repasos(OLD.usuario_id);
+    ELSIF TG_OP = 'INSERT' OR NEW.ritmo_repaso IS DISTINCT FROM OLD.ritmo_repaso THEN
+        PERFORM _recalcular_proximos_repasos(NEW.usuario_id);
+    END IF;
+    RETURN NULL;
+END $$;
+
+-- Cambiar de ritmo reprograma los repasos del usuario, venga de
+-- set_ritmo_repaso o de un PATCH directo a preferencias_usuario.
+CREATE TRIGGER preferencias_ritmo_aiud
+    AFTER INSERT OR UPDATE OF ritmo_repaso OR DELETE ON preferencias_usuario
+    FOR EACH ROW
+    EXECUTE FUNCTION preferencias_ritmo_aiud();
+
 
 -- registrar_respuesta hace tres cosas de una:
 --   1) guarda la respuesta cruda en 'respuestas' (histórico intacto);
@@ -1140,10 +1405,10 @@ END $$;
 -- Semántica de p_adelantada = true: el acierto NO cambia caja ni ultima_en
 -- (evita "farmear" cajas adelantándose). Los fallos siempre penalizan.
 --
--- La fecha del próximo repaso NO se materializa: se deriva de
--- (caja, ultima_en, ritmo_actual). Por eso, en el caso de fallo, anclamos
--- ultima_en en el pasado exactamente el intervalo de la caja final para
--- que la fecha derivada caiga en now() (vencida al instante).
+-- proximo_repaso se escribe aquí junto con caja y ultima_en. En el caso de
+-- fallo, anclamos ultima_en en el pasado exactamente el intervalo de la
+-- caja final para que proximo_repaso caiga en now() (vencida al instante)
+-- y siga cuadrando con ultima_en + intervalo si se recalcula.
 CREATE OR REPLACE FUNCTION registrar_respuesta(
     p_intento_id  uuid,
     p_pregunta_id uuid,
@@ -1192,8 +1457,8 @@ BEGIN
     IF p_correcta AND p_adelantada THEN
         -- Sesión adelantada: la caja no sube (no "farmear" repasos).
         v_caja_new := COALESCE(v_caja_prev, 1);
-        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en)
-        VALUES (v_uid, p_pregunta_id, 2, 1, 0, now())
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, 2, 1, 0, now(), now() + intervalo_repaso(2, v_ritmo))
         ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
             SET aciertos = repasos.aciertos + 1;
 
@@ -1201,23 +1466,27 @@ BEGIN
         v_caja_new := LEAST(COALESCE(v_caja_prev, 1) + 1, 7);
         IF v_caja_prev IS NULL THEN v_caja_new := 2; END IF;
 
-        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en)
-        VALUES (v_uid, p_pregunta_id, v_caja_new, 1, 0, now())
+        v_intv := intervalo_repaso(v_caja_new, v_ritmo);
+
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, v_caja_new, 1, 0, now(), now() + v_intv)
         ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
-            SET caja      = v_caja_new,
-                aciertos  = repasos.aciertos + 1,
-                ultima_en = now();
+            SET caja           = v_caja_new,
+                aciertos       = repasos.aciertos + 1,
+                ultima_en      = now(),
+                proximo_repaso = now() + v_intv;
 
     ELSE
         v_caja_new := GREATEST(COALESCE(v_caja_prev, 1) - 2, 1);
         v_intv := intervalo_repaso(v_caja_new, v_ritmo);
 
-        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en)
-        VALUES (v_uid, p_pregunta_id, v_caja_new, 0, 1, now() - v_intv)
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, v_caja_new, 0, 1, now() - v_intv, now())
         ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
-            SET caja      = v_caja_new,
-                fallos    = repasos.fallos + 1,
-                ultima_en = now() - v_intv;
+            SET caja           = v_caja_new,
+                fallos         = repasos.fallos + 1,
+                ultima_en      = now() - v_intv,
+                proximo_repaso = now();
     END IF;
 
     -- Motor de gamificación: solo UPSERTs, no bloqueante en la práctica.
@@ -1522,7 +1791,9 @@ $$;
 
 -- Formato "nuevo": opciones ya vienen como [{texto, correcta}, ...].
 CREATE OR REPLACE FUNCTION importar_test(p_titulo text, p_json jsonb) RETURNS uuid
-LANGUAGE plpgsql AS $$
+LANGUAGE plpgsql
+SET aprentix.cola_prioridad = '1'   -- embeddings al carril de importación
+AS $$
 DECLARE
     v_test uuid;
     v_preg jsonb;
@@ -1569,7 +1840,9 @@ CREATE OR REPLACE FUNCTION importar_test_normalizado(
     p_descripcion text,
     p_preguntas   jsonb
 ) RETURNS uuid
-LANGUAGE plpgsql AS $$
+LANGUAGE plpgsql
+SET aprentix.cola_prioridad = '1'   -- embeddings al carril de importación
+AS $$
 DECLARE
     v_test uuid;
     v_preg jsonb;
@@ -1908,7 +2181,9 @@ END $$;
 -- clave y padre. Cada fila resultante lleva un 'estado': 'creada',
 -- 'actualizada' o 'error' con su motivo.
 CREATE OR REPLACE FUNCTION importar_etiquetas(p_json jsonb) RETURNS jsonb
-LANGUAGE plpgsql AS $$
+LANGUAGE plpgsql
+SET aprentix.cola_prioridad = '1'   -- embeddings al carril de importación
+AS $$
 DECLARE
     v_item      jsonb;
     v_pendientes jsonb[];
@@ -2077,115 +2352,165 @@ END $$;
 --   • Nunca elimina etiquetas: las manuales sobreviven.
 --   • Nunca añade una etiqueta que esté en 'etiquetas_bloqueadas': si un
 --     usuario la ha quitado, la corrección humana pesa más que el clasificador.
+--   • El texto se compara plegado (plegar: minúsculas y sin tildes), igual
+--     que clasificador.py del worker, para que una pregunta reciba las
+--     mismas etiquetas la clasifique el worker o una reclasificación masiva.
+
+-- Minúsculas y sin diacríticos ("Constitución" → "constitucion"). Es la
+-- versión SQL de clasificador.plegar. IMMUTABLE con el diccionario
+-- calificado, para poder usarla en índices si hiciera falta.
+CREATE OR REPLACE FUNCTION plegar(p_texto text) RETURNS text
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$
+    SELECT lower(public.unaccent('public.unaccent'::regdictionary, p_texto));
+$$;
 
-CREATE OR REPLACE FUNCTION reclasificar_pregunta(
-    p_id          uuid,
-    k             int  DEFAULT 5,
-    umbral        real DEFAULT 0.55,
-    p_knn_k       int  DEFAULT 5,
-    p_knn_umbral  real DEFAULT 0.70,
-    p_knn_min     int  DEFAULT 1
+-- Versión por lotes: misma lógica que la descripción de arriba, pero para
+-- un array de preguntas en una sola pasada basada en conjuntos (los patrones
+-- del catálogo se expanden una vez y el kNN va en un LATERAL por pregunta).
+-- Las vecinas se leen con el estado previo al lote. Solo escribe las filas
+-- cuyas etiquetas cambian. Devuelve cuántas preguntas se han evaluado.
+--
+-- p_candidatas: {"<uuid>": ["etiqueta", ...]} ya calculadas fuera (el
+-- clasificador en memoria del worker de embeddings cubre (a)–(d)). Si se
+-- pasa, sustituye a esas fuentes y aquí solo quedan el kNN y la escritura.
+CREATE OR REPLACE FUNCTION reclasificar_preguntas(
+    p_ids         uuid[],
+    umbral        real  DEFAULT 0.55,
+    p_knn_k       int   DEFAULT 5,
+    p_knn_umbral  real  DEFAULT 0.70,
+    p_knn_min     int   DEFAULT 1,
+    p_candidatas  jsonb DEFAULT NULL
 ) RETURNS int
 LANGUAGE plpgsql AS $$
 DECLARE
-    v_emun       text;
-    v_emb        vector(1024);
-    v_test_tit   text;
-    v_bloqueadas text[];
-    v_n          int;
+    v_n int;
 BEGIN
-    SELECT p.enunciado, p.embedding, p.etiquetas_bloqueadas,
-           (SELECT t.titulo FROM test_preguntas tp
-              JOIN tests t ON t.id = tp.test_id
-             WHERE tp.pregunta_id = p.id
-             ORDER BY t.creado_en LIMIT 1)
-      INTO v_emun, v_emb, v_bloqueadas, v_test_tit
-      FROM preguntas p WHERE p.id = p_id;
-
-    IF v_emun IS NULL THEN RETURN 0; END IF;
-
-    -- La lista efectiva de tags a "no reintroducir": las que el usuario
-    -- ha bloqueado en la pregunta MÁS las que ha bloqueado en el test
-    -- asociado (para que corregir a nivel test se propague).
-    SELECT array_agg(DISTINCT b) INTO v_bloqueadas FROM (
-        SELECT unnest(COALESCE(v_bloqueadas, '{}'::text[])) AS b
-        UNION
-        SELECT unnest(COALESCE(t.etiquetas_bloqueadas, '{}'::text[])) AS b
-          FROM test_preguntas tp JOIN tests t ON t.id = tp.test_id
-         WHERE tp.pregunta_id = p_id
-    ) x WHERE b IS NOT NULL;
-    v_bloqueadas := COALESCE(v_bloqueadas, '{}'::text[]);
-
     WITH
+    objetivo AS (
+        SELECT p.id, p.embedding, p.etiquetas,
+               plegar(p.enunciado) AS enunciado,
+               plegar((SELECT t.titulo FROM test_preguntas tp
+                         JOIN tests t ON t.id = tp.test_id
+                        WHERE tp.pregunta_id = p.id
+                        ORDER BY t.creado_en LIMIT 1)) AS test_tit,
+               -- Bloqueadas de la pregunta MÁS las del test asociado.
+               ARRAY(
+                   SELECT b FROM unnest(COALESCE(p.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE b IS NOT NULL
+                   UNION
+                   SELECT b FROM test_preguntas tp
+                     JOIN tests t ON t.id = tp.test_id
+                    CROSS JOIN unnest(COALESCE(t.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE tp.pregunta_id = p.id AND b IS NOT NULL
+               ) AS bloqueadas
+          FROM preguntas p
+         WHERE p.id = ANY(p_ids)
+           AND p.enunciado IS NOT NULL
+    ),
+    -- Nombre y palabras clave de cada etiqueta como una lista plana de
+    -- patrones plegados; sirven igual para el enunciado y para el título
+    -- del test. Los vacíos se descartan (casarían con todo).
+    patrones AS (
+        SELECT x.nombre, plegar(x.patron) AS patron
+          FROM (
+            SELECT c.nombre, c.nombre AS patron FROM catalogo_etiquetas c
+            UNION
+            SELECT c.nombre, kw FROM catalogo_etiquetas c, unnest(c.palabras_clave) kw
+          ) x
+         WHERE btrim(COALESCE(x.patron, '')) <> ''
+    ),
     cat AS (
-        SELECT c.nombre FROM catalogo_etiquetas c
-        WHERE
-            (v_emb IS NOT NULL AND c.embedding IS NOT NULL
-             AND 1 - (c.embedding <=> v_emb) > umbral)
-            OR EXISTS (
-                SELECT 1 FROM unnest(c.palabras_clave) kw
-                WHERE v_emun ILIKE '%' || kw || '%'
-            )
-            OR v_emun ILIKE '%' || c.nombre || '%'
-            OR (
-                v_test_tit IS NOT NULL AND (
-                    v_test_tit ILIKE '%' || c.nombre || '%'
-                    OR EXISTS (
-                        SELECT 1 FROM unnest(c.palabras_clave) kw
-                        WHERE v_test_tit ILIKE '%' || kw || '%'
-                    )
-                )
-            )
+        SELECT o.id, c.nombre
+          FROM objetivo o
+         CROSS JOIN jsonb_array_elements_text(p_candidatas -> o.id::text) AS j(nombre)
+          JOIN catalogo_etiquetas c ON c.nombre = j.nombre
+         WHERE p_candidatas IS NOT NULL
+        UNION
+        SELECT o.id, c.nombre
+          FROM objetivo o
+          JOIN catalogo_etiquetas c
+            ON o.embedding IS NOT NULL AND c.embedding IS NOT NULL
+           AND 1 - (c.embedding <=> o.embedding) > umbral
+         WHERE p_candidatas IS NULL
+        UNION
+        SELECT o.id, pt.nombre
+          FROM objetivo o
+          JOIN patrones pt
+            ON strpos(o.enunciado, pt.patron) > 0
+            OR strpos(o.test_tit, pt.patron) > 0
+         WHERE p_candidatas IS NULL
     ),
     vecinas AS (
-        SELECT id, etiquetas, etiquetas_manuales, etiquetas_bloqueadas,
-               1 - (embedding <=> v_emb) AS sim
-          FROM preguntas
-         WHERE v_emb IS NOT NULL
-           AND embedding IS NOT NULL
-           AND id <> p_id
-           AND cardinality(etiquetas) > 0
-         ORDER BY embedding <=> v_emb
-         LIMIT GREATEST(p_knn_k, 1)
+        SELECT o.id, v.etiquetas, v.etiquetas_manuales, v.etiquetas_bloqueadas
+          FROM objetivo o
+         CROSS JOIN LATERAL (
+            SELECT q.etiquetas, q.etiquetas_manuales, q.etiquetas_bloqueadas,
+                   1 - (q.embedding <=> o.embedding) AS sim
+              FROM preguntas q
+             WHERE q.embedding IS NOT NULL
+               AND q.id <> o.id
+               AND cardinality(q.etiquetas) > 0
+             ORDER BY q.embedding <=> o.embedding
+             LIMIT GREATEST(p_knn_k, 1)
+         ) v
+         WHERE o.embedding IS NOT NULL
+           AND v.sim >= p_knn_umbral
     ),
-    -- Cada etiqueta vota; las etiquetas MANUALES cuentan como 2 votos porque
-    -- vienen de una corrección humana explícita. Las etiquetas que la vecina
-    -- ha bloqueado cuentan negativo, para que "un usuario ya dijo que no"
-    -- también reste al proponerla a otra pregunta parecida.
+    -- Mismos pesos que en reclasificar_pregunta: 1 por etiqueta, 2 por
+    -- manual, -3 por bloqueada en la vecina.
     votos_knn AS (
-        SELECT v.e AS nombre,
-               SUM(v.peso) AS peso
+        SELECT x.id, x.e AS nombre, SUM(x.peso) AS peso
           FROM (
-            SELECT unnest(etiquetas)          AS e,  1 AS peso FROM vecinas WHERE sim >= p_knn_umbral
+            SELECT id, unnest(etiquetas)            AS e,  1 AS peso FROM vecinas
             UNION ALL
-            SELECT unnest(etiquetas_manuales) AS e,  2 AS peso FROM vecinas WHERE sim >= p_knn_umbral
+            SELECT id, unnest(etiquetas_manuales)   AS e,  2 AS peso FROM vecinas
             UNION ALL
-            SELECT unnest(etiquetas_bloqueadas) AS e, -3 AS peso FROM vecinas WHERE sim >= p_knn_umbral
-          ) v
-         GROUP BY v.e
-    ),
-    knn AS (
-        SELECT nombre FROM votos_knn
-         WHERE peso >= GREATEST(p_knn_min, 1)
+            SELECT id, unnest(etiquetas_bloqueadas) AS e, -3 AS peso FROM vecinas
+          ) x
+         GROUP BY x.id, x.e
     ),
     candidatas AS (
-        SELECT nombre FROM cat
+        SELECT id, nombre FROM cat
         UNION
-        SELECT nombre FROM knn
+        SELECT id, nombre FROM votos_knn WHERE peso >= GREATEST(p_knn_min, 1)
+    ),
+    nuevas AS (
+        SELECT o.id,
+               o.etiquetas AS antes,
+               ARRAY(
+                   SELECT DISTINCT e
+                     FROM unnest(o.etiquetas || ARRAY(
+                              SELECT c.nombre FROM candidatas c WHERE c.id = o.id
+                          )) AS e
+                    WHERE e <> ALL(o.bloqueadas)
+               ) AS despues
+          FROM objetivo o
+    ),
+    upd AS (
+        UPDATE preguntas p
+           SET etiquetas      = n.despues,
+               actualizado_en = now()
+          FROM nuevas n
+         WHERE p.id = n.id
+           AND n.despues IS DISTINCT FROM n.antes
+        RETURNING p.id
     )
-    UPDATE preguntas
-       SET etiquetas = ARRAY(
-               SELECT DISTINCT e
-                 FROM unnest(etiquetas || ARRAY(SELECT nombre FROM candidatas)) AS e
-                WHERE e <> ALL(v_bloqueadas)
-           ),
-           actualizado_en = now()
-     WHERE id = p_id;
-
-    GET DIAGNOSTICS v_n = ROW_COUNT;
+    SELECT count(*) INTO v_n FROM objetivo;
     RETURN v_n;
 END $$;
 
+CREATE OR REPLACE FUNCTION reclasificar_pregunta(
+    p_id          uuid,
+    k             int  DEFAULT 5,
+    umbral        real DEFAULT 0.55,
+    p_knn_k       int  DEFAULT 5,
+    p_knn_umbral  real DEFAULT 0.70,
+    p_knn_min     int  DEFAULT 1
+) RETURNS int
+LANGUAGE sql AS $$
+    SELECT reclasificar_preguntas(ARRAY[p_id], umbral, p_knn_k, p_knn_umbral, p_knn_min);
+$$;
+
 -- Clasificar un test: propaga etiquetas del título+descripción a todas sus
 -- preguntas.
 CREATE OR REPLACE FUNCTION clasificar_test(p_test_id uuid) RETURNS text[]
@@ -2196,20 +2521,21 @@ DECLARE
     v_bloq_test   text[];
     v_etiq_nuevas text[];
 BEGIN
-    SELECT titulo, descripcion, etiquetas_bloqueadas
+    SELECT plegar(titulo), plegar(descripcion), etiquetas_bloqueadas
       INTO v_titulo, v_descr, v_bloq_test
       FROM tests WHERE id = p_test_id;
     IF v_titulo IS NULL THEN RETURN '{}'::text[]; END IF;
 
+    -- Texto plegado, como en reclasificar_preguntas.
     SELECT array_agg(DISTINCT c.nombre) INTO v_etiq_nuevas
       FROM catalogo_etiquetas c
-     WHERE (v_titulo ILIKE '%' || c.nombre || '%'
-        OR (v_descr IS NOT NULL AND v_descr ILIKE '%' || c.nombre || '%')
-        OR EXISTS (
-            SELECT 1 FROM unnest(c.palabras_clave) kw
-            WHERE v_titulo ILIKE '%' || kw || '%'
-               OR (v_descr IS NOT NULL AND v_descr ILIKE '%' || kw || '%')
-        ))
+     WHERE EXISTS (
+            SELECT 1
+              FROM unnest(c.nombre || COALESCE(c.palabras_clave, '{}'::text[])) kw
+             WHERE btrim(COALESCE(kw, '')) <> ''
+               AND (strpos(v_titulo, plegar(kw)) > 0
+                    OR strpos(v_descr, plegar(kw)) > 0)
+        )
        AND c.nombre <> ALL(COALESCE(v_bloq_test, '{}'::text[]));
 
     IF v_etiq_nuevas IS NULL OR cardinality(v_etiq_nuevas) = 0 THEN
@@ -2406,16 +2732,22 @@ BEGIN
     );
 END $$;
 
+-- Ambas recorren las preguntas en trozos de 500 con reclasificar_preguntas.
 CREATE OR REPLACE FUNCTION reclasificar_todas() RETURNS int
 LANGUAGE plpgsql AS $$
-DECLARE v_n int := 0; v_id uuid;
+DECLARE v_n int := 0; v_ids uuid[];
 BEGIN
     IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
         RAISE EXCEPTION 'permiso_denegado';
     END IF;
-    FOR v_id IN SELECT id FROM preguntas WHERE embedding IS NOT NULL LOOP
-        PERFORM reclasificar_pregunta(v_id);
-        v_n := v_n + 1;
+    FOR v_ids IN
+        SELECT array_agg(id) FROM (
+            SELECT id, (row_number() OVER (ORDER BY id) - 1) / 500 AS trozo
+              FROM preguntas WHERE embedding IS NOT NULL
+        ) x GROUP BY trozo
+    LOOP
+        PERFORM reclasificar_preguntas(v_ids);
+        v_n := v_n + cardinality(v_ids);
     END LOOP;
     RETURN v_n;
 END $$;
@@ -2426,6 +2758,7 @@ DECLARE
     v_tests_n     int := 0;
     v_preguntas_n int := 0;
     v_id          uuid;
+    v_ids         uuid[];
 BEGIN
     IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
         RAISE EXCEPTION 'permiso_denegado';
@@ -2436,9 +2769,14 @@ BEGIN
         v_tests_n := v_tests_n + 1;
     END LOOP;
 
-    FOR v_id IN SELECT id FROM preguntas LOOP
-        PERFORM reclasificar_pregunta(v_id);
-        v_preguntas_n := v_preguntas_n + 1;
+    FOR v_ids IN
+        SELECT array_agg(id) FROM (
+            SELECT id, (row_number() OVER (ORDER BY id) - 1) / 500 AS trozo
+              FROM preguntas
+        ) x GROUP BY trozo
+    LOOP
+        PERFORM reclasificar_preguntas(v_ids);
+        v_preguntas_n := v_preguntas_n + cardinality(v_ids);
     END LOOP;
 
     RETURN jsonb_build_object(
@@ -2604,8 +2942,15 @@ BEGIN
     IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
         RAISE EXCEPTION 'permiso_denegado';
     END IF;
-    INSERT INTO cola_embeddings(entidad, entidad_id)
-    SELECT 'pregunta', id::text FROM preguntas;
+    -- Carril 2 (reconstrucción); las que ya estaban pendientes no se
+    -- duplican.
+    INSERT INTO cola_embeddings(entidad, entidad_id, prioridad)
+    SELECT 'pregunta', p.id::text, 2 FROM preguntas p
+     WHERE NOT EXISTS (
+        SELECT 1 FROM cola_embeddings c
+         WHERE c.entidad = 'pregunta' AND c.entidad_id = p.id::text
+           AND c.procesado_en IS NULL
+     );
     GET DIAGNOSTICS v_n = ROW_COUNT;
     PERFORM pg_notify('embeddings', 'bulk');
     RETURN v_n;
@@ -2624,6 +2969,9 @@ LANGUAGE sql STABLE AS $$
     );
 $$;
 
+-- Cambiar de ritmo reprograma proximo_repaso de todos los repasos del
+-- usuario (lo hace el trigger preferencias_ritmo_aiud: un UPDATE por
+-- conjunto, solo las filas que cambian).
 CREATE OR REPLACE FUNCTION set_ritmo_repaso(p_ritmo text) RETURNS jsonb
 LANGUAGE plpgsql AS $$
 BEGIN
@@ -2640,7 +2988,7 @@ END $$;
 
 -- Vacía por completo el estado del motor de cajas del usuario actual.
 -- No toca respuestas ni intentos (histórico intacto); solo borra
--- 'repasos'. En la siguiente respuesta correcta, la pregunta volverá a
+-- 'repasos' (con sus proximo_repaso; no queda nada que recalcular). En la siguiente respuesta correcta, la pregunta volverá a
 -- entrar en caja 2 (comportamiento por defecto de registrar_respuesta).
 -- Opcionalmente restringe el reset a un test concreto.
 CREATE OR REPLACE FUNCTION resetear_mis_repasos(p_test_id uuid DEFAULT NULL)
@@ -2665,56 +3013,48 @@ BEGIN
     RETURN jsonb_build_object('borradas', v_n);
 END $$;
 
+-- Los resúmenes leen proximo_repaso tal cual (sin recalcular por fila) y
+-- sacan los cuatro números en una sola pasada con agregados FILTER.
 CREATE OR REPLACE FUNCTION resumen_repaso_test(p_test_id uuid) RETURNS jsonb
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
-    v_uid   uuid := jwt_usuario_id();
-    v_ritmo text := ritmo_repaso_usuario(v_uid);
+    v_uid uuid := jwt_usuario_id();
 BEGIN
     RETURN (
-        WITH q AS (
-            SELECT r.caja,
-                   r.ultima_en + intervalo_repaso(r.caja, v_ritmo) AS proximo_repaso
-            FROM repasos r
-            JOIN test_preguntas tp ON tp.pregunta_id = r.pregunta_id
-            WHERE tp.test_id = p_test_id AND r.usuario_id = v_uid
-        )
         SELECT jsonb_build_object(
-            'total_repasos',  (SELECT count(*) FROM q),
-            'vencidas',       (SELECT count(*) FROM q WHERE proximo_repaso <= now()),
-            'dominadas',      (SELECT count(*) FROM q WHERE caja = 7),
-            'siguiente',      (SELECT min(proximo_repaso) FROM q WHERE proximo_repaso > now()),
+            'total_repasos',  count(*),
+            'vencidas',       count(*) FILTER (WHERE r.proximo_repaso <= now()),
+            'dominadas',      count(*) FILTER (WHERE r.caja = 7),
+            'siguiente',      min(r.proximo_repaso) FILTER (WHERE r.proximo_repaso > now()),
             'test_realizado', EXISTS (
                 SELECT 1 FROM intentos WHERE usuario_id = v_uid AND test_id = p_test_id
             )
         )
+        FROM repasos r
+        JOIN test_preguntas tp ON tp.pregunta_id = r.pregunta_id
+        WHERE tp.test_id = p_test_id AND r.usuario_id = v_uid
     );
 END $$;
 
 CREATE OR REPLACE FUNCTION resumen_repaso_global() RETURNS jsonb
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
-    v_uid   uuid := jwt_usuario_id();
-    v_ritmo text := ritmo_repaso_usuario(v_uid);
+    v_uid uuid := jwt_usuario_id();
 BEGIN
     RETURN (
-        WITH q AS (
-            SELECT r.caja,
-                   r.ultima_en + intervalo_repaso(r.caja, v_ritmo) AS proximo_repaso
-            FROM repasos r
-            WHERE r.usuario_id = v_uid
-              AND EXISTS (
-                SELECT 1 FROM test_preguntas tp
-                JOIN intentos i ON i.test_id = tp.test_id
-                WHERE tp.pregunta_id = r.pregunta_id AND i.usuario_id = r.usuario_id
-              )
-        )
         SELECT jsonb_build_object(
-            'total_repasos', (SELECT count(*) FROM q),
-            'vencidas',      (SELECT count(*) FROM q WHERE proximo_repaso <= now()),
-            'dominadas',     (SELECT count(*) FROM q WHERE caja = 7),
-            'siguiente',     (SELECT min(proximo_repaso) FROM q WHERE proximo_repaso > now())
+            'total_repasos', count(*),
+            'vencidas',      count(*) FILTER (WHERE r.proximo_repaso <= now()),
+            'dominadas',     count(*) FILTER (WHERE r.caja = 7),
+            'siguiente',     min(r.proximo_repaso) FILTER (WHERE r.proximo_repaso > now())
         )
+        FROM repasos r
+        WHERE r.usuario_id = v_uid
+          AND EXISTS (
+            SELECT 1 FROM test_preguntas tp
+            JOIN intentos i ON i.test_id = tp.test_id
+            WHERE tp.pregunta_id = r.pregunta_id AND i.usuario_id = r.usuario_id
+          )
     );
 END $$;
 
@@ -2726,22 +3066,24 @@ CREATE OR REPLACE FUNCTION preguntas_repaso_test(
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
     v_uid    uuid := jwt_usuario_id();
-    v_ritmo  text := ritmo_repaso_usuario(v_uid);
+    -- Cota superior fija (en vez de "p_adelantar OR …") para que el plan
+    -- genérico también recorra repasos_proximo_idx por rango.
+    v_hasta  timestamptz := CASE WHEN p_adelantar THEN 'infinity' ELSE now() END;
     v_titulo text;
     v_qs     jsonb;
 BEGIN
     SELECT titulo INTO v_titulo FROM tests WHERE id = p_test_id;
 
-    WITH pool AS (
-        SELECT r.pregunta_id, r.caja,
-               r.ultima_en + intervalo_repaso(r.caja, v_ritmo) AS proximo_repaso
+    WITH filtro AS (
+        SELECT r.pregunta_id, r.caja, r.proximo_repaso
         FROM repasos r
-        JOIN test_preguntas tp ON tp.pregunta_id = r.pregunta_id
-        WHERE tp.test_id = p_test_id AND r.usuario_id = v_uid
-    ), filtro AS (
-        SELECT * FROM pool
-        WHERE p_adelantar OR proximo_repaso <= now()
-        ORDER BY proximo_repaso ASC
+        WHERE r.usuario_id = v_uid
+          AND r.proximo_repaso <= v_hasta
+          AND EXISTS (
+            SELECT 1 FROM test_preguntas tp
+            WHERE tp.test_id = p_test_id AND tp.pregunta_id = r.pregunta_id
+          )
+        ORDER BY r.proximo_repaso ASC
         LIMIT GREATEST(p_n, 0)
     )
     SELECT COALESCE(jsonb_agg(
@@ -2777,23 +3119,21 @@ CREATE OR REPLACE FUNCTION preguntas_repaso_global(
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
     v_uid   uuid := jwt_usuario_id();
-    v_ritmo text := ritmo_repaso_usuario(v_uid);
+    v_hasta timestamptz := CASE WHEN p_adelantar THEN 'infinity' ELSE now() END;
     v_qs    jsonb;
 BEGIN
-    WITH pool AS (
-        SELECT r.pregunta_id, r.caja,
-               r.ultima_en + intervalo_repaso(r.caja, v_ritmo) AS proximo_repaso
+    -- Recorre repasos_proximo_idx en orden y para a las p_n filas.
+    WITH filtro AS (
+        SELECT r.pregunta_id, r.caja, r.proximo_repaso
         FROM repasos r
         WHERE r.usuario_id = v_uid
+          AND r.proximo_repaso <= v_hasta
           AND EXISTS (
             SELECT 1 FROM test_preguntas tp
             JOIN intentos i ON i.test_id = tp.test_id
             WHERE tp.pregunta_id = r.pregunta_id AND i.usuario_id = r.usuario_id
           )
-    ), filtro AS (
-        SELECT * FROM pool
-        WHERE p_adelantar OR proximo_repaso <= now()
-        ORDER BY proximo_repaso ASC
+        ORDER BY r.proximo_repaso ASC
         LIMIT GREATEST(p_n, 0)
     )
     SELECT COALESCE(jsonb_agg(
@@ -2919,6 +3259,128 @@ BEGIN
     RETURN v_n;
 END $$;
 
+-- ─── Pasajes de teoría (búsqueda semántica) ───────────────────────────────
+-- Las dos primeras las llama teoria.py (servicio de embeddings) con el
+-- usuario de la base de datos; web_user no tiene permisos sobre
+-- teoria_pasajes, así que no puede usarlas aunque PostgREST las exponga.
+
+-- Sustituye los pasajes de un fichero por los de p_pasajes
+-- ([{orden, titulo, texto}, ...]). Los que ya existían con el mismo
+-- contenido se quedan (solo cambia su orden); los nuevos reutilizan el
+-- embedding de otra fila con el mismo hash si la hay (fichero movido o
+-- copiado) y, si no, se encolan para vectorizar. Devuelve cuántos se
+-- encolaron.
+CREATE OR REPLACE FUNCTION sincronizar_pasajes_teoria(p_ruta text, p_pasajes jsonb)
+RETURNS int
+LANGUAGE plpgsql
+SET aprentix.cola_prioridad = '1' AS $$
+DECLARE
+    v_id bigint;
+    v_n  int := 0;
+BEGIN
+    CREATE TEMP TABLE IF NOT EXISTS _pasajes_nuevos (
+        orden int, titulo text, texto text, hash text
+    ) ON COMMIT DROP;
+    TRUNCATE _pasajes_nuevos;
+    -- Un pasaje repetido dentro del mismo fichero se guarda una vez.
+    INSERT INTO _pasajes_nuevos
+    SELECT DISTINCT ON (h) orden, titulo, texto, h
+      FROM (
+        SELECT x.orden, COALESCE(x.titulo, '') AS titulo, x.texto,
+               md5(COALESCE(x.titulo, '') || E'\n' || x.texto) AS h
+          FROM jsonb_to_recordset(p_pasajes) AS x(orden int, titulo text, texto text)
+         WHERE x.texto IS NOT NULL
+      ) s
+     ORDER BY h, orden;
+
+    DELETE FROM teoria_pasajes t
+     WHERE t.ruta = p_ruta
+       AND NOT EXISTS (SELECT 1 FROM _pasajes_nuevos n WHERE n.hash = t.hash_contenido);
+
+    INSERT INTO teoria_pasajes (ruta, orden, titulo, texto, embedding)
+    SELECT p_ruta, n.orden, n.titulo, n.texto,
+           (SELECT o.embedding FROM teoria_pasajes o
+             WHERE o.hash_contenido = n.hash AND o.embedding IS NOT NULL
+             LIMIT 1)
+      FROM _pasajes_nuevos n
+    ON CONFLICT (ruta, hash_contenido) DO UPDATE
+        SET orden = EXCLUDED.orden
+        WHERE teoria_pasajes.orden IS DISTINCT FROM EXCLUDED.orden;
+
+    FOR v_id IN
+        SELECT t.id FROM teoria_pasajes t WHERE t.ruta = p_ruta AND t.embedding IS NULL
+    LOOP
+        PERFORM _encolar_embedding('teoria', v_id::text);
+        v_n := v_n + 1;
+    END LOOP;
+    RETURN v_n;
+END $$;
+
+-- Borra los pasajes de los ficheros que ya no están (p_rutas = todos los
+-- que sí). Se llama después de sincronizar, para que un fichero movido
+-- herede antes los embeddings de su ruta anterior.
+CREATE OR REPLACE FUNCTION retirar_pasajes_teoria(p_rutas text[]) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE v_n int;
+BEGIN
+    DELETE FROM teoria_pasajes WHERE ruta <> ALL(p_rutas);
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+-- Pasajes de teoría más parecidos a una pregunta (kNN por el índice HNSW
+-- sobre el embedding de la pregunta), el mejor de cada fichero. Para
+-- saltar de una pregunta fallada a los apuntes. Respeta el mismo filtro
+-- por oposición que el listado de la raíz de teoría: las carpetas de
+-- primer nivel asignadas solo a oposiciones ajenas no aparecen.
+CREATE OR REPLACE FUNCTION teoria_para_pregunta(p_pregunta_id uuid, p_n int DEFAULT 3)
+RETURNS TABLE(ruta text, titulo text, texto text, similitud real)
+LANGUAGE plpgsql STABLE SECURITY DEFINER AS $$
+#variable_conflict use_column
+DECLARE
+    v_emb   vector(1024);
+    v_admin boolean := es_admin();
+    v_mias  uuid[];
+    v_n     int := LEAST(GREATEST(COALESCE(p_n, 3), 1), 10);
+BEGIN
+    IF NOT puede_ver_teoria() THEN RAISE EXCEPTION 'permiso_denegado'; END IF;
+    SELECT p.embedding INTO v_emb FROM preguntas p WHERE p.id = p_pregunta_id;
+    IF v_emb IS NULL THEN RETURN; END IF;
+    IF NOT v_admin THEN
+        SELECT COALESCE(array_agg(x::uuid), '{}') INTO v_mias
+          FROM jsonb_array_elements_text(mis_oposiciones_ids()) x;
+    END IF;
+
+    RETURN QUERY
+    WITH cercanos AS (
+        -- Margen para el filtro por oposición y para quedarse con uno por
+        -- fichero. Con v_n <= 10 no pasa de 40, el hnsw.ef_search por
+        -- defecto: el índice no devuelve más candidatos que esos.
+        SELECT t.ruta, t.titulo, t.texto, t.embedding <=> v_emb AS distancia
+          FROM teoria_pasajes t
+         WHERE t.embedding IS NOT NULL
+         ORDER BY t.embedding <=> v_emb
+         LIMIT v_n * 4
+    ), visibles AS (
+        SELECT DISTINCT ON (c.ruta) c.*
+          FROM cercanos c
+         WHERE v_admin
+            OR split_part(c.ruta, '/', 3) = ''   -- fichero suelto en la raíz
+            OR NOT EXISTS (
+                SELECT 1 FROM carpeta_oposiciones co
+                 WHERE co.ruta = '/' || split_part(c.ruta, '/', 2))
+            OR EXISTS (
+                SELECT 1 FROM carpeta_oposiciones co
+                 WHERE co.ruta = '/' || split_part(c.ruta, '/', 2)
+                   AND co.oposicion_id = ANY(v_mias))
+         ORDER BY c.ruta, c.distancia
+    )
+    SELECT v.ruta, v.titulo, v.texto, (1 - v.distancia)::real
+      FROM visibles v
+     ORDER BY v.distancia
+     LIMIT v_n;
+END $$;
+
 
 -- =============================================================================
 --                    GAMIFICACIÓN — MOTOR Y RPCs
@@ -3381,11 +3843,15 @@ END $$;
 --                    NOTIFICACIONES WEB PUSH
 -- =============================================================================
 -- La SPA suscribe con guardar_push_suscripcion y lee la clave pública VAPID
--- vía push_config_publica. El worker Python 'notificador' consulta a través
--- de push_candidatos_* quién necesita aviso, envía con pywebpush + VAPID
--- y llama a push_marcar_envio / push_marcar_error según resultado.
+-- vía push_config_publica. El worker Python 'notificador' vuelca en
+-- push_outbox quién necesita aviso (push_encolar_tick), la vacía enviando
+-- con pywebpush + VAPID y registra el resultado con push_outbox_enviado /
+-- push_outbox_fallo, que a su vez llaman a push_marcar_envio /
+-- push_marcar_error.
 -- La ventana horaria y el intervalo entre pushes viven en la tabla config
--- (claves push_*) para poder ajustarlos sin redeployar el worker.
+-- (claves push_*) para poder ajustarlos sin redeployar el worker. En modo
+-- eventos el notificador escucha el canal 'push' (cambios de config y
+-- suscripciones nuevas) y duerme hasta push_proximo_evento().
 
 CREATE OR REPLACE FUNCTION guardar_push_suscripcion(
     p_endpoint text,
@@ -3411,6 +3877,8 @@ BEGIN
             tz           = EXCLUDED.tz,
             activa       = true,
             ultimo_error = NULL;
+    -- El notificador en modo eventos recalcula su próximo despertar.
+    PERFORM pg_notify('push', 'suscripcion');
 END $$;
 
 CREATE OR REPLACE FUNCTION borrar_push_suscripcion(p_endpoint text) RETURNS void
@@ -3459,10 +3927,29 @@ LANGUAGE sql STABLE AS $$
         'inactividad_horas',      COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_inactividad_horas'), 24),
         'inactividad_cooldown_h', COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_inactividad_cooldown_horas'), 48),
         'tz',                     COALESCE((SELECT valor->>'valor' FROM config WHERE clave='push_tz'), 'Europe/Madrid'),
-        'min_vencidas',           COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_min_vencidas'), 5)
+        'min_vencidas',           COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_min_vencidas'), 5),
+        'reintentos_max',         COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_reintentos_max'), 6),
+        'reintento_base_s',       COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_reintento_base_s'), 60)
     );
 $$;
 
+-- Avisa al notificador en modo eventos (canal 'push') de que ha cambiado
+-- algo de la config que afecta a cuándo o a quién avisar.
+CREATE OR REPLACE FUNCTION notificar_cambio_config_push() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_clave text := CASE WHEN TG_OP = 'DELETE' THEN OLD.clave ELSE NEW.clave END;
+BEGIN
+    IF v_clave LIKE 'push\_%' OR v_clave = 'ritmos_repaso' THEN
+        PERFORM pg_notify('push', 'config');
+    END IF;
+    RETURN NULL;
+END $$;
+
+CREATE TRIGGER config_push_aiud
+    AFTER INSERT OR UPDATE OR DELETE ON config
+    FOR EACH ROW EXECUTE FUNCTION notificar_cambio_config_push();
+
 CREATE OR REPLACE FUNCTION _push_en_ventana() RETURNS boolean
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
@@ -3473,76 +3960,241 @@ BEGIN
        AND v_h <  (v_cfg->>'ventana_fin')::int;
 END $$;
 
--- Nota: las columnas del RETURNS TABLE se convierten en variables locales.
--- Para evitar colisiones con 'usuario_id' de las tablas subyacentes usamos
--- prefijo 'o_'.
-CREATE OR REPLACE FUNCTION push_candidatos_repaso() RETURNS TABLE (
+-- Inicio del tramo de cooldown (de p_horas) que contiene now(): es la
+-- `ventana` de push_outbox. Los tramos van alineados a una fecha fija, así
+-- que todas las réplicas calculan el mismo.
+CREATE OR REPLACE FUNCTION push_ventana(p_horas int) RETURNS timestamptz
+LANGUAGE sql STABLE AS $$
+    SELECT date_bin(make_interval(hours => GREATEST(p_horas, 1)), now(),
+                    timestamptz '2000-01-01 00:00:00+00');
+$$;
+
+-- Todo lo que necesita un tick del notificador en un solo resultado: una
+-- fila por (candidato, suscripción activa), con tipo 'repaso' (medida = nº
+-- de vencidas) o 'inactividad' (medida = días sin entrar). Quedan fuera
+-- los usuarios en cooldown, los que ya tienen ese aviso pendiente en
+-- push_outbox y los que ya tienen fila en la outbox para el tramo actual
+-- en cualquier estado: un aviso descartado tras agotar los reintentos no
+-- deja rastro en push_envios y, sin esto, el usuario volvería a salir en
+-- cada tick hasta que cambiara el tramo. push_encolar_tick la vuelca en la
+-- outbox.
+--
+-- El coste no crece con el total de `repasos`: se parte de los usuarios con
+-- suscripción activa y fuera de cooldown, y de cada uno solo se leen sus
+-- repasos vencidos por rango en repasos_proximo_idx.
+--
+-- p_limite: máximo de usuarios por tipo (NULL = sin límite).
+CREATE OR REPLACE FUNCTION push_candidatos_tick(p_limite int DEFAULT 500) RETURNS TABLE (
+    o_tipo       text,
     o_usuario_id uuid,
-    o_vencidas   int
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
 )
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
     v_cfg jsonb := push_config_worker();
     v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
     v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_h   int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_hoy date  := (now() AT TIME ZONE (v_cfg->>'tz'))::date;
 BEGIN
     RETURN QUERY
-    WITH ritmos AS (
-        SELECT r.usuario_id AS uid, r.pregunta_id, r.caja, r.ultima_en,
-               ritmo_repaso_usuario(r.usuario_id) AS ritmo
-          FROM repasos r
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    usuarios_repaso AS (
+        SELECT u.uid
+          FROM con_push u
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = u.uid
+                  AND e.tipo = 'repaso'
+                  AND e.enviado_en > now() - make_interval(hours => v_int)
+         )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND (o.estado = 'pendiente' OR o.ventana = push_ventana(v_int))
+         )
     ),
     vencidas AS (
-        SELECT r.uid, count(*) AS n
-          FROM ritmos r
-         WHERE r.ultima_en + intervalo_repaso(r.caja, r.ritmo) <= now()
-         GROUP BY r.uid
+        SELECT u.uid, count(*)::int AS n
+          FROM usuarios_repaso u
+          JOIN repasos r ON r.usuario_id = u.uid
+                        AND r.proximo_repaso <= now()
+         GROUP BY u.uid
+        HAVING count(*) >= v_min
+         LIMIT p_limite
+    ),
+    inactivos AS (
+        SELECT g.usuario_id AS uid,
+               (v_hoy - g.ultimo_dia_activo)::int AS dias
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
+           AND NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = g.usuario_id
+                  AND e.tipo = 'inactividad'
+                  AND e.enviado_en > now() - make_interval(hours => v_cd)
+           )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND (o.estado = 'pendiente' OR o.ventana = push_ventana(v_cd))
+           )
+         LIMIT p_limite
+    ),
+    candidatos AS (
+        SELECT 'repaso'::text AS tipo, v.uid, v.n AS medida FROM vencidas v
+        UNION ALL
+        SELECT 'inactividad'::text, i.uid, i.dias FROM inactivos i
     )
-    SELECT v.uid, v.n::int
-      FROM vencidas v
-     WHERE v.n >= v_min
-       AND EXISTS (
-           SELECT 1 FROM push_suscripciones s
-            WHERE s.usuario_id = v.uid AND s.activa
-       )
-       AND NOT EXISTS (
-           SELECT 1 FROM push_envios e
-            WHERE e.usuario_id = v.uid
-              AND e.tipo = 'repaso'
-              AND e.enviado_en > now() - make_interval(hours => v_int)
-       );
+    SELECT c.tipo, c.uid, c.medida, s.endpoint, s.p256dh, s.auth
+      FROM candidatos c
+      JOIN push_suscripciones s ON s.usuario_id = c.uid AND s.activa;
 END $$;
 
-CREATE OR REPLACE FUNCTION push_candidatos_inactividad() RETURNS TABLE (
-    o_usuario_id uuid,
-    o_dias       int
-)
+-- Próximo instante en que habrá trabajo para el notificador, ya llevado a
+-- la ventana horaria; NULL si no hay nada previsto. Lo usa el modo eventos
+-- (NOTIF_MODO=eventos) para dormir justo hasta entonces. Para cada usuario
+-- con push activo toma el momento en que cumple las condiciones de
+-- push_candidatos_tick:
+--   · repaso: vence su min_vencidas-ésimo repaso (una sonda en
+--     repasos_proximo_idx) y ha pasado el cooldown;
+--   · inactividad: empieza el día local en que supera inactividad_horas y
+--     ha pasado el cooldown;
+-- nunca antes del fin del último tramo con fila en push_outbox (un aviso
+-- descartado no deja push_envios, y sin esto devolvería now() en bucle
+-- hasta que cambiara el tramo), y además el próximo reintento pendiente
+-- de push_outbox.
+-- Los repasos que vencen de golpe por un fallo no se avisan por NOTIFY (un
+-- aviso por respuesta serializaría los commits); los recoge el tope de
+-- espera del notificador.
+CREATE OR REPLACE FUNCTION push_proximo_evento() RETURNS timestamptz
 LANGUAGE plpgsql STABLE AS $$
 DECLARE
-    v_cfg jsonb := push_config_worker();
-    v_h   int   := (v_cfg->>'inactividad_horas')::int;
-    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
-    v_tz  text  := v_cfg->>'tz';
-    v_hoy date  := (now() AT TIME ZONE v_tz)::date;
+    v_cfg   jsonb := push_config_worker();
+    v_int   int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min   int   := (v_cfg->>'min_vencidas')::int;
+    v_h     int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd    int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_tz    text  := v_cfg->>'tz';
+    v_ini   int   := (v_cfg->>'ventana_ini')::int;
+    v_fin   int   := (v_cfg->>'ventana_fin')::int;
+    v_t     timestamptz;
+    v_local timestamp;
 BEGIN
-    RETURN QUERY
-    SELECT g.usuario_id,
-           (v_hoy - g.ultimo_dia_activo)::int
-      FROM usuario_gamificacion g
-     WHERE g.ultimo_dia_activo IS NOT NULL
-       AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
-       AND EXISTS (
-           SELECT 1 FROM push_suscripciones s
-            WHERE s.usuario_id = g.usuario_id AND s.activa
-       )
-       AND NOT EXISTS (
-           SELECT 1 FROM push_envios e
-            WHERE e.usuario_id = g.usuario_id
-              AND e.tipo = 'inactividad'
-              AND e.enviado_en > now() - make_interval(hours => v_cd)
-       );
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    repaso AS (
+        SELECT GREATEST(
+                   n.proximo,
+                   (SELECT e.enviado_en + make_interval(hours => v_int)
+                      FROM push_envios e
+                     WHERE e.usuario_id = u.uid AND e.tipo = 'repaso'),
+                   (SELECT max(o.ventana) + make_interval(hours => GREATEST(v_int, 1))
+                      FROM push_outbox o
+                     WHERE o.usuario_id = u.uid AND o.tipo = 'repaso')
+               ) AS t
+          FROM con_push u
+          CROSS JOIN LATERAL (
+              SELECT r.proximo_repaso AS proximo
+                FROM repasos r
+               WHERE r.usuario_id = u.uid
+               ORDER BY r.proximo_repaso
+              OFFSET GREATEST(v_min, 1) - 1
+               LIMIT 1
+          ) n
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND o.estado = 'pendiente'
+         )
+    ),
+    inactividad AS (
+        SELECT GREATEST(
+                   (g.ultimo_dia_activo + ceil(v_h / 24.0)::int)::timestamp AT TIME ZONE v_tz,
+                   (SELECT e.enviado_en + make_interval(hours => v_cd)
+                      FROM push_envios e
+                     WHERE e.usuario_id = g.usuario_id AND e.tipo = 'inactividad'),
+                   (SELECT max(o.ventana) + make_interval(hours => GREATEST(v_cd, 1))
+                      FROM push_outbox o
+                     WHERE o.usuario_id = g.usuario_id AND o.tipo = 'inactividad')
+               ) AS t
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND o.estado = 'pendiente'
+           )
+    ),
+    reintentos AS (
+        SELECT min(o.proximo_intento) AS t
+          FROM push_outbox o
+         WHERE o.estado = 'pendiente'
+    )
+    SELECT min(x.t) INTO v_t
+      FROM (
+          SELECT t FROM repaso
+          UNION ALL SELECT t FROM inactividad
+          UNION ALL SELECT t FROM reintentos
+      ) x;
+
+    IF v_t IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- Fuera de la ventana no se envía: se pasa a su siguiente apertura.
+    v_t := GREATEST(v_t, now());
+    v_local := v_t AT TIME ZONE v_tz;
+    IF extract(hour FROM v_local) < v_ini THEN
+        v_t := (date_trunc('day', v_local) + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    ELSIF extract(hour FROM v_local) >= v_fin THEN
+        v_t := (date_trunc('day', v_local) + interval '1 day' + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    END IF;
+    RETURN v_t;
 END $$;
 
+-- Nota: las columnas del RETURNS TABLE se convierten en variables locales.
+-- Para evitar colisiones con 'usuario_id' de las tablas subyacentes usamos
+-- prefijo 'o_'. Ambas son vistas de push_candidatos_tick por tipo (sin
+-- límite ni suscripciones), para diagnóstico desde SQL.
+CREATE OR REPLACE FUNCTION push_candidatos_repaso() RETURNS TABLE (
+    o_usuario_id uuid,
+    o_vencidas   int
+)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT t.o_usuario_id, t.o_medida
+      FROM push_candidatos_tick(NULL) t
+     WHERE t.o_tipo = 'repaso';
+$$;
+
+CREATE OR REPLACE FUNCTION push_candidatos_inactividad() RETURNS TABLE (
+    o_usuario_id uuid,
+    o_dias       int
+)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT t.o_usuario_id, t.o_medida
+      FROM push_candidatos_tick(NULL) t
+     WHERE t.o_tipo = 'inactividad';
+$$;
+
 CREATE OR REPLACE FUNCTION push_suscripciones_de(p_usuario_id uuid) RETURNS TABLE (
     endpoint text,
     p256dh   text,
@@ -3581,6 +4233,129 @@ BEGIN
        SET activa       = false,
            ultimo_error = p_motivo
      WHERE endpoint = p_endpoint;
+
+    -- Lo pendiente para esa suscripción ya no se podrá entregar.
+    UPDATE push_outbox
+       SET estado         = 'descartado',
+           ultimo_error   = p_motivo,
+           actualizado_en = now()
+     WHERE endpoint = p_endpoint AND estado = 'pendiente';
+END $$;
+
+-- ── Outbox ──────────────────────────────────────────────────────────────
+-- Ciclo de una fila: push_encolar_tick la crea, push_reclamar_outbox la
+-- entrega a un emisor y push_outbox_enviado / push_outbox_fallo registran
+-- el resultado. La entrega es "al menos una vez": si el emisor muere tras
+-- enviar y antes de registrar, la fila se reintenta al vencer el plazo.
+
+-- Vuelca los candidatos del tick en la outbox. La ventana es el inicio del
+-- tramo de cooldown del tipo (push_ventana sobre la config), así que
+-- repetir el tick o encolar desde dos réplicas a la vez no duplica avisos.
+CREATE OR REPLACE FUNCTION push_encolar_tick(p_limite int DEFAULT 500) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_n   int;
+BEGIN
+    -- Lo ya resuelto solo se guarda una semana (diagnóstico).
+    DELETE FROM push_outbox
+     WHERE estado <> 'pendiente' AND actualizado_en < now() - interval '7 days';
+
+    INSERT INTO push_outbox(usuario_id, tipo, ventana, endpoint, medida)
+    SELECT t.o_usuario_id,
+           t.o_tipo,
+           push_ventana(CASE t.o_tipo WHEN 'repaso' THEN v_int ELSE v_cd END),
+           t.o_endpoint,
+           t.o_medida
+      FROM push_candidatos_tick(p_limite) t
+    ON CONFLICT (usuario_id, tipo, ventana, endpoint) DO NOTHING;
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+-- Reclama hasta p_n envíos cuyo turno ha llegado, con FOR UPDATE SKIP
+-- LOCKED para que varias réplicas del notificador se repartan la cola. El
+-- emisor confirma la reclamación enseguida: proximo_intento se aplaza
+-- p_plazo_s segundos y, si el proceso muere a mitad de envío, la fila
+-- vuelve sola a la cola al vencer el plazo.
+CREATE OR REPLACE FUNCTION push_reclamar_outbox(p_n int, p_plazo_s int DEFAULT 300)
+RETURNS TABLE (
+    o_id         bigint,
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql AS $$
+BEGIN
+    RETURN QUERY
+    WITH lote AS (
+        SELECT o.id
+          FROM push_outbox o
+         WHERE o.estado = 'pendiente'
+           AND o.proximo_intento <= now()
+         ORDER BY o.proximo_intento
+         LIMIT p_n
+         FOR UPDATE SKIP LOCKED
+    ),
+    reclamadas AS (
+        UPDATE push_outbox o
+           SET intentos        = o.intentos + 1,
+               proximo_intento = now() + make_interval(secs => p_plazo_s),
+               actualizado_en  = now()
+          FROM lote
+         WHERE o.id = lote.id
+        RETURNING o.id, o.tipo, o.usuario_id, o.medida, o.endpoint
+    )
+    SELECT r.id, r.tipo, r.usuario_id, r.medida, r.endpoint, s.p256dh, s.auth
+      FROM reclamadas r
+      JOIN push_suscripciones s ON s.endpoint = r.endpoint;
+END $$;
+
+CREATE OR REPLACE FUNCTION push_outbox_enviado(p_id bigint, p_payload jsonb) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_uid  uuid;
+    v_tipo text;
+BEGIN
+    UPDATE push_outbox
+       SET estado         = 'enviado',
+           ultimo_error   = NULL,
+           actualizado_en = now()
+     WHERE id = p_id AND estado = 'pendiente'
+    RETURNING usuario_id, tipo INTO v_uid, v_tipo;
+    IF FOUND THEN
+        PERFORM push_marcar_envio(v_uid, v_tipo, p_payload);
+    END IF;
+END $$;
+
+-- Fallo de un envío. 'gone' desactiva la suscripción (y con ella lo que
+-- tuviera pendiente). El resto se reintenta tras base · 2^(intentos-1)
+-- segundos, con techo de 1 h, hasta push_reintentos_max intentos.
+CREATE OR REPLACE FUNCTION push_outbox_fallo(p_id bigint, p_motivo text) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cfg      jsonb := push_config_worker();
+    v_max      int   := (v_cfg->>'reintentos_max')::int;
+    v_base     int   := (v_cfg->>'reintento_base_s')::int;
+    v_endpoint text;
+BEGIN
+    IF p_motivo = 'gone' THEN
+        SELECT endpoint INTO v_endpoint FROM push_outbox WHERE id = p_id;
+        PERFORM push_marcar_error(v_endpoint, p_motivo);
+        RETURN;
+    END IF;
+    UPDATE push_outbox
+       SET estado          = CASE WHEN intentos >= v_max THEN 'descartado' ELSE 'pendiente' END,
+           proximo_intento = now() + make_interval(
+                                 secs => LEAST(v_base * 2 ^ GREATEST(intentos - 1, 0), 3600)),
+           ultimo_error    = p_motivo,
+           actualizado_en  = now()
+     WHERE id = p_id AND estado = 'pendiente';
 END $$;
 
 
@@ -3719,6 +4494,7 @@ GRANT EXECUTE ON FUNCTION importar_etiquetas(jsonb)                   TO web_use
 GRANT EXECUTE ON FUNCTION borrar_etiqueta(text)                       TO web_user;
 GRANT EXECUTE ON FUNCTION clasificar_test(uuid)                       TO web_user;
 GRANT EXECUTE ON FUNCTION reclasificar_pregunta(uuid,int,real,int,real,int) TO web_user;
+GRANT EXECUTE ON FUNCTION reclasificar_preguntas(uuid[],real,int,real,int,jsonb) TO web_user;
 GRANT EXECUTE ON FUNCTION set_etiquetas_pregunta(uuid, text[])        TO web_user;
 GRANT EXECUTE ON FUNCTION set_etiquetas_test(uuid, text[])            TO web_user;
 GRANT EXECUTE ON FUNCTION reclasificar_todas()                        TO web_user;
@@ -3747,6 +4523,7 @@ GRANT EXECUTE ON FUNCTION marcar_fichero_no_visto(text)               TO web_use
 GRANT EXECUTE ON FUNCTION mis_ficheros_vistos(text)                   TO web_user;
 GRANT EXECUTE ON FUNCTION renombrar_ruta_vistas(text, text)           TO web_user;
 GRANT EXECUTE ON FUNCTION borrar_ruta_vistas(text)                    TO web_user;
+GRANT EXECUTE ON FUNCTION teoria_para_pregunta(uuid, int)              TO web_user;
 
 GRANT EXECUTE ON FUNCTION listar_usuarios()                           TO web_user;
 GRANT EXECUTE ON FUNCTION listar_roles()                              TO web_user;
@@ -3880,6 +4657,8 @@ INSERT INTO config(clave, valor) VALUES
     ('push_inactividad_cooldown_horas', jsonb_build_object('valor', 48, 'descripcion', 'Horas mínimas entre avisos de inactividad')),
     ('push_min_vencidas',               jsonb_build_object('valor', 5,  'descripcion', 'Mínimo de preguntas vencidas para lanzar aviso')),
     ('push_tz',                         jsonb_build_object('valor', 'Europe/Madrid', 'descripcion', 'Zona horaria de la ventana de envío')),
+    ('push_reintentos_max',             jsonb_build_object('valor', 6,  'descripcion', 'Intentos máximos por envío con error transitorio')),
+    ('push_reintento_base_s',           jsonb_build_object('valor', 60, 'descripcion', 'Espera antes del primer reintento (se dobla en cada uno, hasta 1 h)')),
     ('push_vapid_public',               jsonb_build_object('valor', '', 'descripcion', 'Clave pública VAPID (base64url); rellenar tras generar el par con notificador/gen_vapid.py'))
 ON CONFLICT (clave) DO NOTHING;
 
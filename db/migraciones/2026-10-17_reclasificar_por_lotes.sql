@@ -0,0 +1,206 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Auto-tagger por lotes: `reclasificar_preguntas(uuid[])`.
+--
+-- Motivación: `reclasificar_pregunta` hacía para UNA pregunta un kNN por
+-- HNSW, un ILIKE contra todas las palabras clave del catálogo y la
+-- búsqueda del título del test. El worker de embeddings y
+-- `reclasificar_todas()`/`reclasificar_todo()` la llamaban en bucle, y una
+-- reclasificación completa tras tocar el catálogo tardaba minutos.
+--
+-- La nueva función hace lo mismo para un array de preguntas en una sola
+-- pasada: los patrones del catálogo (nombre + palabras clave) se expanden
+-- una vez, el kNN va en un LATERAL por pregunta y solo se escriben las
+-- filas cuyas etiquetas cambian. `reclasificar_pregunta` queda como
+-- envoltorio de un elemento (misma firma) y las dos funciones de
+-- reclasificación total procesan trozos de 500.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Versión por lotes del auto-tagger híbrido (mismas fuentes y pesos) para
+-- un array de preguntas en una sola pasada basada en conjuntos (los patrones
+-- del catálogo se expanden una vez y el kNN va en un LATERAL por pregunta).
+-- Las vecinas se leen con el estado previo al lote. Solo escribe las filas
+-- cuyas etiquetas cambian. Devuelve cuántas preguntas se han evaluado.
+CREATE OR REPLACE FUNCTION reclasificar_preguntas(
+    p_ids         uuid[],
+    umbral        real DEFAULT 0.55,
+    p_knn_k       int  DEFAULT 5,
+    p_knn_umbral  real DEFAULT 0.70,
+    p_knn_min     int  DEFAULT 1
+) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_n int;
+BEGIN
+    WITH
+    objetivo AS (
+        SELECT p.id, p.enunciado, p.embedding, p.etiquetas,
+               (SELECT t.titulo FROM test_preguntas tp
+                  JOIN tests t ON t.id = tp.test_id
+                 WHERE tp.pregunta_id = p.id
+                 ORDER BY t.creado_en LIMIT 1) AS test_tit,
+               -- Bloqueadas de la pregunta MÁS las del test asociado.
+               ARRAY(
+                   SELECT b FROM unnest(COALESCE(p.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE b IS NOT NULL
+                   UNION
+                   SELECT b FROM test_preguntas tp
+                     JOIN tests t ON t.id = tp.test_id
+                    CROSS JOIN unnest(COALESCE(t.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE tp.pregunta_id = p.id AND b IS NOT NULL
+               ) AS bloqueadas
+          FROM preguntas p
+         WHERE p.id = ANY(p_ids)
+           AND p.enunciado IS NOT NULL
+    ),
+    -- Nombre y palabras clave de cada etiqueta como una lista plana de
+    -- patrones; sirven igual para el enunciado y para el título del test.
+    patrones AS (
+        SELECT c.nombre, c.nombre AS patron FROM catalogo_etiquetas c
+        UNION
+        SELECT c.nombre, kw FROM catalogo_etiquetas c, unnest(c.palabras_clave) kw
+    ),
+    cat AS (
+        SELECT o.id, c.nombre
+          FROM objetivo o
+          JOIN catalogo_etiquetas c
+            ON o.embedding IS NOT NULL AND c.embedding IS NOT NULL
+           AND 1 - (c.embedding <=> o.embedding) > umbral
+        UNION
+        SELECT o.id, pt.nombre
+          FROM objetivo o
+          JOIN patrones pt
+            ON o.enunciado ILIKE '%' || pt.patron || '%'
+            OR o.test_tit  ILIKE '%' || pt.patron || '%'
+    ),
+    vecinas AS (
+        SELECT o.id, v.etiquetas, v.etiquetas_manuales, v.etiquetas_bloqueadas
+          FROM objetivo o
+         CROSS JOIN LATERAL (
+            SELECT q.etiquetas, q.etiquetas_manuales, q.etiquetas_bloqueadas,
+                   1 - (q.embedding <=> o.embedding) AS sim
+              FROM preguntas q
+             WHERE q.embedding IS NOT NULL
+               AND q.id <> o.id
+               AND cardinality(q.etiquetas) > 0
+             ORDER BY q.embedding <=> o.embedding
+             LIMIT GREATEST(p_knn_k, 1)
+         ) v
+         WHERE o.embedding IS NOT NULL
+           AND v.sim >= p_knn_umbral
+    ),
+    -- Mismos pesos que en reclasificar_pregunta: 1 por etiqueta, 2 por
+    -- manual, -3 por bloqueada en la vecina.
+    votos_knn AS (
+        SELECT x.id, x.e AS nombre, SUM(x.peso) AS peso
+          FROM (
+            SELECT id, unnest(etiquetas)            AS e,  1 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_manuales)   AS e,  2 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_bloqueadas) AS e, -3 AS peso FROM vecinas
+          ) x
+         GROUP BY x.id, x.e
+    ),
+    candidatas AS (
+        SELECT id, nombre FROM cat
+        UNION
+        SELECT id, nombre FROM votos_knn WHERE peso >= GREATEST(p_knn_min, 1)
+    ),
+    nuevas AS (
+        SELECT o.id,
+               o.etiquetas AS antes,
+               ARRAY(
+                   SELECT DISTINCT e
+                     FROM unnest(o.etiquetas || ARRAY(
+                              SELECT c.nombre FROM candidatas c WHERE c.id = o.id
+                          )) AS e
+                    WHERE e <> ALL(o.bloqueadas)
+               ) AS despues
+          FROM objetivo o
+    ),
+    upd AS (
+        UPDATE preguntas p
+           SET etiquetas      = n.despues,
+               actualizado_en = now()
+          FROM nuevas n
+         WHERE p.id = n.id
+           AND n.despues IS DISTINCT FROM n.antes
+        RETURNING p.id
+    )
+    SELECT count(*) INTO v_n FROM objetivo;
+    RETURN v_n;
+END $$;
+
+CREATE OR REPLACE FUNCTION reclasificar_pregunta(
+    p_id          uuid,
+    k             int  DEFAULT 5,
+    umbral        real DEFAULT 0.55,
+    p_knn_k       int  DEFAULT 5,
+    p_knn_umbral  real DEFAULT 0.70,
+    p_knn_min     int  DEFAULT 1
+) RETURNS int
+LANGUAGE sql AS $$
+    SELECT reclasificar_preguntas(ARRAY[p_id], umbral, p_knn_k, p_knn_umbral, p_knn_min);
+$$;
+
+-- Ambas recorren las preguntas en trozos de 500 con reclasificar_preguntas.
+CREATE OR REPLACE FUNCTION reclasificar_todas() RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE v_n int := 0; v_ids uuid[];
+BEGIN
+    IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
+        RAISE EXCEPTION 'permiso_denegado';
+    END IF;
+    FOR v_ids IN
+        SELECT array_agg(id) FROM (
+            SELECT id, (row_number() OVER (ORDER BY id) - 1) / 500 AS trozo
+              FROM preguntas WHERE embedding IS NOT NULL
+        ) x GROUP BY trozo
+    LOOP
+        PERFORM reclasificar_preguntas(v_ids);
+        v_n := v_n + cardinality(v_ids);
+    END LOOP;
+    RETURN v_n;
+END $$;
+
+CREATE OR REPLACE FUNCTION reclasificar_todo() RETURNS jsonb
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_tests_n     int := 0;
+    v_preguntas_n int := 0;
+    v_id          uuid;
+    v_ids         uuid[];
+BEGIN
+    IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
+        RAISE EXCEPTION 'permiso_denegado';
+    END IF;
+
+    FOR v_id IN SELECT id FROM tests LOOP
+        PERFORM clasificar_test(v_id);
+        v_tests_n := v_tests_n + 1;
+    END LOOP;
+
+    FOR v_ids IN
+        SELECT array_agg(id) FROM (
+            SELECT id, (row_number() OVER (ORDER BY id) - 1) / 500 AS trozo
+              FROM preguntas
+        ) x GROUP BY trozo
+    LOOP
+        PERFORM reclasificar_preguntas(v_ids);
+        v_preguntas_n := v_preguntas_n + cardinality(v_ids);
+    END LOOP;
+
+    RETURN jsonb_build_object(
+        'tests_procesados',     v_tests_n,
+        'preguntas_procesadas', v_preguntas_n
+    );
+END $$;
+
+GRANT EXECUTE ON FUNCTION reclasificar_preguntas(uuid[],real,int,real,int) TO web_user;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
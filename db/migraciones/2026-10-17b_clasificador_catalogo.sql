@@ -0,0 +1,184 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Clasificador del catálogo en memoria (servicio embeddings).
+--
+-- Motivación: la parte de palabras clave del auto-tagger evaluaba un
+-- `ILIKE '%kw%'` por cada palabra clave de cada etiqueta, para el
+-- enunciado y otra vez para el título del test. El worker de embeddings
+-- ahora mantiene el catálogo en memoria (autómata Aho-Corasick sin tildes
+-- ni mayúsculas + matriz de embeddings) y calcula esas candidatas para
+-- todo el lote; a SQL solo le quedan el kNN y la escritura.
+--
+--   • `reclasificar_preguntas` gana el parámetro `p_candidatas jsonb`
+--     ({"<uuid>": ["etiqueta", ...]}). Sin él, se comporta como antes.
+--   • Trigger `catalogo_etiquetas_clasif_aiud`: NOTIFY embeddings
+--     'catalogo:<nombre>' al crear, borrar o cambiar nombre, palabras
+--     clave o embedding de una etiqueta, para que el worker recargue solo
+--     esa fila.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Cambia la firma: hay que borrar la versión de 5 parámetros.
+DROP FUNCTION IF EXISTS reclasificar_preguntas(uuid[], real, int, real, int);
+
+-- p_candidatas: {"<uuid>": ["etiqueta", ...]} ya calculadas fuera (el
+-- clasificador en memoria del worker de embeddings cubre (a)–(d)). Si se
+-- pasa, sustituye a esas fuentes y aquí solo quedan el kNN y la escritura.
+CREATE OR REPLACE FUNCTION reclasificar_preguntas(
+    p_ids         uuid[],
+    umbral        real  DEFAULT 0.55,
+    p_knn_k       int   DEFAULT 5,
+    p_knn_umbral  real  DEFAULT 0.70,
+    p_knn_min     int   DEFAULT 1,
+    p_candidatas  jsonb DEFAULT NULL
+) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_n int;
+BEGIN
+    WITH
+    objetivo AS (
+        SELECT p.id, p.enunciado, p.embedding, p.etiquetas,
+               (SELECT t.titulo FROM test_preguntas tp
+                  JOIN tests t ON t.id = tp.test_id
+                 WHERE tp.pregunta_id = p.id
+                 ORDER BY t.creado_en LIMIT 1) AS test_tit,
+               -- Bloqueadas de la pregunta MÁS las del test asociado.
+               ARRAY(
+                   SELECT b FROM unnest(COALESCE(p.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE b IS NOT NULL
+                   UNION
+                   SELECT b FROM test_preguntas tp
+                     JOIN tests t ON t.id = tp.test_id
+                    CROSS JOIN unnest(COALESCE(t.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE tp.pregunta_id = p.id AND b IS NOT NULL
+               ) AS bloqueadas
+          FROM preguntas p
+         WHERE p.id = ANY(p_ids)
+           AND p.enunciado IS NOT NULL
+    ),
+    -- Nombre y palabras clave de cada etiqueta como una lista plana de
+    -- patrones; sirven igual para el enunciado y para el título del test.
+    patrones AS (
+        SELECT c.nombre, c.nombre AS patron FROM catalogo_etiquetas c
+        UNION
+        SELECT c.nombre, kw FROM catalogo_etiquetas c, unnest(c.palabras_clave) kw
+    ),
+    cat AS (
+        SELECT o.id, c.nombre
+          FROM objetivo o
+         CROSS JOIN jsonb_array_elements_text(p_candidatas -> o.id::text) AS j(nombre)
+          JOIN catalogo_etiquetas c ON c.nombre = j.nombre
+         WHERE p_candidatas IS NOT NULL
+        UNION
+        SELECT o.id, c.nombre
+          FROM objetivo o
+          JOIN catalogo_etiquetas c
+            ON o.embedding IS NOT NULL AND c.embedding IS NOT NULL
+           AND 1 - (c.embedding <=> o.embedding) > umbral
+         WHERE p_candidatas IS NULL
+        UNION
+        SELECT o.id, pt.nombre
+          FROM objetivo o
+          JOIN patrones pt
+            ON o.enunciado ILIKE '%' || pt.patron || '%'
+            OR o.test_tit  ILIKE '%' || pt.patron || '%'
+         WHERE p_candidatas IS NULL
+    ),
+    vecinas AS (
+        SELECT o.id, v.etiquetas, v.etiquetas_manuales, v.etiquetas_bloqueadas
+          FROM objetivo o
+         CROSS JOIN LATERAL (
+            SELECT q.etiquetas, q.etiquetas_manuales, q.etiquetas_bloqueadas,
+                   1 - (q.embedding <=> o.embedding) AS sim
+              FROM preguntas q
+             WHERE q.embedding IS NOT NULL
+               AND q.id <> o.id
+               AND cardinality(q.etiquetas) > 0
+             ORDER BY q.embedding <=> o.embedding
+             LIMIT GREATEST(p_knn_k, 1)
+         ) v
+         WHERE o.embedding IS NOT NULL
+           AND v.sim >= p_knn_umbral
+    ),
+    -- Mismos pesos que en reclasificar_pregunta: 1 por etiqueta, 2 por
+    -- manual, -3 por bloqueada en la vecina.
+    votos_knn AS (
+        SELECT x.id, x.e AS nombre, SUM(x.peso) AS peso
+          FROM (
+            SELECT id, unnest(etiquetas)            AS e,  1 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_manuales)   AS e,  2 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_bloqueadas) AS e, -3 AS peso FROM vecinas
+          ) x
+         GROUP BY x.id, x.e
+    ),
+    candidatas AS (
+        SELECT id, nombre FROM cat
+        UNION
+        SELECT id, nombre FROM votos_knn WHERE peso >= GREATEST(p_knn_min, 1)
+    ),
+    nuevas AS (
+        SELECT o.id,
+               o.etiquetas AS antes,
+               ARRAY(
+                   SELECT DISTINCT e
+                     FROM unnest(o.etiquetas || ARRAY(
+                              SELECT c.nombre FROM candidatas c WHERE c.id = o.id
+                          )) AS e
+                    WHERE e <> ALL(o.bloqueadas)
+               ) AS despues
+          FROM objetivo o
+    ),
+    upd AS (
+        UPDATE preguntas p
+           SET etiquetas      = n.despues,
+               actualizado_en = now()
+          FROM nuevas n
+         WHERE p.id = n.id
+           AND n.despues IS DISTINCT FROM n.antes
+        RETURNING p.id
+    )
+    SELECT count(*) INTO v_n FROM objetivo;
+    RETURN v_n;
+END $$;
+
+CREATE OR REPLACE FUNCTION reclasificar_pregunta(
+    p_id          uuid,
+    k             int  DEFAULT 5,
+    umbral        real DEFAULT 0.55,
+    p_knn_k       int  DEFAULT 5,
+    p_knn_umbral  real DEFAULT 0.70,
+    p_knn_min     int  DEFAULT 1
+) RETURNS int
+LANGUAGE sql AS $$
+    SELECT reclasificar_preguntas(ARRAY[p_id], umbral, p_knn_k, p_knn_umbral, p_knn_min);
+$$;
+
+-- Avisa al clasificador en memoria del worker (embeddings/clasificador.py)
+-- de que una etiqueta del catálogo ha cambiado; recarga solo esa fila.
+CREATE OR REPLACE FUNCTION notificar_cambio_catalogo() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM pg_notify('embeddings', 'catalogo:' || OLD.nombre);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.nombre <> OLD.nombre) THEN
+        PERFORM pg_notify('embeddings', 'catalogo:' || NEW.nombre);
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS catalogo_etiquetas_clasif_aiud ON catalogo_etiquetas;
+CREATE TRIGGER catalogo_etiquetas_clasif_aiud
+    AFTER INSERT OR DELETE OR UPDATE OF nombre, palabras_clave, embedding
+    ON catalogo_etiquetas
+    FOR EACH ROW EXECUTE FUNCTION notificar_cambio_catalogo();
+
+GRANT EXECUTE ON FUNCTION reclasificar_preguntas(uuid[],real,int,real,int,jsonb) TO web_user;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,169 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Carriles de prioridad y deduplicado en `cola_embeddings`.
+--
+-- Motivación: la cola se procesaba estrictamente por `encolado_en`, así
+-- que editar la descripción de una etiqueta esperaba detrás de las 20k
+-- filas de un `encolar_revectorizado_total()`. Y cada edición repetida de
+-- la misma pregunta añadía una fila más que se vectorizaba otra vez.
+--
+--   • Columna `prioridad`: 0 = edición interactiva, 1 = importación,
+--     2 = reconstrucción completa. Índices parciales nuevos.
+--   • `_encolar_embedding(entidad, id)`: los triggers ya no insertan a
+--     ciegas; si hay una fila pendiente y libre de la misma entidad solo le
+--     suben la prioridad. El carril sale de `aprentix.cola_prioridad`, que
+--     `importar_test`, `importar_test_normalizado` e `importar_etiquetas`
+--     fijan a 1 (cláusula SET de la función).
+--   • `reclamar_cola_embeddings(n)`: reparto 60/30/10 entre carriles con
+--     relleno posterior por prioridad, y reclamación conjunta de
+--     duplicados de la misma entidad. La usa el worker.
+--   • `encolar_revectorizado_total()` encola en el carril 2 sin duplicar.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+ALTER TABLE cola_embeddings
+    ADD COLUMN IF NOT EXISTS prioridad smallint NOT NULL DEFAULT 0;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM pg_constraint
+         WHERE conrelid = 'cola_embeddings'::regclass
+           AND conname = 'cola_embeddings_prioridad_check'
+    ) THEN
+        ALTER TABLE cola_embeddings
+            ADD CONSTRAINT cola_embeddings_prioridad_check CHECK (prioridad BETWEEN 0 AND 2);
+    END IF;
+END $$;
+
+DROP INDEX IF EXISTS cola_emb_pendiente;
+CREATE INDEX cola_emb_pendiente ON cola_embeddings (prioridad, encolado_en)
+    WHERE procesado_en IS NULL;
+CREATE INDEX IF NOT EXISTS cola_emb_entidad_pendiente ON cola_embeddings (entidad, entidad_id)
+    WHERE procesado_en IS NULL;
+
+-- Encola una entidad para (re)vectorizar. El carril sale de la variable de
+-- sesión aprentix.cola_prioridad (0 si no está fijada): las funciones de
+-- importación la fijan a 1 con `SET` en su cabecera. Si la entidad ya tiene
+-- una fila pendiente y libre, no se duplica: solo se sube su prioridad.
+-- Una fila bloqueada la está procesando un worker con el texto anterior,
+-- así que en ese caso sí hace falta una nueva.
+CREATE OR REPLACE FUNCTION _encolar_embedding(p_entidad text, p_entidad_id text) RETURNS void
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+DECLARE
+    v_prio smallint := COALESCE(
+        NULLIF(current_setting('aprentix.cola_prioridad', true), '')::smallint, 0);
+    v_id   bigint;
+BEGIN
+    SELECT id INTO v_id FROM cola_embeddings
+     WHERE entidad = p_entidad AND entidad_id = p_entidad_id
+       AND procesado_en IS NULL
+     LIMIT 1
+     FOR UPDATE SKIP LOCKED;
+    IF FOUND THEN
+        UPDATE cola_embeddings SET prioridad = LEAST(prioridad, v_prio) WHERE id = v_id;
+    ELSE
+        INSERT INTO cola_embeddings(entidad, entidad_id, prioridad)
+        VALUES (p_entidad, p_entidad_id, v_prio);
+    END IF;
+    -- Las ediciones puntuales avisan con el id para que el worker las
+    -- atienda primero; el resto avisa 'bulk', que Postgres colapsa en un
+    -- único NOTIFY por transacción.
+    IF v_prio = 0 THEN
+        PERFORM pg_notify('embeddings', p_entidad || ':' || p_entidad_id);
+    ELSE
+        PERFORM pg_notify('embeddings', 'bulk');
+    END IF;
+END $$;
+
+CREATE OR REPLACE FUNCTION encolar_embedding_pregunta() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    PERFORM _encolar_embedding('pregunta', NEW.id::text);
+    RETURN NEW;
+END $$;
+
+CREATE OR REPLACE FUNCTION encolar_embedding_etiqueta() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    PERFORM _encolar_embedding('etiqueta', NEW.nombre);
+    RETURN NEW;
+END $$;
+
+-- Reclama hasta p_n filas pendientes para un worker (FOR UPDATE SKIP
+-- LOCKED, dentro de su transacción). Primero cada carril hasta su cuota
+-- (60 % interactivo, 30 % importación, 10 % reconstrucción) para que el
+-- trabajo masivo siga avanzando aunque no paren de llegar ediciones;
+-- después se rellena por prioridad y antigüedad. También reclama las
+-- filas pendientes duplicadas de las mismas entidades, para vectorizar
+-- cada una una sola vez.
+CREATE OR REPLACE FUNCTION reclamar_cola_embeddings(p_n int)
+RETURNS TABLE(id bigint, entidad text, entidad_id text)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_ids  bigint[] := '{}';
+    v_prio int;
+BEGIN
+    FOREACH v_prio IN ARRAY ARRAY[0, 1, 2] LOOP
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.prioridad = v_prio
+             ORDER BY c.encolado_en
+             LIMIT GREATEST(1, floor(p_n * (ARRAY[0.6, 0.3, 0.1])[v_prio + 1]))::int
+             FOR UPDATE SKIP LOCKED
+        );
+    END LOOP;
+
+    IF cardinality(v_ids) < p_n THEN
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+             ORDER BY c.prioridad, c.encolado_en
+             LIMIT p_n - cardinality(v_ids)
+             FOR UPDATE SKIP LOCKED
+        );
+    END IF;
+
+    v_ids := v_ids || ARRAY(
+        SELECT c.id FROM cola_embeddings c
+          JOIN cola_embeddings r
+            ON r.id = ANY(v_ids)
+           AND r.entidad = c.entidad AND r.entidad_id = c.entidad_id
+         WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+         FOR UPDATE OF c SKIP LOCKED
+    );
+
+    RETURN QUERY
+        SELECT c.id, c.entidad, c.entidad_id FROM cola_embeddings c WHERE c.id = ANY(v_ids);
+END $$;
+
+CREATE OR REPLACE FUNCTION encolar_revectorizado_total() RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE v_n int;
+BEGIN
+    IF NOT (tiene_permiso('etiqueta.gestionar') OR es_admin()) THEN
+        RAISE EXCEPTION 'permiso_denegado';
+    END IF;
+    -- Carril 2 (reconstrucción); las que ya estaban pendientes no se
+    -- duplican.
+    INSERT INTO cola_embeddings(entidad, entidad_id, prioridad)
+    SELECT 'pregunta', p.id::text, 2 FROM preguntas p
+     WHERE NOT EXISTS (
+        SELECT 1 FROM cola_embeddings c
+         WHERE c.entidad = 'pregunta' AND c.entidad_id = p.id::text
+           AND c.procesado_en IS NULL
+     );
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    PERFORM pg_notify('embeddings', 'bulk');
+    RETURN v_n;
+END $$;
+
+ALTER FUNCTION importar_test(text, jsonb)                   SET aprentix.cola_prioridad = '1';
+ALTER FUNCTION importar_test_normalizado(text, text, jsonb) SET aprentix.cola_prioridad = '1';
+ALTER FUNCTION importar_etiquetas(jsonb)                    SET aprentix.cola_prioridad = '1';
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,164 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Candidatos a push y sus suscripciones en una sola consulta.
+--
+-- Motivación: el notificador pedía los candidatos y después las
+-- suscripciones de cada usuario (una ida y vuelta por usuario), y
+-- `push_candidatos_repaso()` llamaba a `ritmo_repaso_usuario()` e
+-- `intervalo_repaso()` para cada fila de `repasos` de TODOS los usuarios,
+-- tuvieran push o no. El tick crecía con el tamaño de `repasos`.
+--
+--   • `curvas_repaso()`: la curva de `config('ritmos_repaso')` expandida
+--     a (ritmo, caja, intervalo), para cruzarla por join.
+--   • `push_candidatos_tick(p_limite)`: una fila por (candidato,
+--     suscripción activa) con tipo, medida y claves de la suscripción.
+--     Parte de los usuarios con push activo y fuera de cooldown, y solo
+--     lee los repasos con `ultima_en` anterior al intervalo más corto de su
+--     ritmo. El notificador la lee con un cursor de servidor.
+--   • `push_candidatos_repaso()` y `push_candidatos_inactividad()` se
+--     mantienen con la misma firma como vistas de la anterior.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Curva de repaso expandida: una fila por (ritmo, caja) con su intervalo,
+-- con el mismo recorte de caja que intervalo_repaso. Las consultas que
+-- cuentan vencidas para muchos usuarios la cruzan por join en vez de llamar
+-- a intervalo_repaso() fila a fila.
+CREATE OR REPLACE FUNCTION curvas_repaso() RETURNS TABLE (
+    ritmo     text,
+    caja      int,
+    intervalo interval
+)
+LANGUAGE sql STABLE AS $$
+    SELECT k.key,
+           c.caja,
+           make_interval(hours => (k.value->>(LEAST(c.caja, jsonb_array_length(k.value)) - 1))::numeric::int)
+      FROM config cfg
+     CROSS JOIN LATERAL jsonb_each(cfg.valor) k
+     CROSS JOIN generate_series(1, 7) AS c(caja)
+     WHERE cfg.clave = 'ritmos_repaso'
+       AND jsonb_typeof(k.value) = 'array'
+       AND jsonb_array_length(k.value) > 0;
+$$;
+
+-- Todo lo que necesita un tick del notificador en un solo resultado: una
+-- fila por (candidato, suscripción activa), con tipo 'repaso' (medida = nº
+-- de vencidas) o 'inactividad' (medida = días sin entrar). El notificador
+-- la lee con un cursor de servidor, sin ida y vuelta por usuario.
+--
+-- El coste no crece con el total de `repasos`: se parte de los usuarios con
+-- suscripción activa y fuera de cooldown, su ritmo sale de un join con
+-- preferencias_usuario y curvas_repaso (no de funciones por fila), y solo
+-- se leen sus repasos con `ultima_en` anterior al intervalo más corto de su
+-- curva, que acota el rango en repasos_usuario_idx.
+--
+-- p_limite: máximo de usuarios por tipo (NULL = sin límite).
+CREATE OR REPLACE FUNCTION push_candidatos_tick(p_limite int DEFAULT 500) RETURNS TABLE (
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_h   int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_hoy date  := (now() AT TIME ZONE (v_cfg->>'tz'))::date;
+BEGIN
+    RETURN QUERY
+    WITH curvas AS MATERIALIZED (
+        SELECT * FROM curvas_repaso()
+    ),
+    minimos AS (
+        SELECT c.ritmo, min(c.intervalo) AS intervalo
+          FROM curvas c
+         GROUP BY c.ritmo
+    ),
+    con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    usuarios_repaso AS (
+        SELECT u.uid,
+               COALESCE(m.ritmo, 'normal') AS ritmo
+          FROM con_push u
+          LEFT JOIN preferencias_usuario p ON p.usuario_id = u.uid
+          LEFT JOIN minimos m ON m.ritmo = p.ritmo_repaso
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = u.uid
+                  AND e.tipo = 'repaso'
+                  AND e.enviado_en > now() - make_interval(hours => v_int)
+         )
+    ),
+    vencidas AS (
+        SELECT u.uid, count(*)::int AS n
+          FROM usuarios_repaso u
+          JOIN minimos m ON m.ritmo = u.ritmo
+          JOIN repasos r ON r.usuario_id = u.uid
+                        AND r.ultima_en <= now() - m.intervalo
+          JOIN curvas c ON c.ritmo = u.ritmo AND c.caja = r.caja
+         WHERE r.ultima_en + c.intervalo <= now()
+         GROUP BY u.uid
+        HAVING count(*) >= v_min
+         LIMIT p_limite
+    ),
+    inactivos AS (
+        SELECT g.usuario_id AS uid,
+               (v_hoy - g.ultimo_dia_activo)::int AS dias
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
+           AND NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = g.usuario_id
+                  AND e.tipo = 'inactividad'
+                  AND e.enviado_en > now() - make_interval(hours => v_cd)
+           )
+         LIMIT p_limite
+    ),
+    candidatos AS (
+        SELECT 'repaso'::text AS tipo, v.uid, v.n AS medida FROM vencidas v
+        UNION ALL
+        SELECT 'inactividad'::text, i.uid, i.dias FROM inactivos i
+    )
+    SELECT c.tipo, c.uid, c.medida, s.endpoint, s.p256dh, s.auth
+      FROM candidatos c
+      JOIN push_suscripciones s ON s.usuario_id = c.uid AND s.activa;
+END $$;
+
+-- Nota: las columnas del RETURNS TABLE se convierten en variables locales.
+-- Para evitar colisiones con 'usuario_id' de las tablas subyacentes usamos
+-- prefijo 'o_'. Ambas son vistas de push_candidatos_tick por tipo (sin
+-- límite ni suscripciones), para diagnóstico desde SQL.
+CREATE OR REPLACE FUNCTION push_candidatos_repaso() RETURNS TABLE (
+    o_usuario_id uuid,
+    o_vencidas   int
+)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT t.o_usuario_id, t.o_medida
+      FROM push_candidatos_tick(NULL) t
+     WHERE t.o_tipo = 'repaso';
+$$;
+
+CREATE OR REPLACE FUNCTION push_candidatos_inactividad() RETURNS TABLE (
+    o_usuario_id uuid,
+    o_dias       int
+)
+LANGUAGE sql STABLE AS $$
+    SELECT DISTINCT t.o_usuario_id, t.o_medida
+      FROM push_candidatos_tick(NULL) t
+     WHERE t.o_tipo = 'inactividad';
+$$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
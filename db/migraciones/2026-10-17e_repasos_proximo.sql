@@ -0,0 +1,425 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Fecha del próximo repaso materializada en `repasos`.
+--
+-- Motivación: todas las lecturas del motor Leitner (preguntas_repaso_*,
+-- resumen_repaso_*, candidatos de push) calculaban
+-- `ultima_en + intervalo_repaso(caja, ritmo)` fila a fila, así que ninguna
+-- podía usar un índice y abrir la pantalla de repaso recorría todos los
+-- repasos del usuario.
+--
+--   • Columna `repasos.proximo_repaso` e índice
+--     `repasos_proximo_idx (usuario_id, proximo_repaso) INCLUDE (pregunta_id, caja)`.
+--   • La escribe `registrar_respuesta` junto con caja y ultima_en. La
+--     recalcula `_recalcular_proximos_repasos(usuario?)`, que llaman
+--     `set_ritmo_repaso` (repasos del usuario) y el trigger
+--     `config_ritmos_repaso_au` al cambiar la curva (todos).
+--     `resetear_mis_repasos` borra filas y no necesita cambios.
+--   • `preguntas_repaso_*` recorren el índice por rango y paran a las N;
+--     `resumen_repaso_*` y `push_candidatos_tick` leen la columna.
+--   • Rellena la columna para los repasos existentes.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+ALTER TABLE repasos
+    ADD COLUMN IF NOT EXISTS proximo_repaso timestamptz NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS repasos_proximo_idx ON repasos (usuario_id, proximo_repaso)
+    INCLUDE (pregunta_id, caja);
+
+-- Recalcula repasos.proximo_repaso de un usuario (o de todos, con NULL) a
+-- partir de su ritmo actual y la curva vigente. Solo escribe las filas que
+-- cambian. SECURITY DEFINER: el trigger de config la llama para todos los
+-- usuarios aunque quien edite la config solo vea sus propios repasos.
+CREATE OR REPLACE FUNCTION _recalcular_proximos_repasos(p_usuario_id uuid DEFAULT NULL)
+RETURNS int
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+DECLARE
+    v_n int;
+BEGIN
+    WITH curvas AS MATERIALIZED (
+        SELECT * FROM curvas_repaso()
+    ),
+    ritmos AS (
+        SELECT DISTINCT c.ritmo FROM curvas c
+    ),
+    nuevos AS (
+        SELECT r.usuario_id, r.pregunta_id, r.ultima_en + c.intervalo AS proximo
+          FROM repasos r
+          LEFT JOIN preferencias_usuario p ON p.usuario_id = r.usuario_id
+          LEFT JOIN ritmos rt ON rt.ritmo = p.ritmo_repaso
+          JOIN curvas c ON c.ritmo = COALESCE(rt.ritmo, 'normal') AND c.caja = r.caja
+         WHERE p_usuario_id IS NULL OR r.usuario_id = p_usuario_id
+    )
+    UPDATE repasos r
+       SET proximo_repaso = n.proximo
+      FROM nuevos n
+     WHERE r.usuario_id = n.usuario_id
+       AND r.pregunta_id = n.pregunta_id
+       AND r.proximo_repaso IS DISTINCT FROM n.proximo;
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+CREATE OR REPLACE FUNCTION config_ritmos_repaso_au() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    PERFORM _recalcular_proximos_repasos(NULL);
+    RETURN NULL;
+END $$;
+
+-- Cambiar la curva de config('ritmos_repaso') reprograma todos los repasos.
+DROP TRIGGER IF EXISTS config_ritmos_repaso_au ON config;
+CREATE TRIGGER config_ritmos_repaso_au
+    AFTER UPDATE OF valor ON config
+    FOR EACH ROW WHEN (
+        NEW.clave = 'ritmos_repaso' AND NEW.valor IS DISTINCT FROM OLD.valor
+    )
+    EXECUTE FUNCTION config_ritmos_repaso_au();
+
+-- registrar_respuesta hace tres cosas de una:
+--   1) guarda la respuesta cruda en 'respuestas' (histórico intacto);
+--   2) mantiene el marcador 'fallo' compatible con el "Test de fallos"
+--      (borra el marcador si aciertas la pregunta previamente fallada);
+--   3) mueve la caja de repaso Leitner correspondiente.
+--
+-- Semántica de p_adelantada = true: el acierto NO cambia caja ni ultima_en
+-- (evita "farmear" cajas adelantándose). Los fallos siempre penalizan.
+--
+-- proximo_repaso se escribe aquí junto con caja y ultima_en. En el caso de
+-- fallo, anclamos ultima_en en el pasado exactamente el intervalo de la
+-- caja final para que proximo_repaso caiga en now() (vencida al instante)
+-- y siga cuadrando con ultima_en + intervalo si se recalcula.
+CREATE OR REPLACE FUNCTION registrar_respuesta(
+    p_intento_id  uuid,
+    p_pregunta_id uuid,
+    p_texto       text,
+    p_correcta    boolean,
+    p_adelantada  boolean DEFAULT false
+) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_uid       uuid := jwt_usuario_id();
+    v_ritmo     text;
+    v_caja_new  int;
+    v_caja_prev int;                  -- caja Leitner ANTES de esta respuesta
+    v_intv      interval;
+    v_era_fallo boolean;              -- pregunta ya estaba en 'fallos' del usuario
+    v_es_repaso boolean;              -- ya tenía fila en repasos → la ronda "cuenta como repaso"
+BEGIN
+    INSERT INTO respuestas(intento_id, pregunta_id, opcion_elegida, correcta)
+    VALUES (p_intento_id, p_pregunta_id, p_texto, p_correcta);
+
+    -- Contexto capturado para el motor de retos.
+    SELECT true INTO v_era_fallo
+      FROM marcadores
+     WHERE usuario_id = v_uid AND tipo = 'fallo' AND pregunta_id = p_pregunta_id;
+    v_era_fallo := COALESCE(v_era_fallo, false);
+
+    SELECT caja INTO v_caja_prev
+      FROM repasos WHERE usuario_id = v_uid AND pregunta_id = p_pregunta_id;
+    v_es_repaso := v_caja_prev IS NOT NULL;
+
+    IF NOT p_correcta THEN
+        INSERT INTO marcadores(usuario_id, tipo, pregunta_id, contador, actualizado_en)
+        VALUES (v_uid, 'fallo', p_pregunta_id, 1, now())
+        ON CONFLICT (usuario_id, tipo, COALESCE(pregunta_id, test_id))
+        DO UPDATE SET contador = marcadores.contador + 1,
+                       actualizado_en = now();
+    ELSE
+        DELETE FROM marcadores
+         WHERE usuario_id = v_uid
+           AND tipo = 'fallo'
+           AND pregunta_id = p_pregunta_id;
+    END IF;
+
+    v_ritmo := ritmo_repaso_usuario(v_uid);
+
+    IF p_correcta AND p_adelantada THEN
+        -- Sesión adelantada: la caja no sube (no "farmear" repasos).
+        v_caja_new := COALESCE(v_caja_prev, 1);
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, 2, 1, 0, now(), now() + intervalo_repaso(2, v_ritmo))
+        ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
+            SET aciertos = repasos.aciertos + 1;
+
+    ELSIF p_correcta THEN
+        v_caja_new := LEAST(COALESCE(v_caja_prev, 1) + 1, 7);
+        IF v_caja_prev IS NULL THEN v_caja_new := 2; END IF;
+
+        v_intv := intervalo_repaso(v_caja_new, v_ritmo);
+
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, v_caja_new, 1, 0, now(), now() + v_intv)
+        ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
+            SET caja           = v_caja_new,
+                aciertos       = repasos.aciertos + 1,
+                ultima_en      = now(),
+                proximo_repaso = now() + v_intv;
+
+    ELSE
+        v_caja_new := GREATEST(COALESCE(v_caja_prev, 1) - 2, 1);
+        v_intv := intervalo_repaso(v_caja_new, v_ritmo);
+
+        INSERT INTO repasos(usuario_id, pregunta_id, caja, aciertos, fallos, ultima_en, proximo_repaso)
+        VALUES (v_uid, p_pregunta_id, v_caja_new, 0, 1, now() - v_intv, now())
+        ON CONFLICT (usuario_id, pregunta_id) DO UPDATE
+            SET caja           = v_caja_new,
+                fallos         = repasos.fallos + 1,
+                ultima_en      = now() - v_intv,
+                proximo_repaso = now();
+    END IF;
+
+    -- Motor de gamificación: solo UPSERTs, no bloqueante en la práctica.
+    PERFORM _gamif_on_respuesta(
+        v_uid, p_pregunta_id, p_correcta, p_adelantada,
+        v_es_repaso, v_caja_prev, v_caja_new, v_era_fallo
+    );
+END $$;
+
+-- Cambiar de ritmo reprograma proximo_repaso de todos los repasos del
+-- usuario (un UPDATE por conjunto; solo las filas que cambian).
+CREATE OR REPLACE FUNCTION set_ritmo_repaso(p_ritmo text) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF p_ritmo NOT IN ('intensivo','normal','relajado') THEN
+        RAISE EXCEPTION 'ritmo_invalido';
+    END IF;
+    INSERT INTO preferencias_usuario(usuario_id, ritmo_repaso, actualizado_en)
+    VALUES (jwt_usuario_id(), p_ritmo, now())
+    ON CONFLICT (usuario_id) DO UPDATE
+        SET ritmo_repaso   = EXCLUDED.ritmo_repaso,
+            actualizado_en = now();
+    PERFORM _recalcular_proximos_repasos(jwt_usuario_id());
+    RETURN jsonb_build_object('ritmo', p_ritmo);
+END $$;
+
+-- Los resúmenes leen proximo_repaso tal cual (sin recalcular por fila) y
+-- sacan los cuatro números en una sola pasada con agregados FILTER.
+CREATE OR REPLACE FUNCTION resumen_repaso_test(p_test_id uuid) RETURNS jsonb
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_uid uuid := jwt_usuario_id();
+BEGIN
+    RETURN (
+        SELECT jsonb_build_object(
+            'total_repasos',  count(*),
+            'vencidas',       count(*) FILTER (WHERE r.proximo_repaso <= now()),
+            'dominadas',      count(*) FILTER (WHERE r.caja = 7),
+            'siguiente',      min(r.proximo_repaso) FILTER (WHERE r.proximo_repaso > now()),
+            'test_realizado', EXISTS (
+                SELECT 1 FROM intentos WHERE usuario_id = v_uid AND test_id = p_test_id
+            )
+        )
+        FROM repasos r
+        JOIN test_preguntas tp ON tp.pregunta_id = r.pregunta_id
+        WHERE tp.test_id = p_test_id AND r.usuario_id = v_uid
+    );
+END $$;
+
+CREATE OR REPLACE FUNCTION resumen_repaso_global() RETURNS jsonb
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_uid uuid := jwt_usuario_id();
+BEGIN
+    RETURN (
+        SELECT jsonb_build_object(
+            'total_repasos', count(*),
+            'vencidas',      count(*) FILTER (WHERE r.proximo_repaso <= now()),
+            'dominadas',     count(*) FILTER (WHERE r.caja = 7),
+            'siguiente',     min(r.proximo_repaso) FILTER (WHERE r.proximo_repaso > now())
+        )
+        FROM repasos r
+        WHERE r.usuario_id = v_uid
+          AND EXISTS (
+            SELECT 1 FROM test_preguntas tp
+            JOIN intentos i ON i.test_id = tp.test_id
+            WHERE tp.pregunta_id = r.pregunta_id AND i.usuario_id = r.usuario_id
+          )
+    );
+END $$;
+
+CREATE OR REPLACE FUNCTION preguntas_repaso_test(
+    p_test_id   uuid,
+    p_n         int     DEFAULT 20,
+    p_adelantar boolean DEFAULT false
+) RETURNS jsonb
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_uid    uuid := jwt_usuario_id();
+    -- Cota superior fija (en vez de "p_adelantar OR …") para que el plan
+    -- genérico también recorra repasos_proximo_idx por rango.
+    v_hasta  timestamptz := CASE WHEN p_adelantar THEN 'infinity' ELSE now() END;
+    v_titulo text;
+    v_qs     jsonb;
+BEGIN
+    SELECT titulo INTO v_titulo FROM tests WHERE id = p_test_id;
+
+    WITH filtro AS (
+        SELECT r.pregunta_id, r.caja, r.proximo_repaso
+        FROM repasos r
+        WHERE r.usuario_id = v_uid
+          AND r.proximo_repaso <= v_hasta
+          AND EXISTS (
+            SELECT 1 FROM test_preguntas tp
+            WHERE tp.test_id = p_test_id AND tp.pregunta_id = r.pregunta_id
+          )
+        ORDER BY r.proximo_repaso ASC
+        LIMIT GREATEST(p_n, 0)
+    )
+    SELECT COALESCE(jsonb_agg(
+        jsonb_build_object(
+            'id',   p.id,
+            'text', p.enunciado,
+            'options', (
+                SELECT jsonb_agg(jsonb_build_object(
+                    'text',      o.opt->>'texto',
+                    'isCorrect', COALESCE((o.opt->>'correcta')::boolean, o.idx = 1)
+                ) ORDER BY o.idx)
+                FROM jsonb_array_elements(p.opciones) WITH ORDINALITY o(opt, idx)
+            ),
+            'explicacion', p.explicacion,
+            'etiquetas',   p.etiquetas,
+            'caja',        filtro.caja
+        ) ORDER BY filtro.proximo_repaso ASC
+    ), '[]'::jsonb)
+    INTO v_qs
+    FROM filtro JOIN preguntas p ON p.id = filtro.pregunta_id;
+
+    RETURN jsonb_build_object(
+        'quiz',       jsonb_build_object('id', p_test_id, 'title', v_titulo),
+        'questions',  v_qs,
+        'adelantada', p_adelantar
+    );
+END $$;
+
+CREATE OR REPLACE FUNCTION preguntas_repaso_global(
+    p_n         int     DEFAULT 20,
+    p_adelantar boolean DEFAULT false
+) RETURNS jsonb
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_uid   uuid := jwt_usuario_id();
+    v_hasta timestamptz := CASE WHEN p_adelantar THEN 'infinity' ELSE now() END;
+    v_qs    jsonb;
+BEGIN
+    -- Recorre repasos_proximo_idx en orden y para a las p_n filas.
+    WITH filtro AS (
+        SELECT r.pregunta_id, r.caja, r.proximo_repaso
+        FROM repasos r
+        WHERE r.usuario_id = v_uid
+          AND r.proximo_repaso <= v_hasta
+          AND EXISTS (
+            SELECT 1 FROM test_preguntas tp
+            JOIN intentos i ON i.test_id = tp.test_id
+            WHERE tp.pregunta_id = r.pregunta_id AND i.usuario_id = r.usuario_id
+          )
+        ORDER BY r.proximo_repaso ASC
+        LIMIT GREATEST(p_n, 0)
+    )
+    SELECT COALESCE(jsonb_agg(
+        jsonb_build_object(
+            'id',   p.id,
+            'text', p.enunciado,
+            'options', (
+                SELECT jsonb_agg(jsonb_build_object(
+                    'text',      o.opt->>'texto',
+                    'isCorrect', COALESCE((o.opt->>'correcta')::boolean, o.idx = 1)
+                ) ORDER BY o.idx)
+                FROM jsonb_array_elements(p.opciones) WITH ORDINALITY o(opt, idx)
+            ),
+            'explicacion', p.explicacion,
+            'etiquetas',   p.etiquetas,
+            'caja',        filtro.caja
+        ) ORDER BY filtro.proximo_repaso ASC
+    ), '[]'::jsonb)
+    INTO v_qs
+    FROM filtro JOIN preguntas p ON p.id = filtro.pregunta_id;
+
+    RETURN jsonb_build_object('questions', v_qs, 'adelantada', p_adelantar);
+END $$;
+
+-- Todo lo que necesita un tick del notificador en un solo resultado: una
+-- fila por (candidato, suscripción activa), con tipo 'repaso' (medida = nº
+-- de vencidas) o 'inactividad' (medida = días sin entrar). El notificador
+-- la lee con un cursor de servidor, sin ida y vuelta por usuario.
+--
+-- El coste no crece con el total de `repasos`: se parte de los usuarios con
+-- suscripción activa y fuera de cooldown, y de cada uno solo se leen sus
+-- repasos vencidos por rango en repasos_proximo_idx.
+--
+-- p_limite: máximo de usuarios por tipo (NULL = sin límite).
+CREATE OR REPLACE FUNCTION push_candidatos_tick(p_limite int DEFAULT 500) RETURNS TABLE (
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_h   int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_hoy date  := (now() AT TIME ZONE (v_cfg->>'tz'))::date;
+BEGIN
+    RETURN QUERY
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    usuarios_repaso AS (
+        SELECT u.uid
+          FROM con_push u
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = u.uid
+                  AND e.tipo = 'repaso'
+                  AND e.enviado_en > now() - make_interval(hours => v_int)
+         )
+    ),
+    vencidas AS (
+        SELECT u.uid, count(*)::int AS n
+          FROM usuarios_repaso u
+          JOIN repasos r ON r.usuario_id = u.uid
+                        AND r.proximo_repaso <= now()
+         GROUP BY u.uid
+        HAVING count(*) >= v_min
+         LIMIT p_limite
+    ),
+    inactivos AS (
+        SELECT g.usuario_id AS uid,
+               (v_hoy - g.ultimo_dia_activo)::int AS dias
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
+           AND NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = g.usuario_id
+                  AND e.tipo = 'inactividad'
+                  AND e.enviado_en > now() - make_interval(hours => v_cd)
+           )
+         LIMIT p_limite
+    ),
+    candidatos AS (
+        SELECT 'repaso'::text AS tipo, v.uid, v.n AS medida FROM vencidas v
+        UNION ALL
+        SELECT 'inactividad'::text, i.uid, i.dias FROM inactivos i
+    )
+    SELECT c.tipo, c.uid, c.medida, s.endpoint, s.p256dh, s.auth
+      FROM candidatos c
+      JOIN push_suscripciones s ON s.usuario_id = c.uid AND s.activa;
+END $$;
+
+-- Relleno: ultima_en + intervalo del ritmo actual de cada usuario.
+SELECT _recalcular_proximos_repasos(NULL);
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,311 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Outbox persistente y reintentos para el notificador.
+--
+-- Motivación: un fallo transitorio de push solo se registraba en el log y
+-- el usuario se reintentaba en el siguiente tick recalculando todos los
+-- candidatos; si el proceso caía a mitad de tick se perdía la transacción
+-- entera. Además, no se podía levantar más de una réplica.
+--
+--   • Tabla `push_outbox`: una fila por (candidato, suscripción) con
+--     estado, intentos y `proximo_intento`. UNIQUE (usuario_id, tipo,
+--     ventana, endpoint), con ventana = inicio del tramo de cooldown.
+--   • `push_encolar_tick(limite)`: vuelca push_candidatos_tick en la
+--     outbox por conjuntos (ON CONFLICT DO NOTHING).
+--   • `push_reclamar_outbox(n, plazo_s)`: FOR UPDATE SKIP LOCKED y plazo
+--     de reclamación; lo no confirmado vuelve a la cola al vencer.
+--   • `push_outbox_enviado` / `push_outbox_fallo`: resultado por fila;
+--     los errores transitorios esperan base · 2^(intentos-1) s (techo 1 h)
+--     hasta `push_reintentos_max` intentos.
+--   • `push_candidatos_tick` excluye avisos ya pendientes en la outbox y
+--     `push_marcar_error` descarta lo pendiente de la suscripción.
+--   • Config nueva: push_reintentos_max (6), push_reintento_base_s (60).
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Outbox del notificador: una fila por (candidato, suscripción) a enviar.
+-- Cada tick la rellena por conjuntos y los emisores la vacían con FOR UPDATE
+-- SKIP LOCKED, así que varias réplicas se reparten el trabajo y un fallo
+-- transitorio se reintenta con espera exponencial sin recalcular
+-- candidatos. `ventana` es el inicio del tramo de cooldown del tipo: con
+-- el UNIQUE, el mismo aviso no se encola dos veces en un tramo.
+CREATE TABLE IF NOT EXISTS push_outbox (
+    id              bigserial PRIMARY KEY,
+    usuario_id      uuid NOT NULL REFERENCES usuarios(id) ON DELETE CASCADE,
+    tipo            text NOT NULL CHECK (tipo IN ('repaso','inactividad','reto')),
+    ventana         timestamptz NOT NULL,
+    endpoint        text NOT NULL REFERENCES push_suscripciones(endpoint) ON DELETE CASCADE,
+    medida          int  NOT NULL,
+    estado          text NOT NULL DEFAULT 'pendiente'
+                      CHECK (estado IN ('pendiente','enviado','descartado')),
+    intentos        int  NOT NULL DEFAULT 0,
+    proximo_intento timestamptz NOT NULL DEFAULT now(),
+    ultimo_error    text,
+    creado_en       timestamptz NOT NULL DEFAULT now(),
+    actualizado_en  timestamptz NOT NULL DEFAULT now(),
+    UNIQUE (usuario_id, tipo, ventana, endpoint)
+);
+CREATE INDEX IF NOT EXISTS push_outbox_turno_idx
+    ON push_outbox (proximo_intento) WHERE estado = 'pendiente';
+CREATE INDEX IF NOT EXISTS push_outbox_usuario_pendiente_idx
+    ON push_outbox (usuario_id, tipo) WHERE estado = 'pendiente';
+
+ALTER TABLE push_outbox ENABLE ROW LEVEL SECURITY;
+DROP POLICY IF EXISTS push_outbox_admin ON push_outbox;
+CREATE POLICY push_outbox_admin ON push_outbox FOR ALL TO web_user
+    USING (es_admin()) WITH CHECK (es_admin());
+
+INSERT INTO config(clave, valor) VALUES
+    ('push_reintentos_max',             jsonb_build_object('valor', 6,  'descripcion', 'Intentos máximos por envío con error transitorio')),
+    ('push_reintento_base_s',           jsonb_build_object('valor', 60, 'descripcion', 'Espera antes del primer reintento (se dobla en cada uno, hasta 1 h)'))
+ON CONFLICT (clave) DO NOTHING;
+
+-- Config leída por el worker. Cambiar values en 'config' para ajustar la
+-- cadencia y la ventana horaria sin redeployar el servicio.
+CREATE OR REPLACE FUNCTION push_config_worker() RETURNS jsonb
+LANGUAGE sql STABLE AS $$
+    SELECT jsonb_build_object(
+        'ventana_ini',            COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_ventana_ini'), 9),
+        'ventana_fin',            COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_ventana_fin'), 22),
+        'intervalo_repaso_horas', COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_intervalo_repaso_horas'), 5),
+        'inactividad_horas',      COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_inactividad_horas'), 24),
+        'inactividad_cooldown_h', COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_inactividad_cooldown_horas'), 48),
+        'tz',                     COALESCE((SELECT valor->>'valor' FROM config WHERE clave='push_tz'), 'Europe/Madrid'),
+        'min_vencidas',           COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_min_vencidas'), 5),
+        'reintentos_max',         COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_reintentos_max'), 6),
+        'reintento_base_s',       COALESCE((SELECT (valor->>'valor')::int FROM config WHERE clave='push_reintento_base_s'), 60)
+    );
+$$;
+
+-- Todo lo que necesita un tick del notificador en un solo resultado: una
+-- fila por (candidato, suscripción activa), con tipo 'repaso' (medida = nº
+-- de vencidas) o 'inactividad' (medida = días sin entrar). Quedan fuera
+-- los usuarios en cooldown y los que ya tienen ese aviso pendiente en
+-- push_outbox. push_encolar_tick la vuelca en la outbox.
+--
+-- El coste no crece con el total de `repasos`: se parte de los usuarios con
+-- suscripción activa y fuera de cooldown, y de cada uno solo se leen sus
+-- repasos vencidos por rango en repasos_proximo_idx.
+--
+-- p_limite: máximo de usuarios por tipo (NULL = sin límite).
+CREATE OR REPLACE FUNCTION push_candidatos_tick(p_limite int DEFAULT 500) RETURNS TABLE (
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_h   int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_hoy date  := (now() AT TIME ZONE (v_cfg->>'tz'))::date;
+BEGIN
+    RETURN QUERY
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    usuarios_repaso AS (
+        SELECT u.uid
+          FROM con_push u
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = u.uid
+                  AND e.tipo = 'repaso'
+                  AND e.enviado_en > now() - make_interval(hours => v_int)
+         )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND o.estado = 'pendiente'
+         )
+    ),
+    vencidas AS (
+        SELECT u.uid, count(*)::int AS n
+          FROM usuarios_repaso u
+          JOIN repasos r ON r.usuario_id = u.uid
+                        AND r.proximo_repaso <= now()
+         GROUP BY u.uid
+        HAVING count(*) >= v_min
+         LIMIT p_limite
+    ),
+    inactivos AS (
+        SELECT g.usuario_id AS uid,
+               (v_hoy - g.ultimo_dia_activo)::int AS dias
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
+           AND NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = g.usuario_id
+                  AND e.tipo = 'inactividad'
+                  AND e.enviado_en > now() - make_interval(hours => v_cd)
+           )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND o.estado = 'pendiente'
+           )
+         LIMIT p_limite
+    ),
+    candidatos AS (
+        SELECT 'repaso'::text AS tipo, v.uid, v.n AS medida FROM vencidas v
+        UNION ALL
+        SELECT 'inactividad'::text, i.uid, i.dias FROM inactivos i
+    )
+    SELECT c.tipo, c.uid, c.medida, s.endpoint, s.p256dh, s.auth
+      FROM candidatos c
+      JOIN push_suscripciones s ON s.usuario_id = c.uid AND s.activa;
+END $$;
+
+CREATE OR REPLACE FUNCTION push_marcar_error(
+    p_endpoint text, p_motivo text
+) RETURNS void
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE push_suscripciones
+       SET activa       = false,
+           ultimo_error = p_motivo
+     WHERE endpoint = p_endpoint;
+
+    -- Lo pendiente para esa suscripción ya no se podrá entregar.
+    UPDATE push_outbox
+       SET estado         = 'descartado',
+           ultimo_error   = p_motivo,
+           actualizado_en = now()
+     WHERE endpoint = p_endpoint AND estado = 'pendiente';
+END $$;
+
+-- ── Outbox ──────────────────────────────────────────────────────────────
+-- Ciclo de una fila: push_encolar_tick la crea, push_reclamar_outbox la
+-- entrega a un emisor y push_outbox_enviado / push_outbox_fallo registran
+-- el resultado. La entrega es "al menos una vez": si el emisor muere tras
+-- enviar y antes de registrar, la fila se reintenta al vencer el plazo.
+
+-- Vuelca los candidatos del tick en la outbox. La ventana es el inicio del
+-- tramo de cooldown del tipo (date_bin sobre la config), así que repetir el
+-- tick o encolar desde dos réplicas a la vez no duplica avisos.
+CREATE OR REPLACE FUNCTION push_encolar_tick(p_limite int DEFAULT 500) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_n   int;
+BEGIN
+    -- Lo ya resuelto solo se guarda una semana (diagnóstico).
+    DELETE FROM push_outbox
+     WHERE estado <> 'pendiente' AND actualizado_en < now() - interval '7 days';
+
+    INSERT INTO push_outbox(usuario_id, tipo, ventana, endpoint, medida)
+    SELECT t.o_usuario_id,
+           t.o_tipo,
+           date_bin(
+               make_interval(hours => GREATEST(
+                   CASE t.o_tipo WHEN 'repaso' THEN v_int ELSE v_cd END, 1)),
+               now(),
+               timestamptz '2000-01-01 00:00:00+00'),
+           t.o_endpoint,
+           t.o_medida
+      FROM push_candidatos_tick(p_limite) t
+    ON CONFLICT (usuario_id, tipo, ventana, endpoint) DO NOTHING;
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+-- Reclama hasta p_n envíos cuyo turno ha llegado, con FOR UPDATE SKIP
+-- LOCKED para que varias réplicas del notificador se repartan la cola. El
+-- emisor confirma la reclamación enseguida: proximo_intento se aplaza
+-- p_plazo_s segundos y, si el proceso muere a mitad de envío, la fila
+-- vuelve sola a la cola al vencer el plazo.
+CREATE OR REPLACE FUNCTION push_reclamar_outbox(p_n int, p_plazo_s int DEFAULT 300)
+RETURNS TABLE (
+    o_id         bigint,
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql AS $$
+BEGIN
+    RETURN QUERY
+    WITH lote AS (
+        SELECT o.id
+          FROM push_outbox o
+         WHERE o.estado = 'pendiente'
+           AND o.proximo_intento <= now()
+         ORDER BY o.proximo_intento
+         LIMIT p_n
+         FOR UPDATE SKIP LOCKED
+    ),
+    reclamadas AS (
+        UPDATE push_outbox o
+           SET intentos        = o.intentos + 1,
+               proximo_intento = now() + make_interval(secs => p_plazo_s),
+               actualizado_en  = now()
+          FROM lote
+         WHERE o.id = lote.id
+        RETURNING o.id, o.tipo, o.usuario_id, o.medida, o.endpoint
+    )
+    SELECT r.id, r.tipo, r.usuario_id, r.medida, r.endpoint, s.p256dh, s.auth
+      FROM reclamadas r
+      JOIN push_suscripciones s ON s.endpoint = r.endpoint;
+END $$;
+
+CREATE OR REPLACE FUNCTION push_outbox_enviado(p_id bigint, p_payload jsonb) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_uid  uuid;
+    v_tipo text;
+BEGIN
+    UPDATE push_outbox
+       SET estado         = 'enviado',
+           ultimo_error   = NULL,
+           actualizado_en = now()
+     WHERE id = p_id AND estado = 'pendiente'
+    RETURNING usuario_id, tipo INTO v_uid, v_tipo;
+    IF FOUND THEN
+        PERFORM push_marcar_envio(v_uid, v_tipo, p_payload);
+    END IF;
+END $$;
+
+-- Fallo de un envío. 'gone' desactiva la suscripción (y con ella lo que
+-- tuviera pendiente). El resto se reintenta tras base · 2^(intentos-1)
+-- segundos, con techo de 1 h, hasta push_reintentos_max intentos.
+CREATE OR REPLACE FUNCTION push_outbox_fallo(p_id bigint, p_motivo text) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cfg      jsonb := push_config_worker();
+    v_max      int   := (v_cfg->>'reintentos_max')::int;
+    v_base     int   := (v_cfg->>'reintento_base_s')::int;
+    v_endpoint text;
+BEGIN
+    IF p_motivo = 'gone' THEN
+        SELECT endpoint INTO v_endpoint FROM push_outbox WHERE id = p_id;
+        PERFORM push_marcar_error(v_endpoint, p_motivo);
+        RETURN;
+    END IF;
+    UPDATE push_outbox
+       SET estado          = CASE WHEN intentos >= v_max THEN 'descartado' ELSE 'pendiente' END,
+           proximo_intento = now() + make_interval(
+                                 secs => LEAST(v_base * 2 ^ GREATEST(intentos - 1, 0), 3600)),
+           ultimo_error    = p_motivo,
+           actualizado_en  = now()
+     WHERE id = p_id AND estado = 'pendiente';
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,166 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Notificador dirigido por eventos (NOTIF_MODO=eventos).
+--
+-- Motivación: el notificador se reconectaba cada TICK_SECONDS y lo
+-- reevaluaba todo aunque nada hubiera cambiado; un repaso que vencía
+-- esperaba hasta 5 minutos a avisarse.
+--
+--   • `push_proximo_evento()`: próximo instante con trabajo (usuario que
+--     cumple condiciones de repaso o inactividad, reintento de la outbox),
+--     llevado a la ventana horaria.
+--   • Trigger `config_push_aiud`: NOTIFY push 'config' al cambiar claves
+--     push_* o ritmos_repaso.
+--   • `guardar_push_suscripcion` emite NOTIFY push 'suscripcion'.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+CREATE OR REPLACE FUNCTION guardar_push_suscripcion(
+    p_endpoint text,
+    p_p256dh   text,
+    p_auth     text,
+    p_ua       text DEFAULT NULL,
+    p_tz       text DEFAULT 'Europe/Madrid'
+) RETURNS void
+LANGUAGE plpgsql AS $$
+DECLARE v_uid uuid := jwt_usuario_id();
+BEGIN
+    IF v_uid IS NULL THEN RAISE EXCEPTION 'no_autenticado'; END IF;
+    IF length(p_endpoint) = 0 OR length(p_p256dh) = 0 OR length(p_auth) = 0 THEN
+        RAISE EXCEPTION 'suscripcion_invalida';
+    END IF;
+    INSERT INTO push_suscripciones(endpoint, usuario_id, p256dh, auth, ua, tz)
+    VALUES (p_endpoint, v_uid, p_p256dh, p_auth, p_ua, COALESCE(p_tz,'Europe/Madrid'))
+    ON CONFLICT (endpoint) DO UPDATE
+        SET usuario_id   = EXCLUDED.usuario_id,
+            p256dh       = EXCLUDED.p256dh,
+            auth         = EXCLUDED.auth,
+            ua           = EXCLUDED.ua,
+            tz           = EXCLUDED.tz,
+            activa       = true,
+            ultimo_error = NULL;
+    -- El notificador en modo eventos recalcula su próximo despertar.
+    PERFORM pg_notify('push', 'suscripcion');
+END $$;
+
+-- Avisa al notificador en modo eventos (canal 'push') de que ha cambiado
+-- algo de la config que afecta a cuándo o a quién avisar.
+CREATE OR REPLACE FUNCTION notificar_cambio_config_push() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_clave text := CASE WHEN TG_OP = 'DELETE' THEN OLD.clave ELSE NEW.clave END;
+BEGIN
+    IF v_clave LIKE 'push\_%' OR v_clave = 'ritmos_repaso' THEN
+        PERFORM pg_notify('push', 'config');
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS config_push_aiud ON config;
+CREATE TRIGGER config_push_aiud
+    AFTER INSERT OR UPDATE OR DELETE ON config
+    FOR EACH ROW EXECUTE FUNCTION notificar_cambio_config_push();
+
+-- Próximo instante en que habrá trabajo para el notificador, ya llevado a
+-- la ventana horaria; NULL si no hay nada previsto. Lo usa el modo eventos
+-- (NOTIF_MODO=eventos) para dormir justo hasta entonces. Para cada usuario
+-- con push activo toma el momento en que cumple las condiciones de
+-- push_candidatos_tick:
+--   · repaso: vence su min_vencidas-ésimo repaso (una sonda en
+--     repasos_proximo_idx) y ha pasado el cooldown;
+--   · inactividad: empieza el día local en que supera inactividad_horas y
+--     ha pasado el cooldown;
+-- y además el próximo reintento pendiente de push_outbox.
+-- Los repasos que vencen de golpe por un fallo no se avisan por NOTIFY (un
+-- aviso por respuesta serializaría los commits); los recoge el tope de
+-- espera del notificador.
+CREATE OR REPLACE FUNCTION push_proximo_evento() RETURNS timestamptz
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg   jsonb := push_config_worker();
+    v_int   int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min   int   := (v_cfg->>'min_vencidas')::int;
+    v_h     int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd    int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_tz    text  := v_cfg->>'tz';
+    v_ini   int   := (v_cfg->>'ventana_ini')::int;
+    v_fin   int   := (v_cfg->>'ventana_fin')::int;
+    v_t     timestamptz;
+    v_local timestamp;
+BEGIN
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    repaso AS (
+        SELECT GREATEST(
+                   n.proximo,
+                   (SELECT e.enviado_en + make_interval(hours => v_int)
+                      FROM push_envios e
+                     WHERE e.usuario_id = u.uid AND e.tipo = 'repaso')
+               ) AS t
+          FROM con_push u
+          CROSS JOIN LATERAL (
+              SELECT r.proximo_repaso AS proximo
+                FROM repasos r
+               WHERE r.usuario_id = u.uid
+               ORDER BY r.proximo_repaso
+              OFFSET GREATEST(v_min, 1) - 1
+               LIMIT 1
+          ) n
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND o.estado = 'pendiente'
+         )
+    ),
+    inactividad AS (
+        SELECT GREATEST(
+                   (g.ultimo_dia_activo + ceil(v_h / 24.0)::int)::timestamp AT TIME ZONE v_tz,
+                   (SELECT e.enviado_en + make_interval(hours => v_cd)
+                      FROM push_envios e
+                     WHERE e.usuario_id = g.usuario_id AND e.tipo = 'inactividad')
+               ) AS t
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND o.estado = 'pendiente'
+           )
+    ),
+    reintentos AS (
+        SELECT min(o.proximo_intento) AS t
+          FROM push_outbox o
+         WHERE o.estado = 'pendiente'
+    )
+    SELECT min(x.t) INTO v_t
+      FROM (
+          SELECT t FROM repaso
+          UNION ALL SELECT t FROM inactividad
+          UNION ALL SELECT t FROM reintentos
+      ) x;
+
+    IF v_t IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- Fuera de la ventana no se envía: se pasa a su siguiente apertura.
+    v_t := GREATEST(v_t, now());
+    v_local := v_t AT TIME ZONE v_tz;
+    IF extract(hour FROM v_local) < v_ini THEN
+        v_t := (date_trunc('day', v_local) + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    ELSIF extract(hour FROM v_local) >= v_fin THEN
+        v_t := (date_trunc('day', v_local) + interval '1 day' + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    END IF;
+    RETURN v_t;
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
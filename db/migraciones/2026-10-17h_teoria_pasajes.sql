@@ -0,0 +1,176 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Búsqueda semántica en los apuntes de teoría.
+--
+-- Motivación: las preguntas ya tienen embedding (bge-m3, índice HNSW) pero
+-- los markdown/txt de /ficheros no, así que desde una pregunta fallada no
+-- había forma de llegar a la parte de los apuntes que la explica.
+--
+--   • Tabla `teoria_pasajes`: un pasaje por fila (ruta, orden, encabezados,
+--     texto) con `hash_contenido` generado y embedding con índice HNSW.
+--   • `cola_embeddings.entidad` admite 'teoria' (entidad_id = id del
+--     pasaje): los vectoriza el worker de siempre, por lotes.
+--   • `sincronizar_pasajes_teoria(ruta, pasajes)` y
+--     `retirar_pasajes_teoria(rutas)`: las llama teoria.py del servicio de
+--     embeddings. Solo se encolan los pasajes cuyo hash no estaba ya.
+--   • RPC `teoria_para_pregunta(pregunta_id, n)`: los pasajes más
+--     parecidos a la pregunta, uno por fichero, con el filtro por
+--     oposición del listado de teoría.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Pasajes de los apuntes de teoría (markdown/texto de /ficheros) para la
+-- búsqueda semántica. Los trocea y sincroniza teoria.py del servicio de
+-- embeddings; el worker los vectoriza por la cola (entidad 'teoria').
+-- Una fila por (fichero, contenido): si el texto de un pasaje no cambia,
+-- su embedding se conserva aunque cambie de posición o de fichero.
+CREATE TABLE IF NOT EXISTS teoria_pasajes (
+    id              bigserial PRIMARY KEY,
+    ruta            text NOT NULL,               -- '/Tema 1/apuntes.md'
+    orden           int  NOT NULL,               -- posición en el fichero
+    titulo          text NOT NULL DEFAULT '',    -- encabezados que lo contienen
+    texto           text NOT NULL,
+    embedding       vector(1024),                -- BAAI/bge-m3
+    actualizado_en  timestamptz NOT NULL DEFAULT now(),
+    -- Lo que se vectoriza es titulo + texto.
+    hash_contenido  text GENERATED ALWAYS AS
+                    (md5(titulo || E'\n' || texto)) STORED,
+    UNIQUE (ruta, hash_contenido)
+);
+
+CREATE INDEX IF NOT EXISTS teoria_pasajes_emb_idx  ON teoria_pasajes USING hnsw (embedding vector_cosine_ops);
+CREATE INDEX IF NOT EXISTS teoria_pasajes_hash_idx ON teoria_pasajes (hash_contenido);
+
+ALTER TABLE cola_embeddings DROP CONSTRAINT IF EXISTS cola_embeddings_entidad_check;
+ALTER TABLE cola_embeddings
+    ADD CONSTRAINT cola_embeddings_entidad_check
+    CHECK (entidad IN ('pregunta','etiqueta','teoria'));
+
+-- ─── Pasajes de teoría (búsqueda semántica) ───────────────────────────────
+-- Las dos primeras las llama teoria.py (servicio de embeddings) con el
+-- usuario de la base de datos; web_user no tiene permisos sobre
+-- teoria_pasajes, así que no puede usarlas aunque PostgREST las exponga.
+
+-- Sustituye los pasajes de un fichero por los de p_pasajes
+-- ([{orden, titulo, texto}, ...]). Los que ya existían con el mismo
+-- contenido se quedan (solo cambia su orden); los nuevos reutilizan el
+-- embedding de otra fila con el mismo hash si la hay (fichero movido o
+-- copiado) y, si no, se encolan para vectorizar. Devuelve cuántos se
+-- encolaron.
+CREATE OR REPLACE FUNCTION sincronizar_pasajes_teoria(p_ruta text, p_pasajes jsonb)
+RETURNS int
+LANGUAGE plpgsql
+SET aprentix.cola_prioridad = '1' AS $$
+DECLARE
+    v_id bigint;
+    v_n  int := 0;
+BEGIN
+    CREATE TEMP TABLE IF NOT EXISTS _pasajes_nuevos (
+        orden int, titulo text, texto text, hash text
+    ) ON COMMIT DROP;
+    TRUNCATE _pasajes_nuevos;
+    -- Un pasaje repetido dentro del mismo fichero se guarda una vez.
+    INSERT INTO _pasajes_nuevos
+    SELECT DISTINCT ON (h) orden, titulo, texto, h
+      FROM (
+        SELECT x.orden, COALESCE(x.titulo, '') AS titulo, x.texto,
+               md5(COALESCE(x.titulo, '') || E'\n' || x.texto) AS h
+          FROM jsonb_to_recordset(p_pasajes) AS x(orden int, titulo text, texto text)
+         WHERE x.texto IS NOT NULL
+      ) s
+     ORDER BY h, orden;
+
+    DELETE FROM teoria_pasajes t
+     WHERE t.ruta = p_ruta
+       AND NOT EXISTS (SELECT 1 FROM _pasajes_nuevos n WHERE n.hash = t.hash_contenido);
+
+    INSERT INTO teoria_pasajes (ruta, orden, titulo, texto, embedding)
+    SELECT p_ruta, n.orden, n.titulo, n.texto,
+           (SELECT o.embedding FROM teoria_pasajes o
+             WHERE o.hash_contenido = n.hash AND o.embedding IS NOT NULL
+             LIMIT 1)
+      FROM _pasajes_nuevos n
+    ON CONFLICT (ruta, hash_contenido) DO UPDATE
+        SET orden = EXCLUDED.orden
+        WHERE teoria_pasajes.orden IS DISTINCT FROM EXCLUDED.orden;
+
+    FOR v_id IN
+        SELECT t.id FROM teoria_pasajes t WHERE t.ruta = p_ruta AND t.embedding IS NULL
+    LOOP
+        PERFORM _encolar_embedding('teoria', v_id::text);
+        v_n := v_n + 1;
+    END LOOP;
+    RETURN v_n;
+END $$;
+
+-- Borra los pasajes de los ficheros que ya no están (p_rutas = todos los
+-- que sí). Se llama después de sincronizar, para que un fichero movido
+-- herede antes los embeddings de su ruta anterior.
+CREATE OR REPLACE FUNCTION retirar_pasajes_teoria(p_rutas text[]) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE v_n int;
+BEGIN
+    DELETE FROM teoria_pasajes WHERE ruta <> ALL(p_rutas);
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+-- Pasajes de teoría más parecidos a una pregunta (kNN por el índice HNSW
+-- sobre el embedding de la pregunta), el mejor de cada fichero. Para
+-- saltar de una pregunta fallada a los apuntes. Respeta el mismo filtro
+-- por oposición que el listado de la raíz de teoría: las carpetas de
+-- primer nivel asignadas solo a oposiciones ajenas no aparecen.
+CREATE OR REPLACE FUNCTION teoria_para_pregunta(p_pregunta_id uuid, p_n int DEFAULT 3)
+RETURNS TABLE(ruta text, titulo text, texto text, similitud real)
+LANGUAGE plpgsql STABLE SECURITY DEFINER AS $$
+#variable_conflict use_column
+DECLARE
+    v_emb   vector(1024);
+    v_admin boolean := es_admin();
+    v_mias  uuid[];
+    v_n     int := LEAST(GREATEST(COALESCE(p_n, 3), 1), 10);
+BEGIN
+    IF NOT puede_ver_teoria() THEN RAISE EXCEPTION 'permiso_denegado'; END IF;
+    SELECT p.embedding INTO v_emb FROM preguntas p WHERE p.id = p_pregunta_id;
+    IF v_emb IS NULL THEN RETURN; END IF;
+    IF NOT v_admin THEN
+        SELECT COALESCE(array_agg(x::uuid), '{}') INTO v_mias
+          FROM jsonb_array_elements_text(mis_oposiciones_ids()) x;
+    END IF;
+
+    RETURN QUERY
+    WITH cercanos AS (
+        -- Margen para el filtro por oposición y para quedarse con uno por
+        -- fichero. Con v_n <= 10 no pasa de 40, el hnsw.ef_search por
+        -- defecto: el índice no devuelve más candidatos que esos.
+        SELECT t.ruta, t.titulo, t.texto, t.embedding <=> v_emb AS distancia
+          FROM teoria_pasajes t
+         WHERE t.embedding IS NOT NULL
+         ORDER BY t.embedding <=> v_emb
+         LIMIT v_n * 4
+    ), visibles AS (
+        SELECT DISTINCT ON (c.ruta) c.*
+          FROM cercanos c
+         WHERE v_admin
+            OR split_part(c.ruta, '/', 3) = ''   -- fichero suelto en la raíz
+            OR NOT EXISTS (
+                SELECT 1 FROM carpeta_oposiciones co
+                 WHERE co.ruta = '/' || split_part(c.ruta, '/', 2))
+            OR EXISTS (
+                SELECT 1 FROM carpeta_oposiciones co
+                 WHERE co.ruta = '/' || split_part(c.ruta, '/', 2)
+                   AND co.oposicion_id = ANY(v_mias))
+         ORDER BY c.ruta, c.distancia
+    )
+    SELECT v.ruta, v.titulo, v.texto, (1 - v.distancia)::real
+      FROM visibles v
+     ORDER BY v.distancia
+     LIMIT v_n;
+END $$;
+
+GRANT EXECUTE ON FUNCTION teoria_para_pregunta(uuid, int) TO web_user;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
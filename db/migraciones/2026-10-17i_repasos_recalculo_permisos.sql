@@ -0,0 +1,71 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Recalculo de repasos.proximo_repaso: permisos y huecos (sigue a
+-- 2026-10-17e).
+--
+--   • `_recalcular_proximos_repasos` es SECURITY DEFINER y tenía EXECUTE
+--     para PUBLIC: /rpc/_recalcular_proximos_repasos con NULL reescribía
+--     toda la tabla `repasos` incluso sin sesión. Se revoca; solo la
+--     llaman los triggers.
+--   • El trigger de config('ritmos_repaso') cubre también INSERT y
+--     upsert, no solo UPDATE OF valor.
+--   • Nuevo trigger en `preferencias_usuario`: un PATCH directo de
+--     `ritmo_repaso` (web_user tiene UPDATE) también recalcula.
+--     `set_ritmo_repaso` ya no llama a la función: lo hace el trigger.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+REVOKE EXECUTE ON FUNCTION _recalcular_proximos_repasos(uuid) FROM PUBLIC;
+
+CREATE OR REPLACE FUNCTION config_ritmos_repaso_au() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    -- El WHEN de un trigger con INSERT no puede mirar OLD: se compara aquí.
+    IF TG_OP = 'UPDATE' AND NEW.valor IS NOT DISTINCT FROM OLD.valor THEN
+        RETURN NULL;
+    END IF;
+    PERFORM _recalcular_proximos_repasos(NULL);
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS config_ritmos_repaso_au ON config;
+CREATE TRIGGER config_ritmos_repaso_au
+    AFTER INSERT OR UPDATE OF valor ON config
+    FOR EACH ROW WHEN (NEW.clave = 'ritmos_repaso')
+    EXECUTE FUNCTION config_ritmos_repaso_au();
+
+CREATE OR REPLACE FUNCTION preferencias_ritmo_aiud() RETURNS trigger
+LANGUAGE plpgsql SECURITY DEFINER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM _recalcular_proximos_repasos(OLD.usuario_id);
+    ELSIF TG_OP = 'INSERT' OR NEW.ritmo_repaso IS DISTINCT FROM OLD.ritmo_repaso THEN
+        PERFORM _recalcular_proximos_repasos(NEW.usuario_id);
+    END IF;
+    RETURN NULL;
+END $$;
+
+DROP TRIGGER IF EXISTS preferencias_ritmo_aiud ON preferencias_usuario;
+CREATE TRIGGER preferencias_ritmo_aiud
+    AFTER INSERT OR UPDATE OF ritmo_repaso OR DELETE ON preferencias_usuario
+    FOR EACH ROW
+    EXECUTE FUNCTION preferencias_ritmo_aiud();
+
+CREATE OR REPLACE FUNCTION set_ritmo_repaso(p_ritmo text) RETURNS jsonb
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF p_ritmo NOT IN ('intensivo','normal','relajado') THEN
+        RAISE EXCEPTION 'ritmo_invalido';
+    END IF;
+    INSERT INTO preferencias_usuario(usuario_id, ritmo_repaso, actualizado_en)
+    VALUES (jwt_usuario_id(), p_ritmo, now())
+    ON CONFLICT (usuario_id) DO UPDATE
+        SET ritmo_repaso   = EXCLUDED.ritmo_repaso,
+            actualizado_en = now();
+    RETURN jsonb_build_object('ritmo', p_ritmo);
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,64 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Cola de embeddings: permisos y límite del reparto (sigue a 2026-10-17c).
+--
+--   • `_encolar_embedding` es SECURITY DEFINER y tenía EXECUTE para
+--     PUBLIC: web_anon/web_user podían meter en `cola_embeddings` filas
+--     con cualquier entidad e id. Se revoca; la llaman los triggers y
+--     las funciones de sincronización, que corren como dueño.
+--   • `reclamar_cola_embeddings(n)`: las cuotas 60/30/10 (con mínimo 1
+--     por carril) se recortan a lo que queda de n. Antes podía reclamar
+--     3 entidades con n = 1. Los duplicados pendientes de las entidades
+--     reclamadas se siguen añadiendo aparte.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+REVOKE EXECUTE ON FUNCTION _encolar_embedding(text, text) FROM PUBLIC;
+
+CREATE OR REPLACE FUNCTION reclamar_cola_embeddings(p_n int)
+RETURNS TABLE(id bigint, entidad text, entidad_id text)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    v_ids  bigint[] := '{}';
+    v_prio int;
+BEGIN
+    FOREACH v_prio IN ARRAY ARRAY[0, 1, 2] LOOP
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.prioridad = v_prio
+             ORDER BY c.encolado_en
+             LIMIT LEAST(
+                 p_n - cardinality(v_ids),
+                 GREATEST(1, floor(p_n * (ARRAY[0.6, 0.3, 0.1])[v_prio + 1]))::int)
+             FOR UPDATE SKIP LOCKED
+        );
+    END LOOP;
+
+    IF cardinality(v_ids) < p_n THEN
+        v_ids := v_ids || ARRAY(
+            SELECT c.id FROM cola_embeddings c
+             WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+             ORDER BY c.prioridad, c.encolado_en
+             LIMIT p_n - cardinality(v_ids)
+             FOR UPDATE SKIP LOCKED
+        );
+    END IF;
+
+    v_ids := v_ids || ARRAY(
+        SELECT c.id FROM cola_embeddings c
+          JOIN cola_embeddings r
+            ON r.id = ANY(v_ids)
+           AND r.entidad = c.entidad AND r.entidad_id = c.entidad_id
+         WHERE c.procesado_en IS NULL AND c.id <> ALL(v_ids)
+         FOR UPDATE OF c SKIP LOCKED
+    );
+
+    RETURN QUERY
+        SELECT c.id, c.entidad, c.entidad_id FROM cola_embeddings c WHERE c.id = ANY(v_ids);
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,209 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Auto-tagger: el texto se compara plegado también en SQL (sigue a la
+-- migración del clasificador en memoria del worker).
+--
+-- clasificador.py compara palabras clave sin mayúsculas ni tildes, pero
+-- reclasificar_preguntas y clasificar_test (las que usan
+-- reclasificar_todas y reclasificar_todo) seguían con ILIKE, que distingue
+-- tildes. Una misma pregunta recibía etiquetas distintas según quién la
+-- clasificara.
+--
+--   • Extensión `unaccent` y función `plegar(text)`: lower(unaccent(..)),
+--     la versión SQL de clasificador.plegar.
+--   • `reclasificar_preguntas` y `clasificar_test` buscan los patrones
+--     plegados con strpos (sin comodines de LIKE) y descartan patrones
+--     vacíos, como el worker.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+CREATE EXTENSION IF NOT EXISTS unaccent;
+
+-- Minúsculas y sin diacríticos ("Constitución" → "constitucion"). Es la
+-- versión SQL de clasificador.plegar. IMMUTABLE con el diccionario
+-- calificado, para poder usarla en índices si hiciera falta.
+CREATE OR REPLACE FUNCTION plegar(p_texto text) RETURNS text
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$
+    SELECT lower(public.unaccent('public.unaccent'::regdictionary, p_texto));
+$$;
+
+CREATE OR REPLACE FUNCTION reclasificar_preguntas(
+    p_ids         uuid[],
+    umbral        real  DEFAULT 0.55,
+    p_knn_k       int   DEFAULT 5,
+    p_knn_umbral  real  DEFAULT 0.70,
+    p_knn_min     int   DEFAULT 1,
+    p_candidatas  jsonb DEFAULT NULL
+) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_n int;
+BEGIN
+    WITH
+    objetivo AS (
+        SELECT p.id, p.embedding, p.etiquetas,
+               plegar(p.enunciado) AS enunciado,
+               plegar((SELECT t.titulo FROM test_preguntas tp
+                         JOIN tests t ON t.id = tp.test_id
+                        WHERE tp.pregunta_id = p.id
+                        ORDER BY t.creado_en LIMIT 1)) AS test_tit,
+               -- Bloqueadas de la pregunta MÁS las del test asociado.
+               ARRAY(
+                   SELECT b FROM unnest(COALESCE(p.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE b IS NOT NULL
+                   UNION
+                   SELECT b FROM test_preguntas tp
+                     JOIN tests t ON t.id = tp.test_id
+                    CROSS JOIN unnest(COALESCE(t.etiquetas_bloqueadas, '{}'::text[])) b
+                    WHERE tp.pregunta_id = p.id AND b IS NOT NULL
+               ) AS bloqueadas
+          FROM preguntas p
+         WHERE p.id = ANY(p_ids)
+           AND p.enunciado IS NOT NULL
+    ),
+    -- Nombre y palabras clave de cada etiqueta como una lista plana de
+    -- patrones plegados; sirven igual para el enunciado y para el título
+    -- del test. Los vacíos se descartan (casarían con todo).
+    patrones AS (
+        SELECT x.nombre, plegar(x.patron) AS patron
+          FROM (
+            SELECT c.nombre, c.nombre AS patron FROM catalogo_etiquetas c
+            UNION
+            SELECT c.nombre, kw FROM catalogo_etiquetas c, unnest(c.palabras_clave) kw
+          ) x
+         WHERE btrim(COALESCE(x.patron, '')) <> ''
+    ),
+    cat AS (
+        SELECT o.id, c.nombre
+          FROM objetivo o
+         CROSS JOIN jsonb_array_elements_text(p_candidatas -> o.id::text) AS j(nombre)
+          JOIN catalogo_etiquetas c ON c.nombre = j.nombre
+         WHERE p_candidatas IS NOT NULL
+        UNION
+        SELECT o.id, c.nombre
+          FROM objetivo o
+          JOIN catalogo_etiquetas c
+            ON o.embedding IS NOT NULL AND c.embedding IS NOT NULL
+           AND 1 - (c.embedding <=> o.embedding) > umbral
+         WHERE p_candidatas IS NULL
+        UNION
+        SELECT o.id, pt.nombre
+          FROM objetivo o
+          JOIN patrones pt
+            ON strpos(o.enunciado, pt.patron) > 0
+            OR strpos(o.test_tit, pt.patron) > 0
+         WHERE p_candidatas IS NULL
+    ),
+    vecinas AS (
+        SELECT o.id, v.etiquetas, v.etiquetas_manuales, v.etiquetas_bloqueadas
+          FROM objetivo o
+         CROSS JOIN LATERAL (
+            SELECT q.etiquetas, q.etiquetas_manuales, q.etiquetas_bloqueadas,
+                   1 - (q.embedding <=> o.embedding) AS sim
+              FROM preguntas q
+             WHERE q.embedding IS NOT NULL
+               AND q.id <> o.id
+               AND cardinality(q.etiquetas) > 0
+             ORDER BY q.embedding <=> o.embedding
+             LIMIT GREATEST(p_knn_k, 1)
+         ) v
+         WHERE o.embedding IS NOT NULL
+           AND v.sim >= p_knn_umbral
+    ),
+    -- Mismos pesos que en reclasificar_pregunta: 1 por etiqueta, 2 por
+    -- manual, -3 por bloqueada en la vecina.
+    votos_knn AS (
+        SELECT x.id, x.e AS nombre, SUM(x.peso) AS peso
+          FROM (
+            SELECT id, unnest(etiquetas)            AS e,  1 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_manuales)   AS e,  2 AS peso FROM vecinas
+            UNION ALL
+            SELECT id, unnest(etiquetas_bloqueadas) AS e, -3 AS peso FROM vecinas
+          ) x
+         GROUP BY x.id, x.e
+    ),
+    candidatas AS (
+        SELECT id, nombre FROM cat
+        UNION
+        SELECT id, nombre FROM votos_knn WHERE peso >= GREATEST(p_knn_min, 1)
+    ),
+    nuevas AS (
+        SELECT o.id,
+               o.etiquetas AS antes,
+               ARRAY(
+                   SELECT DISTINCT e
+                     FROM unnest(o.etiquetas || ARRAY(
+                              SELECT c.nombre FROM candidatas c WHERE c.id = o.id
+                          )) AS e
+                    WHERE e <> ALL(o.bloqueadas)
+               ) AS despues
+          FROM objetivo o
+    ),
+    upd AS (
+        UPDATE preguntas p
+           SET etiquetas      = n.despues,
+               actualizado_en = now()
+          FROM nuevas n
+         WHERE p.id = n.id
+           AND n.despues IS DISTINCT FROM n.antes
+        RETURNING p.id
+    )
+    SELECT count(*) INTO v_n FROM objetivo;
+    RETURN v_n;
+END $$;
+
+CREATE OR REPLACE FUNCTION clasificar_test(p_test_id uuid) RETURNS text[]
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_titulo      text;
+    v_descr       text;
+    v_bloq_test   text[];
+    v_etiq_nuevas text[];
+BEGIN
+    SELECT plegar(titulo), plegar(descripcion), etiquetas_bloqueadas
+      INTO v_titulo, v_descr, v_bloq_test
+      FROM tests WHERE id = p_test_id;
+    IF v_titulo IS NULL THEN RETURN '{}'::text[]; END IF;
+
+    -- Texto plegado, como en reclasificar_preguntas.
+    SELECT array_agg(DISTINCT c.nombre) INTO v_etiq_nuevas
+      FROM catalogo_etiquetas c
+     WHERE EXISTS (
+            SELECT 1
+              FROM unnest(c.nombre || COALESCE(c.palabras_clave, '{}'::text[])) kw
+             WHERE btrim(COALESCE(kw, '')) <> ''
+               AND (strpos(v_titulo, plegar(kw)) > 0
+                    OR strpos(v_descr, plegar(kw)) > 0)
+        )
+       AND c.nombre <> ALL(COALESCE(v_bloq_test, '{}'::text[]));
+
+    IF v_etiq_nuevas IS NULL OR cardinality(v_etiq_nuevas) = 0 THEN
+        RETURN '{}'::text[];
+    END IF;
+
+    UPDATE tests SET etiquetas = ARRAY(
+        SELECT DISTINCT e FROM unnest(etiquetas || v_etiq_nuevas) AS e
+        WHERE e <> ALL(COALESCE(v_bloq_test, '{}'::text[]))
+    ) WHERE id = p_test_id;
+
+    -- Al propagar a las preguntas del test respetamos las bloqueadas
+    -- individuales de cada pregunta: si una pregunta ha rechazado la
+    -- etiqueta a mano, no se la volvemos a poner por vía transitiva.
+    UPDATE preguntas
+       SET etiquetas = ARRAY(
+               SELECT DISTINCT e
+                 FROM unnest(preguntas.etiquetas || v_etiq_nuevas) AS e
+                WHERE e <> ALL(COALESCE(preguntas.etiquetas_bloqueadas, '{}'::text[]))
+                  AND e <> ALL(COALESCE(v_bloq_test, '{}'::text[]))
+           ),
+           actualizado_en = now()
+     WHERE id IN (SELECT pregunta_id FROM test_preguntas WHERE test_id = p_test_id);
+
+    RETURN v_etiq_nuevas;
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
@@ -0,0 +1,265 @@
+-- ─────────────────────────────────────────────────────────────────────────
+-- Notificador: un aviso descartado ya no hace girar el modo eventos.
+--
+-- Motivación: cuando una fila de push_outbox agotaba push_reintentos_max,
+-- push_outbox_fallo la marcaba 'descartado' sin escribir push_envios. El
+-- usuario seguía cumpliendo las condiciones, así que push_proximo_evento()
+-- devolvía now() y el notificador volvía a despertar cada NOTIF_ESPERA_MIN
+-- para correr un tick completo que push_encolar_tick no encolaba (ON
+-- CONFLICT sobre el mismo tramo). Así hasta que cambiaba el tramo: hasta
+-- 5 h para repaso y 48 h para inactividad.
+--
+--   • `push_ventana(horas)`: inicio del tramo actual, el mismo date_bin
+--     que ya usaba push_encolar_tick.
+--   • `push_candidatos_tick` excluye también a quien ya tiene fila en la
+--     outbox para el tramo actual, en cualquier estado.
+--   • `push_proximo_evento` no devuelve nada anterior al fin del último
+--     tramo con fila en la outbox para ese usuario y tipo.
+--
+-- Comprobación: db/comprobaciones/push_outbox_descartado.sql.
+--
+-- Idempotente.
+-- ─────────────────────────────────────────────────────────────────────────
+BEGIN;
+
+-- Inicio del tramo de cooldown (de p_horas) que contiene now(): es la
+-- `ventana` de push_outbox. Los tramos van alineados a una fecha fija, así
+-- que todas las réplicas calculan el mismo.
+CREATE OR REPLACE FUNCTION push_ventana(p_horas int) RETURNS timestamptz
+LANGUAGE sql STABLE AS $$
+    SELECT date_bin(make_interval(hours => GREATEST(p_horas, 1)), now(),
+                    timestamptz '2000-01-01 00:00:00+00');
+$$;
+
+-- Todo lo que necesita un tick del notificador en un solo resultado: una
+-- fila por (candidato, suscripción activa), con tipo 'repaso' (medida = nº
+-- de vencidas) o 'inactividad' (medida = días sin entrar). Quedan fuera
+-- los usuarios en cooldown, los que ya tienen ese aviso pendiente en
+-- push_outbox y los que ya tienen fila en la outbox para el tramo actual
+-- en cualquier estado: un aviso descartado tras agotar los reintentos no
+-- deja rastro en push_envios y, sin esto, el usuario volvería a salir en
+-- cada tick hasta que cambiara el tramo. push_encolar_tick la vuelca en la
+-- outbox.
+--
+-- El coste no crece con el total de `repasos`: se parte de los usuarios con
+-- suscripción activa y fuera de cooldown, y de cada uno solo se leen sus
+-- repasos vencidos por rango en repasos_proximo_idx.
+--
+-- p_limite: máximo de usuarios por tipo (NULL = sin límite).
+CREATE OR REPLACE FUNCTION push_candidatos_tick(p_limite int DEFAULT 500) RETURNS TABLE (
+    o_tipo       text,
+    o_usuario_id uuid,
+    o_medida     int,
+    o_endpoint   text,
+    o_p256dh     text,
+    o_auth       text
+)
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min int   := (v_cfg->>'min_vencidas')::int;
+    v_h   int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_hoy date  := (now() AT TIME ZONE (v_cfg->>'tz'))::date;
+BEGIN
+    RETURN QUERY
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    usuarios_repaso AS (
+        SELECT u.uid
+          FROM con_push u
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = u.uid
+                  AND e.tipo = 'repaso'
+                  AND e.enviado_en > now() - make_interval(hours => v_int)
+         )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND (o.estado = 'pendiente' OR o.ventana = push_ventana(v_int))
+         )
+    ),
+    vencidas AS (
+        SELECT u.uid, count(*)::int AS n
+          FROM usuarios_repaso u
+          JOIN repasos r ON r.usuario_id = u.uid
+                        AND r.proximo_repaso <= now()
+         GROUP BY u.uid
+        HAVING count(*) >= v_min
+         LIMIT p_limite
+    ),
+    inactivos AS (
+        SELECT g.usuario_id AS uid,
+               (v_hoy - g.ultimo_dia_activo)::int AS dias
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND (v_hoy - g.ultimo_dia_activo) * 24 >= v_h
+           AND NOT EXISTS (
+               SELECT 1 FROM push_envios e
+                WHERE e.usuario_id = g.usuario_id
+                  AND e.tipo = 'inactividad'
+                  AND e.enviado_en > now() - make_interval(hours => v_cd)
+           )
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND (o.estado = 'pendiente' OR o.ventana = push_ventana(v_cd))
+           )
+         LIMIT p_limite
+    ),
+    candidatos AS (
+        SELECT 'repaso'::text AS tipo, v.uid, v.n AS medida FROM vencidas v
+        UNION ALL
+        SELECT 'inactividad'::text, i.uid, i.dias FROM inactivos i
+    )
+    SELECT c.tipo, c.uid, c.medida, s.endpoint, s.p256dh, s.auth
+      FROM candidatos c
+      JOIN push_suscripciones s ON s.usuario_id = c.uid AND s.activa;
+END $$;
+
+-- Próximo instante en que habrá trabajo para el notificador, ya llevado a
+-- la ventana horaria; NULL si no hay nada previsto. Lo usa el modo eventos
+-- (NOTIF_MODO=eventos) para dormir justo hasta entonces. Para cada usuario
+-- con push activo toma el momento en que cumple las condiciones de
+-- push_candidatos_tick:
+--   · repaso: vence su min_vencidas-ésimo repaso (una sonda en
+--     repasos_proximo_idx) y ha pasado el cooldown;
+--   · inactividad: empieza el día local en que supera inactividad_horas y
+--     ha pasado el cooldown;
+-- nunca antes del fin del último tramo con fila en push_outbox (un aviso
+-- descartado no deja push_envios, y sin esto devolvería now() en bucle
+-- hasta que cambiara el tramo), y además el próximo reintento pendiente
+-- de push_outbox.
+-- Los repasos que vencen de golpe por un fallo no se avisan por NOTIFY (un
+-- aviso por respuesta serializaría los commits); los recoge el tope de
+-- espera del notificador.
+CREATE OR REPLACE FUNCTION push_proximo_evento() RETURNS timestamptz
+LANGUAGE plpgsql STABLE AS $$
+DECLARE
+    v_cfg   jsonb := push_config_worker();
+    v_int   int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_min   int   := (v_cfg->>'min_vencidas')::int;
+    v_h     int   := (v_cfg->>'inactividad_horas')::int;
+    v_cd    int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_tz    text  := v_cfg->>'tz';
+    v_ini   int   := (v_cfg->>'ventana_ini')::int;
+    v_fin   int   := (v_cfg->>'ventana_fin')::int;
+    v_t     timestamptz;
+    v_local timestamp;
+BEGIN
+    WITH con_push AS (
+        SELECT DISTINCT s.usuario_id AS uid
+          FROM push_suscripciones s
+         WHERE s.activa
+    ),
+    repaso AS (
+        SELECT GREATEST(
+                   n.proximo,
+                   (SELECT e.enviado_en + make_interval(hours => v_int)
+                      FROM push_envios e
+                     WHERE e.usuario_id = u.uid AND e.tipo = 'repaso'),
+                   (SELECT max(o.ventana) + make_interval(hours => GREATEST(v_int, 1))
+                      FROM push_outbox o
+                     WHERE o.usuario_id = u.uid AND o.tipo = 'repaso')
+               ) AS t
+          FROM con_push u
+          CROSS JOIN LATERAL (
+              SELECT r.proximo_repaso AS proximo
+                FROM repasos r
+               WHERE r.usuario_id = u.uid
+               ORDER BY r.proximo_repaso
+              OFFSET GREATEST(v_min, 1) - 1
+               LIMIT 1
+          ) n
+         WHERE NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = u.uid
+                  AND o.tipo = 'repaso'
+                  AND o.estado = 'pendiente'
+         )
+    ),
+    inactividad AS (
+        SELECT GREATEST(
+                   (g.ultimo_dia_activo + ceil(v_h / 24.0)::int)::timestamp AT TIME ZONE v_tz,
+                   (SELECT e.enviado_en + make_interval(hours => v_cd)
+                      FROM push_envios e
+                     WHERE e.usuario_id = g.usuario_id AND e.tipo = 'inactividad'),
+                   (SELECT max(o.ventana) + make_interval(hours => GREATEST(v_cd, 1))
+                      FROM push_outbox o
+                     WHERE o.usuario_id = g.usuario_id AND o.tipo = 'inactividad')
+               ) AS t
+          FROM usuario_gamificacion g
+          JOIN con_push u ON u.uid = g.usuario_id
+         WHERE g.ultimo_dia_activo IS NOT NULL
+           AND NOT EXISTS (
+               SELECT 1 FROM push_outbox o
+                WHERE o.usuario_id = g.usuario_id
+                  AND o.tipo = 'inactividad'
+                  AND o.estado = 'pendiente'
+           )
+    ),
+    reintentos AS (
+        SELECT min(o.proximo_intento) AS t
+          FROM push_outbox o
+         WHERE o.estado = 'pendiente'
+    )
+    SELECT min(x.t) INTO v_t
+      FROM (
+          SELECT t FROM repaso
+          UNION ALL SELECT t FROM inactividad
+          UNION ALL SELECT t FROM reintentos
+      ) x;
+
+    IF v_t IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- Fuera de la ventana no se envía: se pasa a su siguiente apertura.
+    v_t := GREATEST(v_t, now());
+    v_local := v_t AT TIME ZONE v_tz;
+    IF extract(hour FROM v_local) < v_ini THEN
+        v_t := (date_trunc('day', v_local) + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    ELSIF extract(hour FROM v_local) >= v_fin THEN
+        v_t := (date_trunc('day', v_local) + interval '1 day' + make_interval(hours => v_ini)) AT TIME ZONE v_tz;
+    END IF;
+    RETURN v_t;
+END $$;
+
+-- Vuelca los candidatos del tick en la outbox. La ventana es el inicio del
+-- tramo de cooldown del tipo (push_ventana sobre la config), así que
+-- repetir el tick o encolar desde dos réplicas a la vez no duplica avisos.
+CREATE OR REPLACE FUNCTION push_encolar_tick(p_limite int DEFAULT 500) RETURNS int
+LANGUAGE plpgsql AS $$
+DECLARE
+    v_cfg jsonb := push_config_worker();
+    v_int int   := (v_cfg->>'intervalo_repaso_horas')::int;
+    v_cd  int   := (v_cfg->>'inactividad_cooldown_h')::int;
+    v_n   int;
+BEGIN
+    -- Lo ya resuelto solo se guarda una semana (diagnóstico).
+    DELETE FROM push_outbox
+     WHERE estado <> 'pendiente' AND actualizado_en < now() - interval '7 days';
+
+    INSERT INTO push_outbox(usuario_id, tipo, ventana, endpoint, medida)
+    SELECT t.o_usuario_id,
+           t.o_tipo,
+           push_ventana(CASE t.o_tipo WHEN 'repaso' THEN v_int ELSE v_cd END),
+           t.o_endpoint,
+           t.o_medida
+      FROM push_candidatos_tick(p_limite) t
+    ON CONFLICT (usuario_id, tipo, ventana, endpoint) DO NOTHING;
+    GET DIAGNOSTICS v_n = ROW_COUNT;
+    RETURN v_n;
+END $$;
+
+COMMIT;
+
+NOTIFY pgrst, 'reload schema';
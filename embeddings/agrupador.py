@@ -0,0 +1,125 @@
+"""Agrupador de peticiones HTTP en lotes dinámicos (micro-batching).
+
+Cada petición a /vectorizar o /vectorizar_consulta suele traer uno o dos
+textos. Codificarlos por separado obliga a pagar una pasada completa de
+bge-m3 por petición, y como todas compiten por el GIL acaban serializadas
+de todas formas. El agrupador mete las peticiones concurrentes en una cola,
+espera unos milisegundos a que lleguen más y hace UNA sola llamada a
+`encode` con todos los textos; después reparte los vectores a cada
+petición.
+
+Un único hilo ejecuta los lotes, así que nunca hay dos `encode` a la vez
+desde la API. Solo se agrupan peticiones que comparten función (pasajes
+con pasajes, consultas con consultas); el resto espera a la siguiente
+vuelta en su orden de llegada.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable
+
+log = logging.getLogger("embeddings.agrupador")
+
+# Máximo de textos por llamada a encode y ventana de espera para llenar el
+# lote. Con 5 ms la latencia añadida es despreciable frente a una pasada
+# del modelo (decenas de ms en CPU) y bajo carga el lote se llena antes.
+MAX_TEXTOS = int(os.getenv("EMB_HTTP_LOTE", "64"))
+MAX_ESPERA_MS = float(os.getenv("EMB_HTTP_ESPERA_MS", "5"))
+
+Vectorizador = Callable[[list[str]], list[list[float]]]
+
+
+class _Peticion:
+    __slots__ = ("funcion", "textos", "futuro")
+
+    def __init__(self, funcion: Vectorizador, textos: list[str]) -> None:
+        self.funcion = funcion
+        self.textos = textos
+        self.futuro: Future = Future()
+
+
+class Agrupador:
+    def __init__(self, max_textos: int = MAX_TEXTOS, max_espera_ms: float = MAX_ESPERA_MS) -> None:
+        self.max_textos = max(1, max_textos)
+        self.max_espera = max(0.0, max_espera_ms) / 1000.0
+        self._cond = threading.Condition()
+        self._pendientes: deque[_Peticion] = deque()
+        self._hilo: threading.Thread | None = None
+
+    def vectorizar(self, funcion: Vectorizador, textos: list[str]) -> list[list[float]]:
+        """Encola `textos` y bloquea hasta tener sus vectores.
+
+        Pensado para llamarse desde los endpoints síncronos de FastAPI (que
+        corren en el threadpool), así que bloquear aquí no para el bucle de
+        eventos.
+        """
+        if not textos:
+            return []
+        p = _Peticion(funcion, list(textos))
+        with self._cond:
+            if self._hilo is None:
+                self._hilo = threading.Thread(
+                    target=self._bucle, daemon=True, name="emb-agrupador",
+                )
+                self._hilo.start()
+            self._pendientes.append(p)
+            self._cond.notify()
+        return p.futuro.result()
+
+    # ── Hilo de lotes ──────────────────────────────────────────────────────
+
+    def _textos_en_cola(self, funcion: Vectorizador) -> int:
+        return sum(len(p.textos) for p in self._pendientes if p.funcion is funcion)
+
+    def _extraer_lote(self, funcion: Vectorizador) -> list[_Peticion]:
+        """Saca de la cola las peticiones de `funcion` que quepan en el lote.
+
+        La primera se toma siempre aunque sola supere `max_textos` (no se
+        trocea una petición); las de otra función se quedan en su sitio.
+        """
+        lote: list[_Peticion] = []
+        restantes: deque[_Peticion] = deque()
+        n = 0
+        while self._pendientes:
+            p = self._pendientes.popleft()
+            if p.funcion is funcion and (not lote or n + len(p.textos) <= self.max_textos):
+                lote.append(p)
+                n += len(p.textos)
+            else:
+                restantes.append(p)
+        self._pendientes = restantes
+        return lote
+
+    def _bucle(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pendientes:
+                    self._cond.wait()
+                funcion = self._pendientes[0].funcion
+                limite = time.monotonic() + self.max_espera
+                while self._textos_en_cola(funcion) < self.max_textos:
+                    restante = limite - time.monotonic()
+                    if restante <= 0:
+                        break
+                    self._cond.wait(restante)
+                lote = self._extraer_lote(funcion)
+            self._ejecutar(funcion, lote)
+
+    def _ejecutar(self, funcion: Vectorizador, lote: list[_Peticion]) -> None:
+        textos = [t for p in lote for t in p.textos]
+        try:
+            vectores = funcion(textos)
+        except Exception as e:  # noqa: BLE001 — el error se propaga a cada petición
+            log.exception("fallo vectorizando lote de %d textos", len(textos))
+            for p in lote:
+                p.futuro.set_exception(e)
+            return
+        i = 0
+        for p in lote:
+            p.futuro.set_result(vectores[i:i + len(p.textos)])
+            i += len(p.textos)
@@ -0,0 +1,198 @@
+"""Caché persistente de embeddings direccionada por contenido.
+
+Clave = sha256(espacio + texto normalizado), donde `espacio` identifica el
+modelo que produjo el vector. Los vectores viven en un fichero mapeado en
+memoria (numpy.memmap) de `capacidad × dimensiones`; el índice clave → hueco
+y la marca de último uso van en un SQLite al lado. Al llenarse, los huecos
+menos usados recientemente (LRU) se reutilizan.
+
+Varios procesos (los del pool y la API) comparten el directorio. Lecturas
+y escrituras van dentro de BEGIN IMMEDIATE, así que nadie copia un hueco
+mientras otro lo está reescribiendo. Además, junto a cada hueco se guarda
+un resumen de su clave (`_firmas`) y se comprueba al leer: si no cuadra
+es un fallo, nunca el vector de otro texto.
+
+Con esto, re-encolar todas las preguntas (`encolar_revectorizado_total`) o
+editar una pregunta sin cambiar el texto que se vectoriza no vuelve a
+pasar por el modelo, ni siquiera tras reiniciar el contenedor.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+
+log = logging.getLogger("embeddings.cache")
+
+
+# Bytes de la clave que se guardan junto a cada hueco.
+_FIRMA = 8
+
+
+def normalizar(texto: str) -> str:
+    """Forma canónica del texto para la clave: NFC y sin espacios en los
+    extremos. No se toca nada más para no juntar textos que el modelo
+    vectorizaría distinto."""
+    return unicodedata.normalize("NFC", texto).strip()
+
+
+class CacheVectores:
+    def __init__(
+        self,
+        directorio: Path,
+        espacio: str,
+        dimensiones: int,
+        capacidad: int,
+        dtype: str = "float16",
+    ) -> None:
+        self.espacio = espacio
+        self.dimensiones = dimensiones
+        self.capacidad = capacidad
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+
+        directorio.mkdir(parents=True, exist_ok=True)
+        ruta_vec = directorio / f"vectores_{self.dtype.name}_{dimensiones}.bin"
+        ruta_idx = directorio / f"indice_{self.dtype.name}_{dimensiones}.sqlite"
+        ruta_firmas = directorio / f"firmas_{self.dtype.name}_{dimensiones}.bin"
+
+        self._db = sqlite3.connect(str(ruta_idx), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS meta (clave TEXT PRIMARY KEY, valor TEXT);
+            CREATE TABLE IF NOT EXISTS entradas (
+                clave BLOB PRIMARY KEY,
+                hueco INTEGER NOT NULL UNIQUE,
+                usado REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entradas_usado ON entradas (usado);
+            """
+        )
+        fila = self._db.execute("SELECT valor FROM meta WHERE clave = 'capacidad'").fetchone()
+        if (fila is None or int(fila[0]) != capacidad
+                or not ruta_vec.exists() or not ruta_firmas.exists()):
+            # Capacidad distinta o fichero perdido: los huecos ya no
+            # cuadran, se empieza de cero.
+            if fila is not None:
+                log.info("caché de vectores regenerada (capacidad %s → %d)", fila[0], capacidad)
+            self._db.execute("DELETE FROM entradas")
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (clave, valor) VALUES ('capacidad', ?)",
+                (str(capacidad),),
+            )
+            self._db.commit()
+            with open(ruta_vec, "wb") as f:
+                f.truncate(capacidad * dimensiones * self.dtype.itemsize)
+            with open(ruta_firmas, "wb") as f:
+                f.truncate(capacidad * _FIRMA)
+
+        self._vec = np.memmap(ruta_vec, dtype=self.dtype, mode="r+", shape=(capacidad, dimensiones))
+        self._firmas = np.memmap(ruta_firmas, dtype=np.uint8, mode="r+", shape=(capacidad, _FIRMA))
+
+    def _clave(self, texto: str) -> bytes:
+        return hashlib.sha256(f"{self.espacio}\0{normalizar(texto)}".encode("utf-8")).digest()
+
+    def buscar(self, textos: list[str]) -> tuple[list[list[float] | None], list[bytes]]:
+        """Devuelve (vectores, claves); `None` en las posiciones sin acierto."""
+        claves = [self._clave(t) for t in textos]
+        salida: list[list[float] | None] = [None] * len(textos)
+        with self._lock:
+            # IMMEDIATE y no una lectura normal: con WAL un lector no frena
+            # al escritor, y otro proceso podría desalojar y reescribir un
+            # hueco entre nuestro SELECT y la copia del vector.
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                huecos: dict[bytes, int] = {}
+                unicas = list(dict.fromkeys(claves))
+                for i in range(0, len(unicas), 500):
+                    trozo = unicas[i:i + 500]
+                    marcas = ",".join("?" * len(trozo))
+                    huecos.update(self._db.execute(
+                        f"SELECT clave, hueco FROM entradas WHERE clave IN ({marcas})", trozo,
+                    ).fetchall())
+                # Una entrada cuyo hueco no es suyo se borra: así el vector
+                # recalculado se puede volver a guardar.
+                erroneas = [c for c, h in huecos.items() if self._firmas[h].tobytes() != c[:_FIRMA]]
+                if erroneas:
+                    log.warning("caché de vectores: %d huecos no son de su clave; se descartan", len(erroneas))
+                    self._db.executemany("DELETE FROM entradas WHERE clave = ?", [(c,) for c in erroneas])
+                    for c in erroneas:
+                        del huecos[c]
+                for i, c in enumerate(claves):
+                    h = huecos.get(c)
+                    if h is not None:
+                        salida[i] = self._vec[h].astype(np.float32).tolist()
+                if huecos:
+                    ahora = time.time()
+                    self._db.executemany(
+                        "UPDATE entradas SET usado = ? WHERE clave = ?",
+                        [(ahora, c) for c in huecos],
+                    )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+        return salida, claves
+
+    def guardar(self, claves: list[bytes], vectores: list[list[float]]) -> None:
+        nuevos = dict(zip(claves, vectores))
+        if not nuevos:
+            return
+        with self._lock:
+            # BEGIN IMMEDIATE serializa a los escritores de otros procesos
+            # que compartan el mismo directorio de caché.
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._guardar(nuevos)
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+
+    def _guardar(self, nuevos: dict[bytes, list[float]]) -> None:
+        existentes: set[bytes] = set()
+        candidatas = list(nuevos)
+        for i in range(0, len(candidatas), 500):
+            trozo = candidatas[i:i + 500]
+            marcas = ",".join("?" * len(trozo))
+            existentes.update(c for (c,) in self._db.execute(
+                f"SELECT clave FROM entradas WHERE clave IN ({marcas})", trozo,
+            ))
+        pares = [(c, v) for c, v in nuevos.items() if c not in existentes]
+        pares = pares[-self.capacidad:]
+        if not pares:
+            return
+
+        # Los huecos se asignan en orden; los que deja libres una entrada
+        # descartada en `buscar` no se reaprovechan hasta el desalojo LRU.
+        (siguiente,) = self._db.execute("SELECT coalesce(max(hueco) + 1, 0) FROM entradas").fetchone()
+        libres = max(0, min(len(pares), self.capacidad - siguiente))
+        huecos = list(range(siguiente, siguiente + libres))
+        faltan = len(pares) - libres
+        if faltan:
+            # Desalojo LRU: se reutilizan los huecos menos usados.
+            viejas = self._db.execute(
+                "SELECT clave, hueco FROM entradas ORDER BY usado LIMIT ?", (faltan,),
+            ).fetchall()
+            self._db.executemany("DELETE FROM entradas WHERE clave = ?", [(c,) for c, _ in viejas])
+            huecos += [h for _, h in viejas]
+
+        self._vec[huecos] = np.asarray([v for _, v in pares], dtype=self.dtype)
+        self._firmas[huecos] = np.frombuffer(
+            b"".join(c[:_FIRMA] for c, _ in pares), dtype=np.uint8,
+        ).reshape(-1, _FIRMA)
+        self._vec.flush()
+        self._firmas.flush()
+        ahora = time.time()
+        self._db.executemany(
+            "INSERT INTO entradas (clave, hueco, usado) VALUES (?, ?, ?)",
+            [(c, h, ahora) for (c, _), h in zip(pares, huecos)],
+        )
@@ -0,0 +1,137 @@
+"""Clasificador en memoria con el catálogo de etiquetas.
+
+Calcula en Python las fuentes (a)–(d) del auto-tagger de
+`reclasificar_preguntas` para un lote entero de preguntas:
+
+  - palabras clave y nombre de cada etiqueta dentro del enunciado o del
+    título del test, con UN autómata Aho-Corasick sobre todos los patrones
+    (una pasada por texto en vez de un ILIKE por palabra clave);
+  - similitud coseno del embedding de la pregunta contra la matriz de
+    embeddings del catálogo (un producto de matrices por lote).
+
+La comparación de texto ignora mayúsculas y tildes ("Constitución" casa
+con "constitucion"). El kNN contra otras preguntas sigue en SQL, porque
+necesita el índice HNSW de `preguntas`.
+
+El catálogo se carga completo la primera vez y después se refresca por
+etiqueta: el trigger `catalogo_etiquetas_clasif_aiud` emite
+NOTIFY embeddings 'catalogo:<nombre>' y el worker llama a `invalidar`.
+"""
+from __future__ import annotations
+
+import logging
+import unicodedata
+
+import ahocorasick
+import numpy as np
+import psycopg
+
+log = logging.getLogger("embeddings.clasificador")
+
+# Mismo umbral por defecto que reclasificar_preguntas.
+UMBRAL = 0.55
+
+
+def plegar(texto: str) -> str:
+    """Minúsculas y sin diacríticos, para comparar texto."""
+    descompuesto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).casefold()
+
+
+class Clasificador:
+    def __init__(self, umbral: float = UMBRAL) -> None:
+        self.umbral = umbral
+        # nombre → (patrones plegados, embedding normalizado o None)
+        self._etiquetas: dict[str, tuple[list[str], np.ndarray | None]] = {}
+        self._cargado = False
+        self._pendientes: set[str] = set()
+        self._automata: ahocorasick.Automaton | None = None
+        self._nombres_vec: list[str] = []
+        self._matriz = np.zeros((0, 0), dtype=np.float32)
+
+    def invalidar(self, nombre: str | None = None) -> None:
+        """Marca una etiqueta (o todo el catálogo, sin nombre) para recargar."""
+        if nombre is None:
+            self._cargado = False
+            self._pendientes.clear()
+        else:
+            self._pendientes.add(nombre)
+
+    # ── Carga ──────────────────────────────────────────────────────────────
+
+    def _refrescar(self, cur: psycopg.Cursor) -> None:
+        if self._cargado and not self._pendientes:
+            return
+        consulta = "SELECT nombre, palabras_clave, embedding FROM catalogo_etiquetas"
+        if self._cargado:
+            nombres = list(self._pendientes)
+            cur.execute(consulta + " WHERE nombre = ANY(%s)", (nombres,))
+            for nombre in nombres:
+                self._etiquetas.pop(nombre, None)
+        else:
+            cur.execute(consulta)
+            self._etiquetas.clear()
+        for nombre, palabras, emb in cur.fetchall():
+            patrones = [plegar(p) for p in [nombre, *(palabras or [])] if p and p.strip()]
+            vec = None
+            if emb is not None:
+                vec = np.asarray(emb, dtype=np.float32)
+                vec /= max(float(np.linalg.norm(vec)), 1e-12)
+            self._etiquetas[nombre] = (patrones, vec)
+        self._construir()
+        log.info(
+            "catálogo %s: %d etiquetas",
+            "recargado" if not self._cargado else f"refrescado ({len(self._pendientes)})",
+            len(self._etiquetas),
+        )
+        self._cargado = True
+        self._pendientes.clear()
+
+    def _construir(self) -> None:
+        automata = ahocorasick.Automaton()
+        por_patron: dict[str, set[str]] = {}
+        for nombre, (patrones, _) in self._etiquetas.items():
+            for p in patrones:
+                por_patron.setdefault(p, set()).add(nombre)
+        for p, nombres in por_patron.items():
+            automata.add_word(p, frozenset(nombres))
+        self._automata = None
+        if por_patron:
+            automata.make_automaton()
+            self._automata = automata
+
+        self._nombres_vec = [n for n, (_, v) in self._etiquetas.items() if v is not None]
+        if self._nombres_vec:
+            self._matriz = np.stack([self._etiquetas[n][1] for n in self._nombres_vec])
+        else:
+            self._matriz = np.zeros((0, 0), dtype=np.float32)
+
+    # ── Consulta ───────────────────────────────────────────────────────────
+
+    def _por_texto(self, texto: str | None) -> set[str]:
+        if not texto or self._automata is None:
+            return set()
+        encontradas: set[str] = set()
+        for _, nombres in self._automata.iter(plegar(texto)):
+            encontradas |= nombres
+        return encontradas
+
+    def candidatas(
+        self,
+        cur: psycopg.Cursor,
+        enunciados: list[str],
+        titulos: list[str | None],
+        vectores: list[list[float] | None],
+    ) -> list[list[str]]:
+        """Etiquetas candidatas de cada pregunta del lote (mismo orden)."""
+        self._refrescar(cur)
+        salida = [self._por_texto(e) | self._por_texto(t) for e, t in zip(enunciados, titulos)]
+
+        con_vector = [i for i, v in enumerate(vectores) if v is not None]
+        if con_vector and self._nombres_vec:
+            q = np.asarray([vectores[i] for i in con_vector], dtype=np.float32)
+            q /= np.maximum(np.linalg.norm(q, axis=1, keepdims=True), 1e-12)
+            sims = q @ self._matriz.T
+            for fila, i in enumerate(con_vector):
+                salida[i].update(self._nombres_vec[j] for j in np.flatnonzero(sims[fila] > self.umbral))
+        return [sorted(s) for s in salida]
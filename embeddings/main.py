@@ -1,18 +1,25 @@
 """API HTTP del servicio de embeddings + arranque del worker en segundo plano."""
 import logging
+import os
 import threading
 
 import uvicorn
 from fastapi import FastAPI
 from pydantic import BaseModel
 
+import metricas
+import teoria
+from agrupador import Agrupador
 from modelo import vectorizar_pasajes, vectorizar_consultas
-from worker import loop as worker_loop
+from worker import DSN, loop as worker_loop
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 
 app = FastAPI(title="aprentix-embeddings", version="0.2.0")
 
+# Las peticiones concurrentes se codifican juntas en un solo encode.
+agrupador = Agrupador()
+
 
 class Peticion(BaseModel):
     textos: list[str]
@@ -26,15 +33,23 @@ def salud() -> dict[str, str]:
 @app.post("/vectorizar")
 def endpoint_vectorizar(p: Peticion) -> dict[str, list[list[float]]]:
     """Lado documento (passage). Para indexar enunciados y etiquetas."""
-    return {"vectores": vectorizar_pasajes(p.textos)}
+    return {"vectores": agrupador.vectorizar(vectorizar_pasajes, p.textos)}
 
 
 @app.post("/vectorizar_consulta")
 def endpoint_vectorizar_consulta(p: Peticion) -> dict[str, list[list[float]]]:
     """Lado búsqueda (query). Para vectorizar la cadena que escribe el usuario."""
-    return {"vectores": vectorizar_consultas(p.textos)}
+    return {"vectores": agrupador.vectorizar(vectorizar_consultas, p.textos)}
 
 
 if __name__ == "__main__":
-    threading.Thread(target=worker_loop, daemon=True, name="emb-worker").start()
+    # Con el pool de workers (pool.py) en su propio contenedor, la API no
+    # necesita procesar la cola: EMB_WORKER_EN_API=0.
+    if os.getenv("EMB_WORKER_EN_API", "1") == "1":
+        threading.Thread(target=worker_loop, daemon=True, name="emb-worker").start()
+        teoria.iniciar()
+        # La profundidad de la cola solo interesa donde se procesa.
+        metricas.iniciar(DSN)
+    else:
+        metricas.iniciar()
     uvicorn.run(app, host="0.0.0.0", port=8001)
@@ -0,0 +1,108 @@
+"""Métricas Prometheus del servicio de embeddings.
+
+Opcionales: con EMB_METRICAS_PUERTO > 0 el proceso expone /metrics en ese
+puerto (`iniciar`). Sin él, las métricas se siguen contando en memoria
+pero nadie las sirve.
+
+  emb_vectorizar_segundos     latencia de cada llamada a `_vectorizar`
+  emb_vectorizar_textos       textos por llamada (tamaño de lote)
+  emb_textos_total{origen}    textos servidos desde 'cache' o 'modelo'
+  emb_lote_segundos{via}      `_procesar_lote` de principio a fin
+  emb_lote_filas{via}         filas de cola por lote ('dirigida' o 'cola')
+  emb_errores_total           lotes del worker que acabaron en excepción
+  emb_cola_pendientes{prioridad}           filas sin procesar por carril
+  emb_cola_antiguedad_segundos{prioridad}  edad de la más antigua
+
+Las dos últimas se consultan en Postgres en cada scrape (un SELECT
+agregado sobre el índice parcial de pendientes).
+
+El pool (pool.py) corre un worker por proceso: antes de lanzarlos apunta
+PROMETHEUS_MULTIPROC_DIR a un directorio vacío, cada hijo escribe ahí sus
+valores y el padre los agrega al servir /metrics.
+"""
+from __future__ import annotations
+
+import logging
+import os
+
+from prometheus_client import (
+    REGISTRY, CollectorRegistry, Counter, Histogram, multiprocess, start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily
+
+log = logging.getLogger("embeddings.metricas")
+
+PUERTO = int(os.getenv("EMB_METRICAS_PUERTO", "0"))
+
+_LATENCIAS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+_TAMANOS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+VECTORIZAR_SEGUNDOS = Histogram(
+    "emb_vectorizar_segundos", "Latencia de _vectorizar por llamada", buckets=_LATENCIAS,
+)
+VECTORIZAR_TEXTOS = Histogram(
+    "emb_vectorizar_textos", "Textos por llamada a _vectorizar", buckets=_TAMANOS,
+)
+TEXTOS = Counter("emb_textos_total", "Textos vectorizados", ["origen"])
+LOTE_SEGUNDOS = Histogram(
+    "emb_lote_segundos", "Duración de _procesar_lote", ["via"], buckets=_LATENCIAS,
+)
+LOTE_FILAS = Histogram(
+    "emb_lote_filas", "Filas de cola por lote del worker", ["via"], buckets=_TAMANOS,
+)
+ERRORES = Counter("emb_errores_total", "Lotes del worker terminados en error")
+
+
+class ColaEmbeddings:
+    """Collector que lee la profundidad de cola_embeddings en cada scrape."""
+
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+
+    def describe(self):
+        # Sin describe, registrar el collector haría ya una consulta.
+        return []
+
+    def collect(self):
+        import psycopg
+
+        pendientes = GaugeMetricFamily(
+            "emb_cola_pendientes", "Filas pendientes en cola_embeddings", labels=["prioridad"],
+        )
+        antiguedad = GaugeMetricFamily(
+            "emb_cola_antiguedad_segundos", "Edad de la fila pendiente más antigua",
+            labels=["prioridad"],
+        )
+        try:
+            with psycopg.connect(self.dsn, connect_timeout=5) as conn:
+                filas = conn.execute(
+                    "SELECT prioridad, count(*), "
+                    "       EXTRACT(epoch FROM now() - min(encolado_en))::float8 "
+                    "FROM cola_embeddings WHERE procesado_en IS NULL GROUP BY prioridad"
+                ).fetchall()
+        except Exception as e:  # noqa: BLE001 — un scrape fallido no debe tumbar nada
+            log.warning("no se pudo leer cola_embeddings para métricas: %s", e)
+            return
+        for prioridad, n, edad in filas:
+            pendientes.add_metric([str(prioridad)], n)
+            antiguedad.add_metric([str(prioridad)], edad or 0.0)
+        yield pendientes
+        yield antiguedad
+
+
+def iniciar(dsn: str | None = None, multiproceso: bool = False) -> None:
+    """Sirve /metrics en EMB_METRICAS_PUERTO (no hace nada si es 0).
+
+    Con `multiproceso`, agrega lo que escriben los procesos hijos en
+    PROMETHEUS_MULTIPROC_DIR en vez de las métricas de este proceso.
+    """
+    if PUERTO <= 0:
+        return
+    registro = REGISTRY
+    if multiproceso:
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    if dsn:
+        registro.register(ColaEmbeddings(dsn))
+    start_http_server(PUERTO, registry=registro)
+    log.info("métricas en :%d/metrics", PUERTO)
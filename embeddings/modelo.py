@@ -8,29 +8,193 @@ palabras clave manuales) y soporta hasta 8192 tokens por entrada.
 A diferencia de la familia e5, bge-m3 NO requiere prefijos
 "query:"/"passage:": el mismo embedding sirve para indexar y para
 buscar.
+
+Backends (EMB_BACKEND):
+  - torch      FP32 con PyTorch (por defecto).
+  - onnx       el mismo modelo FP32 exportado a ONNX Runtime.
+  - onnx-int8  ONNX Runtime con cuantización dinámica INT8; aprox. la mitad
+               de RAM y varias veces más rápido en CPU. La deriva frente a
+               FP32 se mide con `python paridad.py`.
 """
+import os
 from functools import lru_cache
-from sentence_transformers import SentenceTransformer
+from pathlib import Path
+
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+import metricas
+from cache_vectores import CacheVectores
 
 MODELO_NOMBRE = "BAAI/bge-m3"
 DIMENSIONES = 1024
 
+BACKENDS = ("torch", "onnx", "onnx-int8")
+BACKEND = os.getenv("EMB_BACKEND", "torch")
+# El modelo cuantizado se genera una vez y se guarda en el volumen /cache.
+# EMB_ONNX_CUANT elige la configuración de optimum según la CPU del host:
+# arm64, avx2, avx512 o avx512_vnni.
+ONNX_DIR = Path(os.getenv("EMB_ONNX_DIR", "/cache/onnx"))
+ONNX_CUANT = os.getenv("EMB_ONNX_CUANT", "avx512_vnni")
+# Hilos intra-op de ONNX Runtime (0 = los de ORT, uno por núcleo). pool.py
+# lo fija a núcleos / workers para que N procesos no se pisen la CPU.
+HILOS = int(os.getenv("EMB_HILOS", "0"))
+
+# Caché en disco de vectores ya calculados (ver cache_vectores.py). Vive en
+# el volumen /cache junto a los pesos del modelo. EMB_CACHE_MAX=0 la apaga.
+CACHE_DIR = Path(os.getenv("EMB_CACHE_DIR", "/cache/vectores"))
+CACHE_MAX = int(os.getenv("EMB_CACHE_MAX", "100000"))
+CACHE_DTYPE = os.getenv("EMB_CACHE_DTYPE", "float16")
+
+# Presupuesto de tokens (con padding) por llamada a encode. Cada sub-lote
+# cuesta `longitud_máxima × nº_textos`, así que agrupar textos de longitud
+# parecida evita rellenar 40 preguntas cortas hasta la longitud de un
+# texto legal largo.
+TOKENS_LOTE = int(os.getenv("EMB_TOKENS_LOTE", "16384"))
+
+
+def _espacio(backend: str) -> str:
+    """Identificador del espacio vectorial para la caché: los vectores INT8
+    no son bit a bit iguales a los FP32 y no deben mezclarse."""
+    if backend == "torch":
+        return MODELO_NOMBRE
+    if backend == "onnx-int8":
+        return f"{MODELO_NOMBRE}|onnx-int8-{ONNX_CUANT}"
+    return f"{MODELO_NOMBRE}|{backend}"
+
+
+def _opciones_onnx() -> dict:
+    """model_kwargs con las SessionOptions de ORT si hay que limitar hilos."""
+    if HILOS <= 0:
+        return {}
+    import onnxruntime as ort
+
+    opciones = ort.SessionOptions()
+    opciones.intra_op_num_threads = HILOS
+    opciones.inter_op_num_threads = 1
+    return {"session_options": opciones}
+
+
+def _cargar_int8() -> SentenceTransformer:
+    destino = ONNX_DIR / MODELO_NOMBRE.replace("/", "__")
+    fichero = f"onnx/model_qint8_{ONNX_CUANT}.onnx"
+    if not (destino / fichero).exists():
+        # Primera vez: exportar a ONNX FP32, guardar en local y cuantizar.
+        base = SentenceTransformer(MODELO_NOMBRE, backend="onnx")
+        base.save_pretrained(str(destino))
+        export_dynamic_quantized_onnx_model(base, ONNX_CUANT, str(destino))
+    return SentenceTransformer(
+        str(destino), backend="onnx", model_kwargs={"file_name": fichero, **_opciones_onnx()}
+    )
+
+
+def crear_modelo(backend: str = BACKEND) -> SentenceTransformer:
+    """Instancia el modelo con el backend pedido (sin memoizar)."""
+    if backend == "torch":
+        return SentenceTransformer(MODELO_NOMBRE)
+    if backend == "onnx":
+        return SentenceTransformer(MODELO_NOMBRE, backend="onnx", model_kwargs=_opciones_onnx())
+    if backend == "onnx-int8":
+        return _cargar_int8()
+    raise ValueError(f"EMB_BACKEND desconocido: {backend!r} (válidos: {', '.join(BACKENDS)})")
+
 
 @lru_cache(maxsize=1)
 def cargar() -> SentenceTransformer:
-    return SentenceTransformer(MODELO_NOMBRE)
+    return crear_modelo(BACKEND)
+
+
+@lru_cache(maxsize=1)
+def _cache() -> CacheVectores | None:
+    if CACHE_MAX <= 0:
+        return None
+    return CacheVectores(CACHE_DIR, _espacio(BACKEND), DIMENSIONES, CACHE_MAX, CACHE_DTYPE)
+
+
+def longitudes_tokens(textos: list[str], modelo: SentenceTransformer | None = None) -> list[int]:
+    """Nº de tokens de cada texto tal y como lo verá el modelo (truncado)."""
+    modelo = modelo or cargar()
+    ids = modelo.tokenizer(
+        textos,
+        add_special_tokens=True,
+        truncation=True,
+        max_length=modelo.max_seq_length,
+    )["input_ids"]
+    return [len(x) for x in ids]
+
+
+def lotes_por_longitud(
+    textos: list[str],
+    presupuesto: int = TOKENS_LOTE,
+    modelo: SentenceTransformer | None = None,
+) -> list[list[int]]:
+    """Parte `textos` en sub-lotes de longitud homogénea.
+
+    Devuelve listas de índices ordenadas de más corto a más largo; cada
+    sub-lote cabe en `presupuesto` tokens contando el padding al más largo
+    del grupo. Un texto que por sí solo supere el presupuesto va solo.
+    """
+    longitudes = longitudes_tokens(textos, modelo)
+    lotes: list[list[int]] = []
+    actual: list[int] = []
+    for i in sorted(range(len(textos)), key=longitudes.__getitem__):
+        # Orden ascendente: el texto que entra es el más largo del grupo.
+        if actual and longitudes[i] * (len(actual) + 1) > presupuesto:
+            lotes.append(actual)
+            actual = []
+        actual.append(i)
+    if actual:
+        lotes.append(actual)
+    return lotes
+
+
+def codificar(modelo: SentenceTransformer, textos: list[str]) -> list[list[float]]:
+    """Codifica `textos` con `modelo` en sub-lotes por longitud, sin caché."""
+    vectores: list[list[float]] = [[] for _ in textos]
+    for lote in lotes_por_longitud(textos, modelo=modelo):
+        arr = modelo.encode(
+            [textos[i] for i in lote],
+            batch_size=len(lote),
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+        )
+        for i, v in zip(lote, arr.tolist()):
+            vectores[i] = v
+    return vectores
+
+
+def _codificar(textos: list[str]) -> list[list[float]]:
+    return codificar(cargar(), textos)
 
 
 def _vectorizar(textos: list[str]) -> list[list[float]]:
     if not textos:
         return []
-    modelo = cargar()
-    arr = modelo.encode(
-        textos,
-        normalize_embeddings=True,
-        convert_to_numpy=True,
-    )
-    return arr.tolist()
+    metricas.VECTORIZAR_TEXTOS.observe(len(textos))
+    with metricas.VECTORIZAR_SEGUNDOS.time():
+        return _vectorizar_con_cache(textos)
+
+
+def _vectorizar_con_cache(textos: list[str]) -> list[list[float]]:
+    cache = _cache()
+    if cache is None:
+        metricas.TEXTOS.labels("modelo").inc(len(textos))
+        return _codificar(textos)
+
+    vectores, claves = cache.buscar(textos)
+    # Un texto repetido dentro del mismo lote se codifica una sola vez.
+    faltan: dict[bytes, list[int]] = {}
+    for i, v in enumerate(vectores):
+        if v is None:
+            faltan.setdefault(claves[i], []).append(i)
+    metricas.TEXTOS.labels("cache").inc(len(textos) - sum(map(len, faltan.values())))
+    if faltan:
+        metricas.TEXTOS.labels("modelo").inc(len(faltan))
+        nuevos = _codificar([textos[pos[0]] for pos in faltan.values()])
+        for pos, v in zip(faltan.values(), nuevos):
+            for i in pos:
+                vectores[i] = v
+        cache.guardar(list(faltan), nuevos)
+    return vectores
 
 
 def vectorizar_pasajes(textos: list[str]) -> list[list[float]]:
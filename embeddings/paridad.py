@@ -0,0 +1,78 @@
+"""Comprueba la deriva de un backend de inferencia frente a FP32.
+
+Codifica una muestra de textos con el modelo de referencia (torch FP32) y
+con el backend indicado, y muestra la similitud coseno entre ambos vectores
+por texto (media, percentiles, mínimo) y cuántos textos conservan el mismo
+vecino más cercano dentro de la muestra. No usa la caché de vectores.
+
+Uso (dentro del contenedor):
+    python paridad.py --backend onnx-int8 --muestra 500
+    python paridad.py --backend onnx --fichero textos.txt
+
+Sin --fichero, la muestra sale de `preguntas` (DATABASE_URL) con el mismo
+texto que vectoriza el worker.
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+
+import numpy as np
+
+from modelo import BACKENDS, codificar, crear_modelo
+
+
+def _textos_de_bd(n: int) -> list[str]:
+    import psycopg
+
+    from worker import DSN, _texto_para_embedding
+
+    with psycopg.connect(DSN) as conn:
+        filas = conn.execute(
+            "SELECT enunciado, opciones FROM preguntas ORDER BY random() LIMIT %s",
+            (n,),
+        ).fetchall()
+    return [_texto_para_embedding(e, o) for e, o in filas]
+
+
+def _textos_de_fichero(ruta: str, n: int) -> list[str]:
+    with open(ruta, encoding="utf-8") as f:
+        textos = [linea.strip() for linea in f if linea.strip()]
+    return textos[:n]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--backend", choices=[b for b in BACKENDS if b != "torch"], default="onnx-int8")
+    ap.add_argument("--muestra", type=int, default=300, help="nº máximo de textos")
+    ap.add_argument("--fichero", help="un texto por línea; si falta, se usa la BD")
+    ap.add_argument("--umbral", type=float, default=0.99,
+                    help="coseno medio mínimo aceptable; por debajo, código de salida 1")
+    args = ap.parse_args()
+
+    textos = _textos_de_fichero(args.fichero, args.muestra) if args.fichero else _textos_de_bd(args.muestra)
+    if not textos:
+        print("sin textos de muestra", file=sys.stderr)
+        return 2
+
+    ref = np.asarray(codificar(crear_modelo("torch"), textos), dtype=np.float32)
+    otro = np.asarray(codificar(crear_modelo(args.backend), textos), dtype=np.float32)
+
+    # Los vectores ya vienen normalizados: el coseno es el producto escalar.
+    cos = np.einsum("ij,ij->i", ref, otro)
+    vecino_ref = np.argsort(-(ref @ ref.T), axis=1)[:, 1] if len(textos) > 1 else np.zeros(1)
+    vecino_otro = np.argsort(-(otro @ otro.T), axis=1)[:, 1] if len(textos) > 1 else np.zeros(1)
+    mismo_vecino = float(np.mean(vecino_ref == vecino_otro))
+
+    print(f"backend       {args.backend}")
+    print(f"textos        {len(textos)}")
+    print(f"coseno medio  {cos.mean():.5f}")
+    print(f"coseno p50    {np.percentile(cos, 50):.5f}")
+    print(f"coseno p5     {np.percentile(cos, 5):.5f}")
+    print(f"coseno mín.   {cos.min():.5f}  ({textos[int(cos.argmin())][:60]!r})")
+    print(f"mismo vecino  {mismo_vecino:.1%}")
+    return 0 if cos.mean() >= args.umbral else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""Pool de N procesos worker para vaciar cola_embeddings en paralelo.
+
+Cada proceso carga su propia copia del modelo (con EMB_BACKEND=onnx-int8
+cada copia ocupa aprox. la mitad) y ejecuta `worker.loop`. El reparto lo
+hace Postgres: todos reclaman con FOR UPDATE SKIP LOCKED, así que no hay
+coordinación entre procesos. La caché de vectores en /cache es compartida.
+
+Variables:
+  EMB_WORKERS  nº de procesos (por defecto 2).
+  EMB_HILOS    hilos de cálculo por proceso, tanto de torch como de ONNX
+               Runtime (por defecto núcleos / workers, para no
+               sobresuscribir la CPU).
+
+SIGTERM/SIGINT: cada worker termina el lote en curso, hace commit y sale;
+el padre espera hasta EMB_PARADA_SEG y mata a los rezagados. Un worker que
+muere por error se relanza con espera exponencial (EMB_RELANZAR_MIN hasta
+EMB_RELANZAR_MAX segundos). La espera vuelve al mínimo cuando el worker
+había aguantado EMB_ESTABLE_SEG vivo, así que un fallo de arranque
+(modelo mal configurado, base de datos caída) no recarga el modelo cada
+dos segundos.
+
+Con EMB_METRICAS_PUERTO el padre sirve /metrics con lo de todos los hijos
+(modo multiproceso de prometheus_client, ver metricas.py).
+
+Con EMB_TEORIA_DIR el padre también sincroniza los pasajes de teoría en
+un hilo (teoria.py); solo lee ficheros y encola, no necesita el modelo.
+
+Uso:  python pool.py
+"""
+from __future__ import annotations
+
+import logging
+import multiprocessing as mp
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+import teoria
+
+log = logging.getLogger("embeddings.pool")
+
+WORKERS = int(os.getenv("EMB_WORKERS", "2"))
+HILOS = int(os.getenv("EMB_HILOS", "0")) or max(1, (os.cpu_count() or 1) // max(1, WORKERS))
+PARADA_SEG = float(os.getenv("EMB_PARADA_SEG", "60"))
+RELANZAR_MIN = float(os.getenv("EMB_RELANZAR_MIN", "2"))
+RELANZAR_MAX = float(os.getenv("EMB_RELANZAR_MAX", "300"))
+ESTABLE_SEG = float(os.getenv("EMB_ESTABLE_SEG", "300"))
+
+
+def _proceso(nombre: str) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    import torch
+
+    torch.set_num_threads(HILOS)
+
+    from modelo import cargar
+    from worker import loop
+
+    parar = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: parar.set())
+    signal.signal(signal.SIGINT, lambda *_: parar.set())
+    cargar()
+    loop(parar, nombre)
+
+
+def _lanzar(ctx, nombre: str) -> mp.Process:
+    p = ctx.Process(target=_proceso, args=(nombre,), name=nombre)
+    p.start()
+    log.info("%s lanzado (pid %d, %d hilos)", nombre, p.pid, HILOS)
+    return p
+
+
+def _preparar_metricas() -> None:
+    """Directorio compartido de métricas, vacío en cada arranque. Se fija en
+    el entorno antes de importar prometheus_client para que padre e hijos
+    (que lo heredan con spawn) usen el modo multiproceso."""
+    if int(os.getenv("EMB_METRICAS_PUERTO", "0")) <= 0:
+        return
+    directorio = os.getenv("PROMETHEUS_MULTIPROC_DIR") or os.path.join(tempfile.gettempdir(), "emb_metricas")
+    shutil.rmtree(directorio, ignore_errors=True)
+    os.makedirs(directorio)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = directorio
+
+    # Solo metricas: el padre no importa worker/modelo (ni torch).
+    import metricas
+
+    metricas.iniciar(os.environ["DATABASE_URL"], multiproceso=True)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    _preparar_metricas()
+    # Los hijos heredan el entorno: modelo.py pasa EMB_HILOS a las sesiones
+    # de ORT y OMP_NUM_THREADS acota OpenMP/MKL, que si no usan un hilo
+    # por núcleo en cada proceso.
+    os.environ["EMB_HILOS"] = str(HILOS)
+    os.environ.setdefault("OMP_NUM_THREADS", str(HILOS))
+    # spawn: cada hijo arranca limpio, sin heredar hilos de torch/ORT.
+    ctx = mp.get_context("spawn")
+    parar = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: parar.set())
+    signal.signal(signal.SIGINT, lambda *_: parar.set())
+
+    teoria.iniciar(parar)
+
+    procesos = {f"worker-{i}": _lanzar(ctx, f"worker-{i}") for i in range(1, WORKERS + 1)}
+    lanzado = {nombre: time.monotonic() for nombre in procesos}
+    espera = {nombre: RELANZAR_MIN for nombre in procesos}
+    # nombre → instante del relanzamiento, para los que están caídos.
+    relanzar: dict[str, float] = {}
+    while not parar.wait(2):
+        ahora = time.monotonic()
+        for nombre, p in list(procesos.items()):
+            if nombre in relanzar:
+                if ahora >= relanzar[nombre]:
+                    del relanzar[nombre]
+                    procesos[nombre] = _lanzar(ctx, nombre)
+                    lanzado[nombre] = ahora
+                continue
+            if p.is_alive():
+                continue
+            if ahora - lanzado[nombre] >= ESTABLE_SEG:
+                espera[nombre] = RELANZAR_MIN
+            log.warning(
+                "%s terminó con código %s tras %.0fs; relanzando en %.0fs",
+                nombre, p.exitcode, ahora - lanzado[nombre], espera[nombre],
+            )
+            relanzar[nombre] = ahora + espera[nombre]
+            espera[nombre] = min(espera[nombre] * 2, RELANZAR_MAX)
+
+    log.info("parando %d workers", len(procesos))
+    for p in procesos.values():
+        if p.is_alive():
+            os.kill(p.pid, signal.SIGTERM)
+    limite = time.monotonic() + PARADA_SEG
+    for nombre, p in procesos.items():
+        p.join(max(0.0, limite - time.monotonic()))
+        if p.is_alive():
+            log.warning("%s no paró a tiempo; se mata", nombre)
+            p.kill()
+            p.join()
+
+
+if __name__ == "__main__":
+    main()
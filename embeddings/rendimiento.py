@@ -0,0 +1,440 @@
+"""Banco de pruebas de rendimiento del servicio de embeddings.
+
+Genera un corpus sintético y reproducible con la forma de `preguntas`
+(enunciado + opciones JSON, longitudes variadas: preguntas de una línea,
+supuestos prácticos largos) y mide:
+
+  modelo   `modelo._vectorizar` en este proceso, por tamaño de lote:
+           textos/s y latencia p50/p99 por llamada.
+  http     /vectorizar y /vectorizar_consulta de una API ya arrancada,
+           con N clientes concurrentes: peticiones/s, textos/s, p50/p99.
+  worker   vaciado de cola_embeddings de principio a fin
+           (`worker._procesar_lote`) contra un Postgres+pgvector LOCAL:
+           inserta el corpus en `preguntas`, cronometra hasta vaciar la
+           cola y borra lo insertado.
+
+El resultado se escribe en JSON (--salida) y con --comparar se muestra la
+diferencia frente a una ejecución anterior.
+
+Uso (dentro del contenedor):
+    python rendimiento.py modelo --lotes 1,16,64,256 --salida base.json
+    python rendimiento.py http --url http://localhost:8001 --concurrencia 1,8,32
+    python rendimiento.py worker --dsn postgres://aprentix@localhost:5432/aprentix
+    python rendimiento.py modelo --salida nuevo.json --comparar base.json
+
+La caché de vectores se apaga por defecto en `modelo` y `worker`
+(EMB_CACHE_MAX=0) para medir el modelo y no el disco; --con-cache la deja
+como esté. En `http` manda la configuración del servidor: para medir el
+modelo, arrancarlo con EMB_CACHE_MAX=0 o cambiar --semilla entre
+ejecuciones. `worker` necesita que no haya otros workers vaciando la cola
+de esa base de datos (se llevarían parte del trabajo).
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+
+# ── Corpus ─────────────────────────────────────────────────────────────────
+
+_TEMAS = {
+    "constitución": [
+        ("el Defensor del Pueblo", "las Cortes Generales"),
+        ("el Tribunal Constitucional", "doce miembros"),
+        ("la reforma constitucional", "el artículo 168"),
+        ("los derechos fundamentales", "el recurso de amparo"),
+        ("la Corona", "el refrendo"),
+    ],
+    "procedimiento administrativo": [
+        ("el silencio administrativo", "estimatorio"),
+        ("el recurso de alzada", "un mes"),
+        ("la notificación electrónica", "diez días naturales"),
+        ("la caducidad del procedimiento", "tres meses"),
+        ("los actos nulos de pleno derecho", "el artículo 47"),
+    ],
+    "informática": [
+        ("el protocolo HTTPS", "el puerto 443"),
+        ("una clave primaria", "la unicidad de cada fila"),
+        ("Maven", "la gestión de dependencias en Java"),
+        ("el modelo OSI", "siete capas"),
+        ("una transacción ACID", "el aislamiento"),
+    ],
+    "historia": [
+        ("la Constitución de Cádiz", "1812"),
+        ("los Reyes Católicos", "la unión dinástica"),
+        ("la Transición", "la Ley para la Reforma Política"),
+        ("la Segunda República", "1931"),
+        ("la Ilustración", "el siglo XVIII"),
+    ],
+    "biología": [
+        ("la mitocondria", "la respiración celular"),
+        ("el ADN", "la doble hélice"),
+        ("la fotosíntesis", "el cloroplasto"),
+        ("los ribosomas", "la síntesis de proteínas"),
+        ("la meiosis", "cuatro células haploides"),
+    ],
+}
+
+_CORTAS = [
+    "¿Qué se asocia con {c}?",
+    "¿Con qué está relacionado {c}?",
+    "Señale la respuesta correcta sobre {c}.",
+]
+_MEDIAS = [
+    "En relación con {c}, dentro del temario de {t}, ¿cuál de las siguientes afirmaciones es correcta?",
+    "Según la normativa vigente en materia de {t}, respecto a {c}, indique la opción verdadera.",
+    "¿Cuál de las siguientes opciones describe mejor {c} en el contexto de {t}?",
+]
+_RELLENO = [
+    "Un ciudadano presenta un escrito ante la Administración y, transcurrido el plazo, no recibe respuesta.",
+    "La unidad tramitadora solicita un informe preceptivo que no llega en el plazo establecido.",
+    "El equipo de desarrollo debe desplegar una nueva versión sin interrumpir el servicio.",
+    "Durante el examen se plantea un caso práctico que combina varios apartados del temario.",
+    "El órgano competente dicta resolución y la notifica por medios electrónicos al interesado.",
+    "Se detecta un error material en el expediente después de haber finalizado el procedimiento.",
+    "La comisión revisa la documentación aportada y requiere al interesado para que la subsane.",
+    "El responsable del sistema analiza los registros de acceso tras una incidencia de seguridad.",
+]
+_DISTRACTORES = [
+    "Ninguna de las anteriores", "Todas las anteriores son correctas",
+    "Depende de la comunidad autónoma", "Solo en casos excepcionales",
+    "El Consejo de Estado", "seis meses", "el artículo 21", "el puerto 80",
+    "1978", "la célula procariota", "la Ley de Enjuiciamiento Civil",
+]
+
+
+def _enunciado(rng: random.Random, tema: str, concepto: str) -> str:
+    forma = rng.random()
+    if forma < 0.45:
+        return rng.choice(_CORTAS).format(c=concepto)
+    if forma < 0.85:
+        return rng.choice(_MEDIAS).format(c=concepto, t=tema)
+    # Supuesto práctico largo: de 4 a 40 frases.
+    frases = [rng.choice(_RELLENO) for _ in range(rng.randint(4, 40))]
+    pregunta = rng.choice(_MEDIAS).format(c=concepto, t=tema)
+    return "Supuesto práctico. " + " ".join(frases) + " " + pregunta
+
+
+def _opciones(rng: random.Random, correcta: str) -> list:
+    falsas = rng.sample(_DISTRACTORES, rng.randint(2, 4))
+    textos = [correcta, *falsas]
+    if rng.random() < 0.1:
+        # Formato heredado: strings sueltos, la primera es la correcta.
+        return textos
+    rng.shuffle(textos)
+    return [{"texto": t, "correcta": t == correcta} for t in textos]
+
+
+def generar_corpus(n: int, semilla: int) -> list[tuple[str, list]]:
+    """`n` filas (enunciado, opciones) deterministas para una semilla.
+
+    Los enunciados no se repiten (preguntas.hash_contenido es UNIQUE): al
+    agotarse las combinaciones se numeran como variantes.
+    """
+    rng = random.Random(semilla)
+    vistos: set[str] = set()
+    filas: list[tuple[str, list]] = []
+    while len(filas) < n:
+        tema = rng.choice(list(_TEMAS))
+        concepto, correcta = rng.choice(_TEMAS[tema])
+        enunciado = _enunciado(rng, tema, concepto)
+        if enunciado.lower() in vistos:
+            enunciado = f"{enunciado} (variante {len(filas)} · {semilla})"
+        vistos.add(enunciado.lower())
+        filas.append((enunciado, _opciones(rng, correcta)))
+    return filas
+
+
+def _textos(corpus: list[tuple[str, list]]) -> list[str]:
+    """Texto que vectoriza el worker para cada fila (enunciado + correcta)."""
+    from worker import _texto_para_embedding
+
+    return [_texto_para_embedding(e, o) for e, o in corpus]
+
+
+# ── Medidas ────────────────────────────────────────────────────────────────
+
+def _resumen(latencias: list[float], textos: int, duracion: float) -> dict:
+    lat = np.asarray(latencias) * 1000
+    return {
+        "llamadas": len(latencias),
+        "textos": textos,
+        "segundos": round(duracion, 3),
+        "llamadas_s": round(len(latencias) / duracion, 2),
+        "textos_s": round(textos / duracion, 2),
+        "p50_ms": round(float(np.percentile(lat, 50)), 2),
+        "p99_ms": round(float(np.percentile(lat, 99)), 2),
+        "max_ms": round(float(lat.max()), 2),
+    }
+
+
+def medir_modelo(corpus: list[tuple[str, list]], lotes: list[int], repeticiones: int) -> list[dict]:
+    import modelo
+
+    textos = _textos(corpus)
+    modelo.cargar()
+    modelo._vectorizar(textos[:8])  # calentamiento
+    resultados = []
+    for lote in lotes:
+        trozos = [textos[i:i + lote] for i in range(0, len(textos), lote)][:repeticiones]
+        latencias = []
+        t0 = time.perf_counter()
+        for trozo in trozos:
+            t = time.perf_counter()
+            modelo._vectorizar(trozo)
+            latencias.append(time.perf_counter() - t)
+        r = {"lote": lote, **_resumen(latencias, sum(map(len, trozos)), time.perf_counter() - t0)}
+        print(f"modelo  lote={lote:<5} {r['textos_s']:>9.1f} textos/s  "
+              f"p50 {r['p50_ms']:.0f} ms  p99 {r['p99_ms']:.0f} ms", file=sys.stderr)
+        resultados.append(r)
+    return resultados
+
+
+def _post(url: str, textos: list[str], timeout: float) -> None:
+    cuerpo = json.dumps({"textos": textos}).encode("utf-8")
+    req = urllib.request.Request(url, data=cuerpo, headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        datos = json.load(resp)
+    if len(datos["vectores"]) != len(textos):
+        raise RuntimeError(f"{url}: {len(datos['vectores'])} vectores para {len(textos)} textos")
+
+
+def medir_http(
+    textos: list[str],
+    url: str,
+    rutas: list[str],
+    concurrencias: list[int],
+    por_peticion: int,
+    peticiones: int,
+    timeout: float,
+) -> list[dict]:
+    _post(f"{url}/vectorizar_consulta", textos[:1], timeout)  # calentamiento
+    resultados = []
+    siguiente = 0
+    for ruta in rutas:
+        for conc in concurrencias:
+            # Cada petición con textos distintos, para no medir la caché
+            # del servidor dentro de la misma ejecución.
+            cargas = []
+            for _ in range(peticiones):
+                cargas.append([textos[(siguiente + k) % len(textos)] for k in range(por_peticion)])
+                siguiente += por_peticion
+            latencias: list[float] = []
+            errores = 0
+            cerrojo = threading.Lock()
+
+            def una(carga: list[str]) -> None:
+                nonlocal errores
+                t = time.perf_counter()
+                try:
+                    _post(f"{url}{ruta}", carga, timeout)
+                except Exception:  # noqa: BLE001 — se cuentan, no cortan la medida
+                    with cerrojo:
+                        errores += 1
+                    return
+                with cerrojo:
+                    latencias.append(time.perf_counter() - t)
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=conc) as ex:
+                list(ex.map(una, cargas))
+            duracion = time.perf_counter() - t0
+            if not latencias:
+                raise RuntimeError(f"{ruta}: todas las peticiones fallaron")
+            r = {
+                "ruta": ruta, "concurrencia": conc, "textos_peticion": por_peticion,
+                "errores": errores,
+                **_resumen(latencias, len(latencias) * por_peticion, duracion),
+            }
+            print(f"http    {ruta:<21} c={conc:<4} {r['textos_s']:>9.1f} textos/s  "
+                  f"p50 {r['p50_ms']:.0f} ms  p99 {r['p99_ms']:.0f} ms  errores {errores}",
+                  file=sys.stderr)
+            resultados.append(r)
+    return resultados
+
+
+def medir_worker(corpus: list[tuple[str, list]]) -> dict:
+    import psycopg
+    from psycopg.types.json import Jsonb
+
+    import modelo
+    import worker
+
+    modelo.cargar()
+    with psycopg.connect(worker.DSN, autocommit=False) as conn:
+        with conn.cursor() as cur:
+            # Prioridad de importación: un solo NOTIFY 'bulk' por transacción.
+            cur.execute("SET LOCAL aprentix.cola_prioridad = '1'")
+            cur.executemany(
+                "INSERT INTO preguntas (enunciado, opciones) VALUES (%s, %s) "
+                "ON CONFLICT (hash_contenido) DO NOTHING RETURNING id",
+                [(e, Jsonb(o)) for e, o in corpus],
+                returning=True,
+            )
+            ids = []
+            while True:
+                fila = cur.fetchone()
+                if fila:
+                    ids.append(fila[0])
+                if not cur.nextset():
+                    break
+            cur.execute("SELECT count(*) FROM cola_embeddings WHERE procesado_en IS NULL")
+            (pendientes,) = cur.fetchone()
+        conn.commit()
+
+        try:
+            worker._preparar_conexion(conn)
+            latencias, filas = [], 0
+            t0 = time.perf_counter()
+            while True:
+                t = time.perf_counter()
+                n = worker._procesar_lote(conn)
+                if not n:
+                    break
+                latencias.append(time.perf_counter() - t)
+                filas += n
+            duracion = time.perf_counter() - t0
+        finally:
+            conn.rollback()
+            conn.execute("DELETE FROM preguntas WHERE id = ANY(%s)", (ids,))
+            conn.execute(
+                "DELETE FROM cola_embeddings WHERE entidad = 'pregunta' AND entidad_id = ANY(%s)",
+                ([str(i) for i in ids],),
+            )
+            conn.commit()
+
+    if not latencias:
+        raise RuntimeError("la cola ya estaba vacía: ¿hay otro worker conectado a esta base de datos?")
+    r = {"insertadas": len(ids), "pendientes_inicio": pendientes, "lote": worker.LOTE,
+         **_resumen(latencias, filas, duracion)}
+    r["filas_s"] = r.pop("textos_s")
+    print(f"worker  {filas} filas en {duracion:.1f} s  {r['filas_s']:.1f} filas/s  "
+          f"lote p50 {r['p50_ms']:.0f} ms  p99 {r['p99_ms']:.0f} ms", file=sys.stderr)
+    return r
+
+
+# ── Informe ────────────────────────────────────────────────────────────────
+
+def _entorno() -> dict:
+    claves = ("EMB_BACKEND", "EMB_ONNX_CUANT", "EMB_LOTE", "EMB_TOKENS_LOTE",
+              "EMB_CACHE_MAX", "EMB_HILOS", "EMB_HTTP_LOTE", "EMB_HTTP_ESPERA_MS")
+    return {
+        "maquina": platform.node(),
+        "cpu": platform.processor() or platform.machine(),
+        "nucleos": os.cpu_count(),
+        "python": platform.python_version(),
+        "variables": {k: os.environ[k] for k in claves if k in os.environ},
+    }
+
+
+def _clave(modo: str, r: dict) -> str:
+    if modo == "modelo":
+        return f"lote={r['lote']}"
+    if modo == "http":
+        return f"{r['ruta']} c={r['concurrencia']}"
+    return "cola"
+
+
+def comparar(actual: dict, anterior: dict) -> None:
+    """Imprime la variación de rendimiento y p99 entre dos informes."""
+    print(f"{'medida':<34} {'antes':>10} {'ahora':>10} {'Δ':>8}   {'p99 antes':>10} {'p99 ahora':>10}")
+    for modo in ("modelo", "http", "worker"):
+        previos = anterior.get(modo)
+        if not previos or not actual.get(modo):
+            continue
+        ahora = actual[modo] if isinstance(actual[modo], list) else [actual[modo]]
+        antes = {_clave(modo, r): r for r in (previos if isinstance(previos, list) else [previos])}
+        tasa = "filas_s" if modo == "worker" else "textos_s"
+        for r in ahora:
+            clave = _clave(modo, r)
+            a = antes.get(clave)
+            if a is None:
+                continue
+            delta = (r[tasa] - a[tasa]) / a[tasa] if a[tasa] else 0.0
+            print(f"{modo + ' ' + clave:<34} {a[tasa]:>10.1f} {r[tasa]:>10.1f} {delta:>+8.1%}   "
+                  f"{a['p99_ms']:>10.0f} {r['p99_ms']:>10.0f}")
+
+
+def _enteros(valor: str) -> list[int]:
+    return [int(x) for x in valor.split(",") if x.strip()]
+
+
+def main() -> int:
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("modo", choices=["modelo", "http", "worker"])
+    ap.add_argument("--textos", type=int, default=2000, help="tamaño del corpus sintético")
+    ap.add_argument("--semilla", type=int, default=20261017)
+    ap.add_argument("--salida", help="fichero JSON donde escribir los resultados")
+    ap.add_argument("--comparar", help="JSON de una ejecución anterior")
+    ap.add_argument("--con-cache", action="store_true", help="no apagar la caché de vectores")
+    g = ap.add_argument_group("modelo")
+    g.add_argument("--lotes", type=_enteros, default=[1, 16, 64, 256], help="tamaños de lote, p. ej. 1,16,64")
+    g.add_argument("--repeticiones", type=int, default=20, help="llamadas máximas por tamaño de lote")
+    g = ap.add_argument_group("http")
+    g.add_argument("--url", default="http://localhost:8001")
+    g.add_argument("--rutas", default="/vectorizar,/vectorizar_consulta")
+    g.add_argument("--concurrencia", type=_enteros, default=[1, 8, 32])
+    g.add_argument("--por-peticion", type=int, default=1, help="textos por petición")
+    g.add_argument("--peticiones", type=int, default=200, help="peticiones por combinación")
+    g.add_argument("--timeout", type=float, default=120)
+    g = ap.add_argument_group("worker")
+    g.add_argument("--dsn", help="Postgres LOCAL de pruebas (obligatorio en modo worker)")
+    args = ap.parse_args()
+
+    if args.modo == "worker":
+        if not args.dsn:
+            ap.error("el modo worker escribe en la base de datos: indica --dsn explícitamente")
+        os.environ["DATABASE_URL"] = args.dsn
+    else:
+        # worker.py lee DATABASE_URL al importarse; aquí solo se usa
+        # _texto_para_embedding.
+        os.environ.setdefault("DATABASE_URL", "")
+    if not args.con_cache and args.modo != "http":
+        # Antes de importar modelo, que lee la variable al cargarse.
+        os.environ["EMB_CACHE_MAX"] = "0"
+
+    corpus = generar_corpus(args.textos, args.semilla)
+    informe = {
+        "fecha": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "entorno": _entorno(),
+        "corpus": {
+            "textos": len(corpus),
+            "semilla": args.semilla,
+            "caracteres_medios": round(sum(len(e) for e, _ in corpus) / len(corpus), 1),
+        },
+    }
+    if args.modo == "modelo":
+        informe["modelo"] = medir_modelo(corpus, args.lotes, args.repeticiones)
+    elif args.modo == "http":
+        rutas = [r for r in args.rutas.split(",") if r]
+        informe["http"] = medir_http(
+            _textos(corpus), args.url.rstrip("/"), rutas, args.concurrencia,
+            args.por_peticion, args.peticiones, args.timeout,
+        )
+    else:
+        informe["worker"] = medir_worker(corpus)
+
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(informe, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    if args.comparar:
+        with open(args.comparar, encoding="utf-8") as f:
+            comparar(informe, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""Pasajes de los apuntes de teoría para la búsqueda semántica.
+
+Recorre EMB_TEORIA_DIR (el mismo volumen que sirve el servicio de teoría,
+montado en solo lectura), trocea cada .md/.markdown/.txt en pasajes y los
+sincroniza con `teoria_pasajes` vía `sincronizar_pasajes_teoria`. La
+función SQL conserva los pasajes cuyo hash no cambió y encola el resto en
+cola_embeddings (entidad 'teoria'); el worker los vectoriza por lotes con
+el resto de la cola. Al final de cada pasada, `retirar_pasajes_teoria`
+borra los de ficheros que ya no existen.
+
+Troceado: por secciones markdown (el pasaje lleva como título la ruta de
+encabezados, "Tema 3 › Recursos › Alzada") y, dentro de cada sección,
+párrafos acumulados hasta PASAJE_MAX caracteres; un párrafo más largo se
+parte por frases.
+
+Cada pasada solo relee los ficheros cuyo (mtime, tamaño) cambió desde la
+anterior; la primera tras arrancar los relee todos, pero la base de datos
+ya descarta lo que no cambió.
+
+Corre como hilo del padre de pool.py (o de main.py con el worker en la
+API) si EMB_TEORIA_DIR está definido. También a mano:
+
+    python teoria.py        # una pasada y sale
+"""
+from __future__ import annotations
+
+import logging
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+import psycopg
+from psycopg.types.json import Jsonb
+
+log = logging.getLogger("embeddings.teoria")
+
+DIRECTORIO = os.getenv("EMB_TEORIA_DIR", "")
+INTERVALO_S = float(os.getenv("EMB_TEORIA_INTERVALO_S", "300"))
+# ~1500 caracteres son unos 350-400 tokens de bge-m3 en español: bastante
+# contexto para que el pasaje tenga sentido solo y lo bastante corto para
+# que el parecido con una pregunta no se diluya.
+PASAJE_MAX = int(os.getenv("EMB_TEORIA_PASAJE_MAX", "1500"))
+PASAJE_MIN = 40
+FICHERO_MAX_BYTES = 2 * 1024 * 1024
+
+EXTENSIONES = {".md", ".markdown", ".txt"}
+
+_ENCABEZADO = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_VALLA = re.compile(r"^\s*(```|~~~)")
+_FIN_FRASE = re.compile(r"(?<=[.!?;:])\s+")
+
+
+# ── Troceado ────────────────────────────────────────────────────────────────
+
+def _partir(parrafo: str) -> list[str]:
+    """Trozos de `parrafo` de como mucho PASAJE_MAX caracteres, cortando
+    por frases (o por palabras si una frase sola no cabe)."""
+    if len(parrafo) <= PASAJE_MAX:
+        return [parrafo]
+    trozos: list[str] = []
+    actual = ""
+    for frase in _FIN_FRASE.split(parrafo):
+        while len(frase) > PASAJE_MAX:
+            corte = frase.rfind(" ", 0, PASAJE_MAX)
+            corte = corte if corte > 0 else PASAJE_MAX
+            if actual:
+                trozos.append(actual)
+                actual = ""
+            trozos.append(frase[:corte])
+            frase = frase[corte:].lstrip()
+        if actual and len(actual) + 1 + len(frase) > PASAJE_MAX:
+            trozos.append(actual)
+            actual = ""
+        actual = f"{actual} {frase}" if actual else frase
+    if actual:
+        trozos.append(actual)
+    return trozos
+
+
+def trocear(texto: str, titulo_defecto: str = "") -> list[dict]:
+    """Pasajes [{orden, titulo, texto}] de un markdown o texto plano."""
+    pasajes: list[dict] = []
+    encabezados: list[tuple[int, str]] = []
+    parrafos: list[str] = []
+    lineas: list[str] = []
+    en_codigo = False
+
+    def cerrar_parrafo() -> None:
+        p = "\n".join(lineas).strip()
+        lineas.clear()
+        if p:
+            parrafos.extend(_partir(p))
+
+    def cerrar_seccion() -> None:
+        cerrar_parrafo()
+        titulo = " › ".join(t for _, t in encabezados) or titulo_defecto
+        actual = ""
+        for p in parrafos:
+            if actual and len(actual) + 2 + len(p) > PASAJE_MAX:
+                pasajes.append({"titulo": titulo, "texto": actual})
+                actual = ""
+            actual = f"{actual}\n\n{p}" if actual else p
+        if actual:
+            pasajes.append({"titulo": titulo, "texto": actual})
+        parrafos.clear()
+
+    for linea in texto.splitlines():
+        if _VALLA.match(linea):
+            en_codigo = not en_codigo
+            lineas.append(linea)
+            continue
+        m = None if en_codigo else _ENCABEZADO.match(linea)
+        if m:
+            cerrar_seccion()
+            nivel = len(m.group(1))
+            while encabezados and encabezados[-1][0] >= nivel:
+                encabezados.pop()
+            encabezados.append((nivel, m.group(2)))
+        elif not en_codigo and not linea.strip():
+            cerrar_parrafo()
+        else:
+            lineas.append(linea)
+    cerrar_seccion()
+
+    # Los muy cortos (una línea suelta bajo un encabezado) no dicen nada
+    # por sí solos.
+    utiles = [p for p in pasajes if len(p["texto"]) >= PASAJE_MIN]
+    for i, p in enumerate(utiles):
+        p["orden"] = i
+    return utiles
+
+
+# ── Sincronización ─────────────────────────────────────────────────────────
+
+def _recorrer(base: Path):
+    """(ruta estilo URL, Path) de los ficheros de texto, sin ocultos."""
+    for raiz, carpetas, ficheros in os.walk(base):
+        carpetas[:] = [c for c in carpetas if not c.startswith(".")]
+        rel = Path(raiz).relative_to(base).as_posix()
+        prefijo = "" if rel == "." else "/" + rel
+        for nombre in ficheros:
+            if not nombre.startswith(".") and os.path.splitext(nombre)[1].lower() in EXTENSIONES:
+                yield f"{prefijo}/{nombre}", Path(raiz) / nombre
+
+
+class Sincronizador:
+    def __init__(self, base: Path) -> None:
+        self.base = base
+        # ruta → (mtime_ns, tamaño) de la última vez que se sincronizó.
+        self._firmas: dict[str, tuple[int, int]] = {}
+
+    def pasada(self, conn: psycopg.Connection, parar: threading.Event | None = None) -> None:
+        t0 = time.monotonic()
+        presentes: list[str] = []
+        ficheros = encolados = 0
+        for ruta, fs in _recorrer(self.base):
+            if parar is not None and parar.is_set():
+                return
+            try:
+                st = fs.stat()
+            except OSError:
+                continue
+            presentes.append(ruta)
+            firma = (st.st_mtime_ns, st.st_size)
+            if self._firmas.get(ruta) == firma:
+                continue
+            if st.st_size > FICHERO_MAX_BYTES:
+                pasajes = []
+            else:
+                try:
+                    texto = fs.read_text(encoding="utf-8", errors="replace")
+                except OSError as e:
+                    log.warning("no se pudo leer %s: %s", ruta, e)
+                    continue
+                pasajes = trocear(texto, titulo_defecto=fs.stem)
+            (n,) = conn.execute(
+                "SELECT sincronizar_pasajes_teoria(%s, %s)", (ruta, Jsonb(pasajes)),
+            ).fetchone()
+            conn.commit()
+            self._firmas[ruta] = firma
+            ficheros += 1
+            encolados += n
+
+        # Un volumen sin montar se ve como una carpeta vacía: mejor no
+        # borrar todos los pasajes por eso.
+        if not presentes:
+            log.warning("%s no tiene ficheros de texto; no se retira nada", self.base)
+            return
+        (retirados,) = conn.execute(
+            "SELECT retirar_pasajes_teoria(%s)", (presentes,),
+        ).fetchone()
+        conn.commit()
+        vistos = set(presentes)
+        self._firmas = {r: f for r, f in self._firmas.items() if r in vistos}
+        if ficheros or retirados:
+            log.info(
+                "teoría: %d ficheros sincronizados, %d pasajes encolados, %d retirados en %.1fs",
+                ficheros, encolados, retirados, time.monotonic() - t0,
+            )
+
+
+def bucle(parar: threading.Event | None = None) -> None:
+    """Una pasada cada EMB_TEORIA_INTERVALO_S hasta que se active `parar`."""
+    parar = parar or threading.Event()
+    base = Path(DIRECTORIO)
+    sinc = Sincronizador(base)
+    log.info("sincronizando pasajes de %s cada %.0fs", base, INTERVALO_S)
+    while not parar.is_set():
+        try:
+            with psycopg.connect(os.environ["DATABASE_URL"], autocommit=False) as conn:
+                while not parar.is_set():
+                    sinc.pasada(conn, parar)
+                    parar.wait(INTERVALO_S)
+        except Exception as e:  # noqa: BLE001
+            log.exception("error sincronizando teoría, reintento en 30s: %s", e)
+            parar.wait(30)
+
+
+def iniciar(parar: threading.Event | None = None) -> None:
+    """Arranca `bucle` en un hilo si EMB_TEORIA_DIR está definido."""
+    if not DIRECTORIO:
+        return
+    threading.Thread(target=bucle, args=(parar,), daemon=True, name="emb-teoria").start()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    with psycopg.connect(os.environ["DATABASE_URL"]) as conexion:
+        Sincronizador(Path(DIRECTORIO or "/ficheros")).pasada(conexion)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Los módulos del worker se importan planos, como dentro de la imagen.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
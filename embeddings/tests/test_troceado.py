@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip("psycopg")
+
+from teoria import PASAJE_MAX, PASAJE_MIN, trocear  # noqa: E402
+
+FRASE = "El recurso de alzada se interpone ante el órgano superior jerárquico. "
+
+
+def test_titulos_con_la_ruta_de_encabezados():
+    texto = (
+        "# Tema 3\n\nIntroducción al tema con texto suficiente para contar.\n\n"
+        "## Recursos\n\nLos recursos administrativos proceden contra resoluciones.\n\n"
+        "# Tema 4\n\nOtro tema distinto, también con texto suficiente.\n"
+    )
+    pasajes = trocear(texto)
+    assert [p["titulo"] for p in pasajes] == ["Tema 3", "Tema 3 › Recursos", "Tema 4"]
+    assert [p["orden"] for p in pasajes] == [0, 1, 2]
+
+
+def test_sin_encabezados_usa_el_titulo_por_defecto():
+    pasajes = trocear("Texto plano sin encabezados, pero con longitud de sobra.", "apuntes")
+    assert [p["titulo"] for p in pasajes] == ["apuntes"]
+
+
+def test_pasajes_cortos_se_descartan():
+    pasajes = trocear("# Tema\n\nCorto.\n\n## Otro\n\n" + FRASE)
+    assert all(len(p["texto"]) >= PASAJE_MIN for p in pasajes)
+    assert [p["titulo"] for p in pasajes] == ["Tema › Otro"]
+    assert pasajes[0]["orden"] == 0
+
+
+def test_secciones_largas_se_parten_sin_pasar_del_maximo():
+    parrafos = "\n\n".join(FRASE * 4 for _ in range(12))
+    largo = FRASE * 60
+    pasajes = trocear(f"# Tema\n\n{parrafos}\n\n{largo}\n")
+    assert len(pasajes) > 2
+    assert all(len(p["texto"]) <= PASAJE_MAX for p in pasajes)
+    assert [p["orden"] for p in pasajes] == list(range(len(pasajes)))
+    # Sin perder texto: cada frase sigue entera en algún pasaje.
+    frases = sum(p["texto"].count(FRASE.strip()) for p in pasajes)
+    assert frases == 12 * 4 + 60
+
+
+def test_almohadilla_dentro_de_codigo_no_es_encabezado():
+    texto = (
+        "# Tema\n\nEjemplo de configuración comentada en el temario:\n\n"
+        "```\n# esto es un comentario\nclave = valor\n```\n"
+    )
+    pasajes = trocear(texto)
+    assert {p["titulo"] for p in pasajes} == {"Tema"}
+    assert "# esto es un comentario" in pasajes[-1]["texto"]
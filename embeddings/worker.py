@@ -1,6 +1,8 @@
 """Worker que escucha NOTIFY 'embeddings' y procesa la cola pendiente.
 
-Se ejecuta en un hilo aparte arrancado desde main.py. Si pg_notify pierde un
+Se ejecuta en un hilo aparte arrancado desde main.py o en N procesos con
+pool.py. Varios workers pueden convivir: cada uno reclama filas con
+FOR UPDATE SKIP LOCKED y nunca procesan la misma. Si pg_notify pierde un
 mensaje (reconexión, reinicio), la pasada de barrido posterior recoge todas
 las filas pendientes.
 """
@@ -8,16 +10,26 @@ from __future__ import annotations
 
 import logging
 import os
-import select
+import threading
 import time
 
 import psycopg
+from pgvector.psycopg import register_vector
+from psycopg.types.json import Jsonb
 
-from modelo import vectorizar_pasajes as vectorizar
+import metricas
+from clasificador import Clasificador
+from modelo import DIMENSIONES, vectorizar_pasajes as vectorizar
 
 log = logging.getLogger("embeddings.worker")
 DSN = os.environ["DATABASE_URL"]
-LOTE = int(os.getenv("EMB_LOTE", "32"))
+# Filas de la cola reclamadas por pasada. La ventana es amplia a propósito:
+# modelo.py reordena los textos por nº de tokens y los codifica en
+# sub-lotes homogéneos (EMB_TOKENS_LOTE), así que cuantos más textos vea a
+# la vez, menos padding desperdiciado.
+LOTE = int(os.getenv("EMB_LOTE", "256"))
+
+clasificador = Clasificador()
 
 
 def _texto_opcion_correcta(opciones) -> str | None:
@@ -57,92 +69,339 @@ def _texto_para_embedding(enunciado: str, opciones) -> str:
     return enunciado
 
 
-def _procesar_lote(conn: psycopg.Connection) -> int:
+def _preparar_conexion(conn: psycopg.Connection) -> None:
+    """Tipos de pgvector y tabla temporal de staging, una vez por conexión."""
+    register_vector(conn)
+    # Conexión nueva: pudieron perderse avisos del catálogo mientras no
+    # escuchábamos.
+    clasificador.invalidar()
+    conn.execute(
+        f"""
+        CREATE TEMP TABLE _emb_lote (
+            pregunta_id uuid,
+            etiqueta    text,
+            pasaje_id   bigint,
+            embedding   vector({DIMENSIONES}) NOT NULL
+        ) ON COMMIT DELETE ROWS
+        """
+    )
+    conn.commit()
+
+
+def _procesar_lote(
+    conn: psycopg.Connection,
+    preguntas_avisadas: list[str] | None = None,
+    etiquetas_avisadas: list[str] | None = None,
+) -> int:
+    """Reclama, vectoriza y escribe un lote. Con `*_avisadas` solo reclama
+    las filas pendientes de esas entidades (ediciones puntuales que llegan
+    por NOTIFY y se atienden antes que el resto de la cola)."""
     with conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT id, entidad, entidad_id
-            FROM cola_embeddings
-            WHERE procesado_en IS NULL
-            ORDER BY encolado_en
-            LIMIT %s
-            FOR UPDATE SKIP LOCKED
-            """,
-            (LOTE,),
-        )
+        if preguntas_avisadas is None and etiquetas_avisadas is None:
+            # Reparto por carriles de prioridad y deduplicado en SQL.
+            cur.execute(
+                "SELECT id, entidad, entidad_id FROM reclamar_cola_embeddings(%s)",
+                (LOTE,),
+            )
+        else:
+            cur.execute(
+                """
+                SELECT id, entidad, entidad_id
+                FROM cola_embeddings
+                WHERE procesado_en IS NULL
+                  AND (   (entidad = 'pregunta' AND entidad_id = ANY(%s))
+                       OR (entidad = 'etiqueta' AND entidad_id = ANY(%s)))
+                FOR UPDATE SKIP LOCKED
+                """,
+                (preguntas_avisadas or [], etiquetas_avisadas or []),
+            )
         filas = cur.fetchall()
         if not filas:
+            conn.rollback()
             return 0
 
         preguntas_ids = [r[2] for r in filas if r[1] == "pregunta"]
         etiquetas_nombres = [r[2] for r in filas if r[1] == "etiqueta"]
+        pasajes_ids = [r[2] for r in filas if r[1] == "teoria"]
 
+        preguntas = []
         if preguntas_ids:
             cur.execute(
-                "SELECT id, enunciado, opciones FROM preguntas WHERE id::text = ANY(%s)",
+                """
+                SELECT p.id, p.enunciado, p.opciones,
+                       (SELECT t.titulo FROM test_preguntas tp
+                          JOIN tests t ON t.id = tp.test_id
+                         WHERE tp.pregunta_id = p.id
+                         ORDER BY t.creado_en LIMIT 1)
+                FROM preguntas p WHERE p.id::text = ANY(%s)
+                """,
                 (preguntas_ids,),
             )
-            datos = cur.fetchall()
-            if datos:
-                textos = [_texto_para_embedding(d[1], d[2]) for d in datos]
-                vecs = vectorizar(textos)
-                cur.executemany(
-                    "UPDATE preguntas SET embedding = %s, actualizado_en = now() WHERE id = %s",
-                    [(v, d[0]) for d, v in zip(datos, vecs)],
-                )
-                cur.executemany(
-                    "SELECT reclasificar_pregunta(%s)",
-                    [(d[0],) for d in datos],
-                )
+            preguntas = cur.fetchall()
 
+        etiquetas = []
         if etiquetas_nombres:
             cur.execute(
                 "SELECT nombre, COALESCE(descripcion, nombre) FROM catalogo_etiquetas WHERE nombre = ANY(%s)",
                 (etiquetas_nombres,),
             )
-            datos = cur.fetchall()
-            if datos:
-                vecs = vectorizar([d[1] for d in datos])
-                cur.executemany(
-                    "UPDATE catalogo_etiquetas SET embedding = %s WHERE nombre = %s",
-                    [(v, d[0]) for d, v in zip(datos, vecs)],
-                )
+            etiquetas = cur.fetchall()
+
+        pasajes = []
+        if pasajes_ids:
+            cur.execute(
+                "SELECT id, titulo, texto FROM teoria_pasajes WHERE id = ANY(%s::bigint[])",
+                (pasajes_ids,),
+            )
+            pasajes = cur.fetchall()
+
+        # Una sola llamada con todas las entidades juntas: el modelo las
+        # agrupa por longitud, no por tipo. Los pasajes de teoría llevan
+        # delante su ruta de encabezados, que suele nombrar el tema.
+        textos = [_texto_para_embedding(d[1], d[2]) for d in preguntas]
+        textos += [d[1] for d in etiquetas]
+        textos += [f"{d[1]}\n{d[2]}" if d[1] else d[2] for d in pasajes]
+        vecs = vectorizar(textos) if textos else []
+        n_p, n_e = len(preguntas), len(etiquetas)
+        vecs_preguntas = vecs[:n_p]
+        vecs_etiquetas = vecs[n_p:n_p + n_e]
+        vecs_pasajes = vecs[n_p + n_e:]
+
+        # Vectores por COPY binario a la tabla temporal y un único UPDATE
+        # por tabla + ack de la cola en la misma sentencia.
+        with cur.copy(
+            "COPY _emb_lote (pregunta_id, etiqueta, pasaje_id, embedding)"
+            " FROM STDIN WITH (FORMAT BINARY)"
+        ) as copy:
+            copy.set_types(["uuid", "text", "int8", "vector"])
+            for d, v in zip(preguntas, vecs_preguntas):
+                copy.write_row((d[0], None, None, v))
+            for d, v in zip(etiquetas, vecs_etiquetas):
+                copy.write_row((None, d[0], None, v))
+            for d, v in zip(pasajes, vecs_pasajes):
+                copy.write_row((None, None, d[0], v))
 
         cur.execute(
-            "UPDATE cola_embeddings SET procesado_en = now() WHERE id = ANY(%s)",
+            """
+            WITH p AS (
+                UPDATE preguntas q
+                SET embedding = l.embedding, actualizado_en = now()
+                FROM _emb_lote l
+                WHERE l.pregunta_id = q.id
+                RETURNING q.id
+            ), e AS (
+                UPDATE catalogo_etiquetas c
+                SET embedding = l.embedding
+                FROM _emb_lote l
+                WHERE l.etiqueta = c.nombre
+            ), t AS (
+                UPDATE teoria_pasajes t
+                SET embedding = l.embedding, actualizado_en = now()
+                FROM _emb_lote l
+                WHERE l.pasaje_id = t.id
+            ), ack AS (
+                UPDATE cola_embeddings
+                SET procesado_en = now()
+                WHERE id = ANY(%s)
+            )
+            SELECT array_agg(id) FROM p
+            """,
             ([r[0] for r in filas],),
         )
+        (actualizadas,) = cur.fetchone()
+
+        # Va aparte: dentro de la sentencia anterior reclasificar vería el
+        # embedding viejo (mismo snapshot). Las candidatas del catálogo se
+        # calculan aquí en memoria; SQL solo añade el kNN y escribe.
+        if actualizadas:
+            for d in etiquetas:
+                clasificador.invalidar(d[0])
+            candidatas = clasificador.candidatas(
+                cur,
+                [d[1] for d in preguntas],
+                [d[3] for d in preguntas],
+                vecs_preguntas,
+            )
+            cur.execute(
+                "SELECT reclasificar_preguntas(%s::uuid[], p_candidatas => %s)",
+                (actualizadas, Jsonb({str(d[0]): c for d, c in zip(preguntas, candidatas)})),
+            )
     conn.commit()
     return len(filas)
 
 
-def loop() -> None:
-    log.info("worker arrancado; DSN=%s", DSN.split("@")[-1])
-    while True:
+class Estadisticas:
+    """Contadores de rendimiento de un worker; se vuelcan al log cada
+    `intervalo` segundos (y al parar) como filas/s desde el último informe
+    y acumulado desde el arranque."""
+
+    def __init__(self, nombre: str, intervalo: float = 60.0) -> None:
+        self.nombre = nombre
+        self.intervalo = intervalo
+        self.inicio = time.monotonic()
+        self.filas = 0
+        self.segundos = 0.0
+        self._ultimo = self.inicio
+        self._filas_ultimo = 0
+
+    def registrar(self, filas: int, segundos: float) -> None:
+        self.filas += filas
+        self.segundos += segundos
+        if time.monotonic() - self._ultimo >= self.intervalo:
+            self.informar()
+
+    def informar(self) -> None:
+        ahora = time.monotonic()
+        tramo = self.filas - self._filas_ultimo
+        log.info(
+            "%s: %d filas en %.0fs (%.1f filas/s); total %d filas, %.1f filas/s ocupado",
+            self.nombre, tramo, ahora - self._ultimo, tramo / max(ahora - self._ultimo, 1e-9),
+            self.filas, self.filas / max(self.segundos, 1e-9),
+        )
+        self._ultimo = ahora
+        self._filas_ultimo = self.filas
+
+
+# Barrido defensivo adaptativo: si un barrido encuentra filas (avisos
+# perdidos, otro worker caído…) se vuelve al intervalo mínimo; si no, el
+# intervalo se duplica hasta el máximo.
+BARRIDO_MIN = float(os.getenv("EMB_BARRIDO_MIN", "5"))
+BARRIDO_MAX = float(os.getenv("EMB_BARRIDO_MAX", "300"))
+# Tras el primer aviso se siguen recogiendo mientras lleguen con menos de
+# EMB_REBOTE_MS entre sí (hasta EMB_REBOTE_MAX_MS): una importación que
+# dispara miles de triggers produce una sola pasada, no miles.
+REBOTE = float(os.getenv("EMB_REBOTE_MS", "50")) / 1000
+REBOTE_MAX = float(os.getenv("EMB_REBOTE_MAX_MS", "500")) / 1000
+
+
+class Avisos:
+    """Payloads de NOTIFY embeddings acumulados entre pasadas.
+
+    Cualquier aviso despierta al worker, que vacía la cola entera.
+    'pregunta:<id>' y 'etiqueta:<nombre>' son ediciones puntuales y además
+    se reclaman por id antes que el resto. 'bulk' (y cualquier payload
+    desconocido, como 'teoria:<id>', que no tiene vía dirigida) no añade
+    nada más. 'catalogo:<nombre>' refresca el clasificador y no implica
+    trabajo en la cola.
+    """
+
+    def __init__(self) -> None:
+        self.preguntas: set[str] = set()
+        self.etiquetas: set[str] = set()
+
+    def anotar(self, payload: str) -> None:
+        tipo, _, valor = payload.partition(":")
+        if tipo == "catalogo":
+            clasificador.invalidar(valor)
+            return
+        if tipo == "pregunta" and valor:
+            self.preguntas.add(valor)
+        elif tipo == "etiqueta" and valor:
+            self.etiquetas.add(valor)
+        if len(self.preguntas) + len(self.etiquetas) > LOTE:
+            # Demasiados para ser ediciones a mano: es una importación y
+            # va por el orden normal de la cola.
+            self.preguntas.clear()
+            self.etiquetas.clear()
+
+    def tomar_dirigidos(self) -> tuple[list[str], list[str]]:
+        preguntas, etiquetas = list(self.preguntas), list(self.etiquetas)
+        self.preguntas.clear()
+        self.etiquetas.clear()
+        return preguntas, etiquetas
+
+
+def _recoger(escucha: psycopg.Connection, avisos: Avisos, espera: float) -> bool:
+    """Lee avisos durante como mucho `espera` s; vuelve en cuanto llega uno
+    (más los que vengan en el mismo paquete). True si llegó alguno."""
+    llegaron = False
+    for n in escucha.notifies(timeout=espera, stop_after=1):
+        avisos.anotar(n.payload)
+        llegaron = True
+    return llegaron
+
+
+def _rebote(escucha: psycopg.Connection, avisos: Avisos) -> None:
+    limite = time.monotonic() + REBOTE_MAX
+    while time.monotonic() < limite and _recoger(escucha, avisos, REBOTE):
+        pass
+
+
+def _medir(stats: Estadisticas, via: str, filas: int, segundos: float) -> None:
+    stats.registrar(filas, segundos)
+    metricas.LOTE_SEGUNDOS.labels(via).observe(segundos)
+    metricas.LOTE_FILAS.labels(via).observe(filas)
+
+
+def _vaciar_cola(
+    trabajo: psycopg.Connection,
+    escucha: psycopg.Connection,
+    avisos: Avisos,
+    parar: threading.Event,
+    stats: Estadisticas,
+) -> int:
+    """Procesa hasta vaciar la cola. Antes de cada lote mira si han llegado
+    ediciones puntuales y, si las hay, las atiende primero. Devuelve las
+    filas procesadas por orden de cola (sin contar las dirigidas)."""
+    total = 0
+    while not parar.is_set():
+        # Lo que haya llegado mientras se codificaba el lote anterior.
+        while _recoger(escucha, avisos, 0):
+            pass
+        preguntas, etiquetas = avisos.tomar_dirigidos()
+        t0 = time.monotonic()
+        if preguntas or etiquetas:
+            n = _procesar_lote(trabajo, preguntas, etiquetas)
+            _medir(stats, "dirigida", n, time.monotonic() - t0)
+            continue
+        n = _procesar_lote(trabajo)
+        if not n:
+            break
+        _medir(stats, "cola", n, time.monotonic() - t0)
+        total += n
+    return total
+
+
+def loop(parar: threading.Event | None = None, nombre: str = "worker") -> None:
+    """Bucle LISTEN + barrido. Termina (tras acabar el lote en curso)
+    cuando se activa `parar`; sin evento corre para siempre.
+
+    Usa dos conexiones: `escucha` solo hace LISTEN y lee avisos; `trabajo`
+    reclama y escribe. Así los avisos que llegan mientras se codifica un
+    lote no se mezclan con las consultas del lote.
+    """
+    parar = parar or threading.Event()
+    stats = Estadisticas(nombre)
+    log.info("%s arrancado; DSN=%s", nombre, DSN.split("@")[-1])
+    while not parar.is_set():
         try:
-            with psycopg.connect(DSN, autocommit=False) as conn:
+            with psycopg.connect(DSN, autocommit=True) as escucha, \
+                    psycopg.connect(DSN, autocommit=False) as trabajo:
+                escucha.execute("LISTEN embeddings")
+                _preparar_conexion(trabajo)
+                avisos = Avisos()
                 # Barrido inicial por si quedó cola pendiente.
-                while _procesar_lote(conn):
-                    pass
-
-                conn.autocommit = True
-                with conn.cursor() as cur:
-                    cur.execute("LISTEN embeddings;")
-
-                while True:
-                    if select.select([conn], [], [], 30) == ([], [], []):
-                        # Timeout: barrido defensivo.
-                        conn.autocommit = False
-                        while _procesar_lote(conn):
-                            pass
-                        conn.autocommit = True
+                _vaciar_cola(trabajo, escucha, avisos, parar, stats)
+                intervalo = BARRIDO_MIN
+                ultimo_barrido = time.monotonic()
+
+                while not parar.is_set():
+                    # Espera corta para notar `parar` enseguida.
+                    if _recoger(escucha, avisos, 1):
+                        _rebote(escucha, avisos)
+                        _vaciar_cola(trabajo, escucha, avisos, parar, stats)
+                        ultimo_barrido = time.monotonic()
+                        continue
+                    if time.monotonic() - ultimo_barrido < intervalo:
                         continue
-                    conn.execute("SELECT 1")  # consume notificaciones
-                    list(conn.notifies())
-                    conn.autocommit = False
-                    while _procesar_lote(conn):
-                        pass
-                    conn.autocommit = True
+                    n = _vaciar_cola(trabajo, escucha, avisos, parar, stats)
+                    intervalo = BARRIDO_MIN if n else min(intervalo * 2, BARRIDO_MAX)
+                    if n:
+                        log.info("%s: el barrido encontró %d filas sin aviso", nombre, n)
+                    ultimo_barrido = time.monotonic()
         except Exception as e:  # noqa: BLE001
-            log.exception("error en worker, reintento en 5s: %s", e)
-            time.sleep(5)
+            metricas.ERRORES.inc()
+            log.exception("error en %s, reintento en 5s: %s", nombre, e)
+            parar.wait(5)
+    stats.informar()
+    log.info("%s parado", nombre)
@@ -5,25 +5,52 @@ Aprentix · notificador
 Servicio residente que, cada N minutos:
   1. Comprueba si estamos dentro de la ventana horaria (Europe/Madrid por
      defecto) mediante _push_en_ventana() en la BBDD.
-  2. Consulta candidatos a recibir push:
-       - push_candidatos_repaso()      → tienen preguntas de repaso vencidas.
-       - push_candidatos_inactividad() → llevan demasiadas horas sin entrar.
-  3. Para cada candidato, envía un Web Push firmado con VAPID a todas sus
-     suscripciones activas (pywebpush).
-  4. Registra el envío en push_envios (para el rate-limit) y desactiva las
-     suscripciones que devuelvan 404/410 (el navegador las tiró).
+  2. Vuelca los candidatos en la outbox con push_encolar_tick(), por
+     conjuntos y una fila por (candidato, suscripción activa):
+       - tipo 'repaso'      → tienen preguntas de repaso vencidas.
+       - tipo 'inactividad' → llevan demasiadas horas sin entrar.
+  3. Vacía la outbox por lotes con push_reclamar_outbox() (FOR UPDATE SKIP
+     LOCKED: se pueden levantar varias réplicas) y envía un Web Push
+     firmado con VAPID a cada suscripción (pywebpush). Los envíos van en
+     paralelo por un pool de hilos, con una sesión HTTP reutilizable, un
+     tope de conexiones y un límite de envíos/s por servicio push (host del
+     endpoint).
+  4. Al acabar cada lote, registra en bloque el resultado: los correctos
+     pasan a push_envios (para el rate-limit), las suscripciones que
+     devuelven 404/410 se desactivan (el navegador las tiró) y los errores
+     transitorios se reintentan con espera exponencial desde la outbox, sin
+     volver a calcular candidatos.
 
 La BBDD es la fuente de verdad para *cuándo* y *a quién* avisar: la ventana,
 el mínimo de vencidas y los cooldowns viven en la tabla `config`. Cambiar
 un valor allí surte efecto en el siguiente tick sin redeploy.
 
+Modos (NOTIF_MODO):
+  tick     (por defecto) un ciclo cada TICK_SECONDS, con conexión nueva.
+  eventos  una sola conexión residente con LISTEN push. Tras cada ciclo
+           pregunta a push_proximo_evento() cuándo habrá trabajo (próximo
+           usuario que cumple condiciones, reintento de la outbox o apertura
+           de la ventana) y duerme justo hasta entonces; un cambio de config
+           o una suscripción nueva (NOTIFY push) lo despierta antes. Como
+           red de seguridad nunca duerme más de NOTIF_ESPERA_MAX.
+
 Variables de entorno:
   DATABASE_URL          postgresql://aprentix@db:5432/aprentix
   PGPASSWORD            (contraseña del rol aprentix)
   VAPID_PRIVATE_KEY     clave privada VAPID en formato PEM (una línea con \\n)
   VAPID_PUBLIC_KEY      clave pública VAPID (opcional, solo para log)
   VAPID_SUBJECT         mailto:soporte@aprentix.es
-  TICK_SECONDS          intervalo entre ciclos (default 300 = 5 min)
+  NOTIF_MODO            tick | eventos (default tick)
+  TICK_SECONDS          intervalo entre ciclos en modo tick (default 300 = 5 min)
+  NOTIF_ESPERA_MAX      espera máxima en modo eventos, en segundos (default 900)
+  NOTIF_ESPERA_MIN      espera mínima en modo eventos, en segundos (default 2)
+  BATCH_LIMIT           máximo de usuarios por tipo y tick (default 500)
+  PUSH_LOTE             filas de outbox reclamadas de cada vez (default 500)
+  PUSH_CONCURRENCIA     envíos simultáneos en total (default 32)
+  PUSH_POR_HOST         envíos simultáneos por servicio push (default 8)
+  PUSH_RPS_HOST         envíos/s máximos por servicio push (default 50; 0 = sin límite)
+  PUSH_TIMEOUT          timeout HTTP de cada envío en segundos (default 10)
+  NOTIF_METRICAS_PUERTO puerto de /metrics (Prometheus); 0 = sin servidor (default)
 """
 
 from __future__ import annotations
@@ -33,14 +60,21 @@ import logging
 import os
 import signal
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Iterable
+from urllib.parse import urlparse
 
 import base64
 
 import psycopg
+import requests
+from requests.adapters import HTTPAdapter
 from py_vapid import Vapid01
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
 from pywebpush import WebPushException, webpush
 
 
@@ -98,8 +132,22 @@ def _normalizar_vapid_key(raw: str) -> str:
 DATABASE_URL      = os.environ["DATABASE_URL"]
 VAPID_PRIVATE_KEY = _normalizar_vapid_key(os.environ["VAPID_PRIVATE_KEY"])
 VAPID_SUBJECT     = os.environ.get("VAPID_SUBJECT", "mailto:soporte@aprentix.es")
+NOTIF_MODO        = os.environ.get("NOTIF_MODO", "tick")
 TICK_SECONDS      = int(os.environ.get("TICK_SECONDS", "300"))
+ESPERA_MAX        = float(os.environ.get("NOTIF_ESPERA_MAX", "900"))
+ESPERA_MIN        = float(os.environ.get("NOTIF_ESPERA_MIN", "2"))
+METRICAS_PUERTO   = int(os.environ.get("NOTIF_METRICAS_PUERTO", "0"))
 BATCH_LIMIT       = int(os.environ.get("BATCH_LIMIT",  "500"))
+PUSH_LOTE         = int(os.environ.get("PUSH_LOTE", "500"))
+PUSH_CONCURRENCIA = int(os.environ.get("PUSH_CONCURRENCIA", "32"))
+PUSH_POR_HOST     = int(os.environ.get("PUSH_POR_HOST", "8"))
+PUSH_RPS_HOST     = float(os.environ.get("PUSH_RPS_HOST", "50"))
+PUSH_TIMEOUT      = float(os.environ.get("PUSH_TIMEOUT", "10"))
+
+# Validez del JWT VAPID (el estándar admite hasta 24 h; pywebpush usa 12 h)
+# y margen con el que se renueva antes de caducar.
+VAPID_VIDA_S   = 12 * 3600
+VAPID_MARGEN_S = 10 * 60
 
 logging.basicConfig(
     level=os.environ.get("LOG_LEVEL", "INFO"),
@@ -183,6 +231,53 @@ VAPID_PRIV_OBJ = _cargar_vapid_privada(VAPID_PRIVATE_KEY)
 _validar_config_vapid(VAPID_PRIV_OBJ)
 
 
+# ── Métricas ───────────────────────────────────────────────────────────────
+# Se cuentan siempre; solo se sirven si NOTIF_METRICAS_PUERTO > 0. La
+# profundidad de la outbox se consulta en Postgres en cada scrape.
+
+ENVIO_SEGUNDOS = Histogram(
+    "push_envio_segundos", "Latencia de cada envío push por servicio y resultado",
+    ["host", "estado"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+TICK_SEGUNDOS = Histogram(
+    "push_tick_segundos", "Duración de un ciclo completo del notificador",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600),
+)
+ENCOLADOS = Counter("push_encolados_total", "Candidatos volcados a push_outbox")
+AVISADOS = Counter("push_avisados_total", "Usuarios avisados con éxito", ["tipo"])
+
+
+class _OutboxPendiente:
+    def describe(self):
+        return []
+
+    def collect(self):
+        familia = GaugeMetricFamily(
+            "push_outbox_pendientes", "Filas pendientes en push_outbox", labels=["tipo"],
+        )
+        try:
+            with psycopg.connect(DATABASE_URL, connect_timeout=5) as conn:
+                filas = conn.execute(
+                    "SELECT tipo, count(*) FROM push_outbox "
+                    "WHERE estado = 'pendiente' GROUP BY tipo;"
+                ).fetchall()
+        except Exception as e:  # noqa: BLE001 — un scrape fallido no debe tumbar nada
+            log.warning("no se pudo leer push_outbox para métricas: %s", e)
+            return
+        for tipo, n in filas:
+            familia.add_metric([tipo], n)
+        yield familia
+
+
+def iniciar_metricas() -> None:
+    if METRICAS_PUERTO <= 0:
+        return
+    REGISTRY.register(_OutboxPendiente())
+    start_http_server(METRICAS_PUERTO)
+    log.info("métricas en :%d/metrics", METRICAS_PUERTO)
+
+
 # ── Textos motivacionales ──────────────────────────────────────────────────
 # Deliberadamente cortos: en Android e iOS solo se ven ~2 líneas.
 
@@ -211,6 +306,12 @@ def payload_inactividad(dias: int) -> dict:
     }
 
 
+PAYLOADS = {
+    "repaso":      payload_repaso,
+    "inactividad": payload_inactividad,
+}
+
+
 # ── Modelo simple ──────────────────────────────────────────────────────────
 
 @dataclass
@@ -226,9 +327,87 @@ class Suscripcion:
         }
 
 
+# ── Servicios push ─────────────────────────────────────────────────────────
+# Cada host de endpoint (fcm.googleapis.com, updates.push.services.mozilla.com,
+# web.push.apple.com…) es un servicio push distinto: se le reserva una sesión
+# HTTP con keep-alive que dura entre ticks, un tope de envíos simultáneos y
+# un límite de envíos/s para no comernos un 429.
+
+class _CuboTokens:
+    """Token bucket: como mucho `tasa` envíos/s, con ráfagas de `tasa`."""
+
+    def __init__(self, tasa: float) -> None:
+        self.tasa = tasa
+        self.capacidad = max(1.0, tasa)
+        self.tokens = self.capacidad
+        self.ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def tomar(self) -> None:
+        if self.tasa <= 0:
+            return
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad,
+                                  self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                espera = (1 - self.tokens) / self.tasa
+            time.sleep(espera)
+
+
+class ServicioPush:
+    def __init__(self, aud: str) -> None:
+        self.aud = aud
+        self.host = urlparse(aud).netloc
+        self.sesion = requests.Session()
+        self.sesion.mount("https://", HTTPAdapter(pool_connections=1,
+                                                  pool_maxsize=PUSH_POR_HOST))
+        self.huecos = threading.BoundedSemaphore(PUSH_POR_HOST)
+        self.cubo = _CuboTokens(PUSH_RPS_HOST)
+        self._vapid: dict[str, str] = {}
+        self._vapid_exp = 0
+        self._vapid_lock = threading.Lock()
+
+    def cabeceras_vapid(self) -> dict[str, str]:
+        """
+        Cabeceras Authorization/Crypto-Key firmadas para este servicio.
+        El JWT VAPID solo depende de `aud` (el origen del servicio), `sub` y
+        `exp`, así que se firma una vez y se reutiliza para todas sus
+        suscripciones hasta VAPID_MARGEN_S antes de caducar. La firma ECDSA
+        era lo más caro del envío.
+        """
+        with self._vapid_lock:
+            if self._vapid_exp - VAPID_MARGEN_S <= time.time():
+                self._vapid_exp = int(time.time()) + VAPID_VIDA_S
+                self._vapid = VAPID_PRIV_OBJ.sign({
+                    "sub": VAPID_SUBJECT,
+                    "aud": self.aud,
+                    "exp": self._vapid_exp,
+                })
+            return self._vapid
+
+
+_servicios: dict[str, ServicioPush] = {}
+_servicios_lock = threading.Lock()
+
+
+def servicio_de(endpoint: str) -> ServicioPush:
+    url = urlparse(endpoint)
+    aud = f"{url.scheme}://{url.netloc}"
+    with _servicios_lock:
+        srv = _servicios.get(aud)
+        if srv is None:
+            srv = _servicios[aud] = ServicioPush(aud)
+        return srv
+
+
 # ── Envío con manejo de errores ────────────────────────────────────────────
 
-def enviar_push(sus: Suscripcion, payload: dict) -> tuple[bool, str | None]:
+def enviar_push(sus: Suscripcion, datos: bytes) -> tuple[bool, str | None]:
     """
     Devuelve (ok, motivo_si_falla). Un motivo con "gone" o "not_found" es
     señal de que la suscripción está muerta y hay que desactivarla.
@@ -238,18 +417,42 @@ def enviar_push(sus: Suscripcion, payload: dict) -> tuple[bool, str | None]:
     py-vapid tiran ValueError con textos como "invalid_scheme", "expiration
     too far in the future", etc. cuando la config está mal, y sin ese texto
     todo se ve igual desde fuera.
+
+    Se llama desde los hilos del pool: respeta el tope de concurrencia y el
+    límite de envíos/s del servicio push del endpoint.
+
+    `datos` es el payload ya serializado (compartido por todos los envíos
+    con el mismo contenido). El cifrado sí es por suscripción: RFC 8291
+    deriva la clave de su p256dh/auth con una clave efímera y sal nuevas.
     """
+    srv = servicio_de(sus.endpoint)
+    with srv.huecos:
+        srv.cubo.tomar()
+        t0 = time.monotonic()
+        ok, motivo = _entregar(srv, sus, datos)
+    ENVIO_SEGUNDOS.labels(srv.host, _estado(motivo)).observe(time.monotonic() - t0)
+    return ok, motivo
+
+
+def _estado(motivo: str | None) -> str:
+    """Etiqueta corta para métricas: ok, gone, http_429, network, error…"""
+    if motivo is None:
+        return "ok"
+    return motivo.split(":", 1)[0]
+
+
+def _entregar(srv: ServicioPush, sus: Suscripcion, datos: bytes) -> tuple[bool, str | None]:
     try:
-        # vapid_claims se muta dentro de pywebpush (añade 'aud'/'exp'), y esa
-        # mutación persiste entre llamadas → después de la primera suscripción
-        # las siguientes reciben un 'aud' viejo y fallan. Le pasamos siempre
-        # un dict fresco.
+        # Sin vapid_claims: pywebpush no firma; le damos las cabeceras ya
+        # firmadas para este servicio (webpush copia el dict, no lo muta).
         webpush(
             subscription_info=sus.as_subscription_info(),
-            data=json.dumps(payload),
-            vapid_private_key=VAPID_PRIV_OBJ,
-            vapid_claims={"sub": VAPID_SUBJECT},
+            data=datos,
+            vapid_private_key=None,
+            headers=srv.cabeceras_vapid(),
             ttl=3600,
+            timeout=PUSH_TIMEOUT,
+            requests_session=srv.sesion,
         )
         return True, None
     except WebPushException as e:
@@ -263,45 +466,67 @@ def enviar_push(sus: Suscripcion, payload: dict) -> tuple[bool, str | None]:
 
 # ── Ciclo principal ────────────────────────────────────────────────────────
 
-def procesar_candidatos(
-    cur: psycopg.Cursor,
-    tipo: str,
-    filas: Iterable[tuple],
-    build_payload,
-) -> int:
-    enviados = 0
-    for usuario_id, medida in filas:
-        payload = build_payload(medida)
-
-        # Todas las suscripciones activas del usuario en un solo round-trip.
-        cur.execute(
-            "SELECT endpoint, p256dh, auth FROM push_suscripciones_de(%s);",
-            (usuario_id,),
-        )
-        subs = [Suscripcion(*row) for row in cur.fetchall()]
-        if not subs:
-            continue
+@dataclass
+class Envio:
+    id:         int
+    tipo:       str
+    usuario_id: str
+    datos:      bytes
+    sus:        Suscripcion
+
 
-        exito_alguno = False
-        for s in subs:
-            ok, motivo = enviar_push(s, payload)
-            if ok:
-                exito_alguno = True
-            elif motivo == "gone":
-                cur.execute("SELECT push_marcar_error(%s, %s);", (s.endpoint, motivo))
-                log.info("suscripción desactivada (%s): %s", motivo, s.endpoint[:60])
+def procesar_outbox(cur: psycopg.Cursor, filas: Iterable[tuple]) -> dict[str, int]:
+    """
+    `filas` son (id, tipo, usuario_id, medida, endpoint, p256dh, auth) tal
+    como las reclama push_reclamar_outbox(), una por suscripción. Envía
+    todos los push en paralelo y, cuando han terminado, registra en bloque
+    el resultado de cada fila en la outbox. Devuelve el nº de usuarios
+    avisados por tipo.
+    """
+    # El payload depende solo de (tipo, medida): todos los usuarios con el
+    # mismo nº de vencidas comparten texto, así que se construye y serializa
+    # una vez por valor distinto.
+    serializados: dict[tuple[str, int], tuple[str, bytes]] = {}
+    envios: list[Envio] = []
+    for id_, tipo, usuario_id, medida, *campos in filas:
+        clave = (tipo, medida)
+        if clave not in serializados:
+            texto = json.dumps(PAYLOADS[tipo](medida))
+            serializados[clave] = (texto, texto.encode("utf-8"))
+        envios.append(Envio(id_, tipo, usuario_id, serializados[clave][1],
+                            Suscripcion(*campos)))
+    if not envios:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=PUSH_CONCURRENCIA,
+                            thread_name_prefix="push") as pool:
+        resultados = list(pool.map(lambda e: enviar_push(e.sus, e.datos), envios))
+
+    ok: list[tuple[int, str]] = []
+    fallos: list[tuple[int, str]] = []
+    avisados: set[tuple[str, str]] = set()
+    for e, (bien, motivo) in zip(envios, resultados):
+        if bien:
+            ok.append((e.id, e.datos.decode("utf-8")))
+            avisados.add((e.tipo, e.usuario_id))
+        else:
+            fallos.append((e.id, motivo or "error"))
+            if motivo == "gone":
+                log.info("suscripción desactivada (gone): %s", e.sus.endpoint[:60])
             else:
-                # error transitorio → no desactivamos, se reintentará el próximo tick
+                # error transitorio → la outbox lo reintenta con backoff
                 log.warning("push falló (%s) para %s: %s",
-                            motivo, s.endpoint[:60], tipo)
+                            motivo, e.sus.endpoint[:60], e.tipo)
 
-        if exito_alguno:
-            cur.execute(
-                "SELECT push_marcar_envio(%s, %s, %s::jsonb);",
-                (usuario_id, tipo, json.dumps(payload)),
-            )
-            enviados += 1
+    # Bookkeeping en bloque (executemany va en pipeline).
+    if fallos:
+        cur.executemany("SELECT push_outbox_fallo(%s, %s);", fallos)
+    if ok:
+        cur.executemany("SELECT push_outbox_enviado(%s, %s::jsonb);", ok)
 
+    enviados: dict[str, int] = {}
+    for tipo, _ in avisados:
+        enviados[tipo] = enviados.get(tipo, 0) + 1
     return enviados
 
 
@@ -311,55 +536,114 @@ def tick(conn: psycopg.Connection) -> None:
         (en_ventana,) = cur.fetchone()
         if not en_ventana:
             log.debug("fuera de ventana horaria; skip")
+            conn.rollback()
             return
 
-        # ── Repaso ──
-        cur.execute("SELECT * FROM push_candidatos_repaso() LIMIT %s;",
-                    (BATCH_LIMIT,))
-        candidatos_repaso = cur.fetchall()
-        n_repaso = procesar_candidatos(
-            cur, "repaso", candidatos_repaso, payload_repaso
-        )
+        t0 = time.monotonic()
+        # Candidatos → outbox, por conjuntos. Idempotente dentro de la
+        # ventana de cooldown: si otra réplica acaba de hacerlo, no duplica.
+        cur.execute("SELECT push_encolar_tick(%s);", (BATCH_LIMIT,))
+        (encolados,) = cur.fetchone()
+        conn.commit()
+
+        # Vaciado por lotes. La reclamación se confirma antes de enviar (la
+        # fila queda aplazada); si el proceso muere a mitad, vuelve a la
+        # cola sola. Los reintentos programados también salen por aquí.
+        enviados: dict[str, int] = {}
+        while True:
+            cur.execute(
+                "SELECT o_id, o_tipo, o_usuario_id, o_medida, o_endpoint, o_p256dh, o_auth "
+                "FROM push_reclamar_outbox(%s);",
+                (PUSH_LOTE,),
+            )
+            filas = cur.fetchall()
+            conn.commit()
+            if not filas:
+                break
+            for tipo, n in procesar_outbox(cur, filas).items():
+                enviados[tipo] = enviados.get(tipo, 0) + n
+            conn.commit()
+
+    TICK_SEGUNDOS.observe(time.monotonic() - t0)
+    ENCOLADOS.inc(encolados)
+    for tipo, n in enviados.items():
+        AVISADOS.labels(tipo).inc(n)
+    n_repaso, n_inact = enviados.get("repaso", 0), enviados.get("inactividad", 0)
+    if encolados or n_repaso or n_inact:
+        log.info("tick: encolados=%d repaso=%d inactividad=%d (%.1fs)",
+                 encolados, n_repaso, n_inact, time.monotonic() - t0)
+
+
+def bucle_tick(parar: threading.Event) -> None:
+    while not parar.is_set():
+        inicio = time.monotonic()
+        try:
+            with psycopg.connect(DATABASE_URL, autocommit=False) as conn:
+                tick(conn)
+        except Exception:  # noqa: BLE001
+            log.exception("fallo en el tick; reintento en 30s")
+            parar.wait(30)
+            continue
+        # Los ticks nunca se solapan: el siguiente empieza TICK_SECONDS después
+        # del inicio de este (o enseguida si este tardó más). Sleep con exit
+        # temprano si nos avisan.
+        parar.wait(max(0.0, inicio + TICK_SECONDS - time.monotonic()))
 
-        # ── Inactividad ──
-        cur.execute("SELECT * FROM push_candidatos_inactividad() LIMIT %s;",
-                    (BATCH_LIMIT,))
-        candidatos_inactividad = cur.fetchall()
-        n_inact = procesar_candidatos(
-            cur, "inactividad", candidatos_inactividad, payload_inactividad
-        )
 
+def _esperar_evento(conn: psycopg.Connection, parar: threading.Event) -> None:
+    """
+    Duerme hasta push_proximo_evento() (acotado a [ESPERA_MIN, ESPERA_MAX])
+    o hasta que llegue un NOTIFY por el canal 'push'. Espera en trozos de 1 s
+    para atender SIGTERM enseguida.
+    """
+    (segundos,) = conn.execute(
+        "SELECT EXTRACT(epoch FROM push_proximo_evento() - now())::float8;"
+    ).fetchone()
     conn.commit()
-    if n_repaso or n_inact:
-        log.info("tick: repaso=%d inactividad=%d", n_repaso, n_inact)
+    espera = ESPERA_MAX if segundos is None else min(max(segundos, ESPERA_MIN), ESPERA_MAX)
+    log.debug("próximo evento en %.0fs", espera)
+    limite = time.monotonic() + espera
+    while not parar.is_set():
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            return
+        for aviso in conn.notifies(timeout=min(1.0, restante), stop_after=1):
+            log.debug("NOTIFY push: %s", aviso.payload)
+            return
+
+
+def bucle_eventos(parar: threading.Event) -> None:
+    while not parar.is_set():
+        try:
+            with psycopg.connect(DATABASE_URL, autocommit=False) as conn:
+                conn.execute("LISTEN push;")
+                conn.commit()
+                while not parar.is_set():
+                    tick(conn)
+                    _esperar_evento(conn, parar)
+        except Exception:  # noqa: BLE001
+            log.exception("fallo en el bucle de eventos; reconecto en 30s")
+            parar.wait(30)
 
 
 def main() -> int:
-    parar = False
+    parar = threading.Event()
 
     def _handle(signum, _frame):
-        nonlocal parar
         log.info("señal %s recibida, salgo tras el tick actual", signum)
-        parar = True
+        parar.set()
     signal.signal(signal.SIGTERM, _handle)
     signal.signal(signal.SIGINT,  _handle)
+    iniciar_metricas()
 
-    log.info("notificador arrancado (tick=%ss, batch=%d)",
-             TICK_SECONDS, BATCH_LIMIT)
-
-    while not parar:
-        try:
-            with psycopg.connect(DATABASE_URL, autocommit=False) as conn:
-                tick(conn)
-        except Exception:  # noqa: BLE001
-            log.exception("fallo en el tick; reintento en 30s")
-            time.sleep(30)
-            continue
-        # Sleep con exit temprano si nos avisan.
-        for _ in range(TICK_SECONDS):
-            if parar:
-                break
-            time.sleep(1)
+    if NOTIF_MODO == "eventos":
+        log.info("notificador arrancado (modo eventos, espera máx.=%ss, batch=%d)",
+                 ESPERA_MAX, BATCH_LIMIT)
+        bucle_eventos(parar)
+    else:
+        log.info("notificador arrancado (tick=%ss, batch=%d)",
+                 TICK_SECONDS, BATCH_LIMIT)
+        bucle_tick(parar)
 
     log.info("notificador parado")
     return 0
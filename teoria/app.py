@@ -14,18 +14,36 @@ PDF con un enlace <a>). La SPA se sirve como estáticos desde ./site.
 
 from __future__ import annotations
 
+import asyncio
+import errno
+import fcntl
+import hashlib
+import json
 import mimetypes
 import os
+import re
+import secrets
 import shutil
+import stat
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
 from pathlib import Path
+from urllib.parse import quote
 
 import httpx
 import jwt
 from fastapi import (
     FastAPI, File, Form, HTTPException, Request, UploadFile,
 )
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+
+from buscador import Buscador, BuscadorNoDisponible
+from indice import Indice
 
 
 # ── Configuración ───────────────────────────────────────────────────────────
@@ -33,10 +51,69 @@ BASE_DIR = Path(os.getenv("BASE_DIR", "/ficheros")).resolve()
 JWT_SECRET = os.environ["JWT_SECRET"]
 POSTGREST_URL = os.getenv("POSTGREST_URL", "http://postgrest:3000")
 COOKIE_NAME = os.getenv("COOKIE_NAME", "aprentix_token")
+# Conexiones keep-alive abiertas como mucho contra PostgREST.
+POSTGREST_CONEXIONES = int(os.getenv("POSTGREST_CONEXIONES", "20"))
+# Caché de tokens ya verificados: nº máximo de tokens y vida de los datos
+# de sesión derivados (username, oposiciones). Los claims duran hasta exp.
+TOKENS_CACHE_MAX = int(os.getenv("TOKENS_CACHE_MAX", "10000"))
+SESION_DATOS_TTL = float(os.getenv("SESION_DATOS_TTL", "60"))
+# Quién envía los bytes de /api/ver: "caddy" responde con X-Accel-Redirect
+# y el Caddy del contenedor sirve el fichero (sendfile, Range, ETag, 304);
+# "app" los sirve uvicorn (desarrollo, o sin Caddy delante).
+ENTREGA_FICHEROS = os.getenv("ENTREGA_FICHEROS", "app")
+# Los ficheros van con la cookie del usuario: ninguna caché compartida
+# debe guardarlos (private) y el navegador revalida en cada apertura
+# (no-cache), así un permiso retirado se nota enseguida. Con el ETag la
+# revalidación es un 304 sin cuerpo.
+CACHE_FICHEROS = "private, no-cache"
+# Subidas reanudables: ficheros a medias en SUBIDAS_DIR, fuera del árbol
+# que se sirve (ni se lista, ni se indexa, ni se descarga por /api/ver).
+# Si está en el mismo sistema de ficheros que BASE_DIR el paso final es un
+# rename; si no, una copia (ver _mover_subida). Las abandonadas se borran
+# pasadas SUBIDAS_CADUCIDAD_H horas.
+SUBIDAS_DIR = Path(os.getenv("SUBIDAS_DIR", str(BASE_DIR.parent / ".subidas-teoria"))).resolve()
+SUBIDAS_CADUCIDAD_H = float(os.getenv("SUBIDAS_CADUCIDAD_H", "24"))
+# Bytes que se acumulan del cuerpo antes de cada write.
+SUBIDAS_BUFFER = 1024 * 1024
 
 BASE_DIR.mkdir(parents=True, exist_ok=True)
 
-app = FastAPI(title="Aprentix — Teoría", docs_url=None, redoc_url=None)
+# Árbol de carpetas en memoria (ver indice.py) e índice de texto completo
+# (ver buscador.py). Los endpoints que escriben en disco avisan a ambos al
+# terminar.
+indice = Indice(BASE_DIR)
+buscador = Buscador(BASE_DIR)
+
+# Cliente HTTP único para todo el proceso: reutiliza las conexiones con
+# PostgREST en vez de abrir una (TCP + handshake) por cada RPC.
+_http: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def _ciclo_vida(_app: FastAPI):
+    global _http
+    _http = httpx.AsyncClient(
+        base_url=POSTGREST_URL,
+        # Sin límite de espera por conexión libre: un lote grande encola sus
+        # RPC en el pool; cada una sigue limitada a 5 s una vez en marcha.
+        timeout=httpx.Timeout(5.0, pool=None),
+        limits=httpx.Limits(
+            max_connections=POSTGREST_CONEXIONES,
+            max_keepalive_connections=POSTGREST_CONEXIONES,
+            keepalive_expiry=60.0,
+        ),
+    )
+    indice.iniciar()
+    buscador.iniciar()
+    try:
+        yield
+    finally:
+        buscador.parar()
+        indice.parar()
+        await _http.aclose()
+
+
+app = FastAPI(title="Aprentix — Teoría", docs_url=None, redoc_url=None, lifespan=_ciclo_vida)
 
 
 # ── JWT + roles ─────────────────────────────────────────────────────────────
@@ -51,7 +128,68 @@ def extract_jwt(request: Request) -> str:
     raise HTTPException(status_code=401, detail="no_autenticado")
 
 
+class _Sesion:
+    """Claims verificados de un token y datos de PostgREST asociados."""
+    __slots__ = ("claims", "caduca", "datos")
+
+    def __init__(self, claims: dict) -> None:
+        self.claims = claims
+        self.caduca = float(claims["exp"])
+        # clave → (instante en que caduca, valor)
+        self.datos: dict[str, tuple[float, object]] = {}
+
+
+# Un visor de PDF lanza cientos de peticiones Range por minuto con el mismo
+# token: se verifica (HMAC + JSON + claims) una vez y se reutiliza hasta su
+# exp. La clave es el sha256 del token, no el token en claro.
+_sesiones: OrderedDict[bytes, _Sesion] = OrderedDict()
+_sesiones_lock = threading.Lock()
+
+
+def _clave_token(token: str) -> bytes:
+    return hashlib.sha256(token.encode("utf-8")).digest()
+
+
+def _sesion(token: str) -> _Sesion:
+    clave = _clave_token(token)
+    ahora = time.time()
+    with _sesiones_lock:
+        ses = _sesiones.get(clave)
+        if ses is not None:
+            if ahora < ses.caduca:
+                _sesiones.move_to_end(clave)
+                return ses
+            del _sesiones[clave]
+
+    ses = _Sesion(_verificar_jwt(token))
+    with _sesiones_lock:
+        _sesiones[clave] = ses
+        while len(_sesiones) > TOKENS_CACHE_MAX:
+            _sesiones.popitem(last=False)
+    return ses
+
+
+def _dato_sesion(token: str, clave: str):
+    """Valor guardado con `_guardar_dato_sesion`, o None si no está o caducó."""
+    ses = _sesiones.get(_clave_token(token))
+    if ses is None:
+        return None
+    caduca, valor = ses.datos.get(clave, (0.0, None))
+    return valor if time.time() < caduca else None
+
+
+def _guardar_dato_sesion(token: str, clave: str, valor) -> None:
+    ses = _sesiones.get(_clave_token(token))
+    if ses is not None:
+        ses.datos[clave] = (min(time.time() + SESION_DATOS_TTL, ses.caduca), valor)
+
+
 def decode_jwt(token: str) -> dict:
+    """Claims del token (de la caché si ya se verificó). No mutar."""
+    return _sesion(token).claims
+
+
+def _verificar_jwt(token: str) -> dict:
     try:
         return jwt.decode(
             token,
@@ -70,8 +208,7 @@ def require_teoria(request: Request) -> dict:
     roles = claims.get("roles") or []
     if "admin" not in roles and "teoria" not in roles:
         raise HTTPException(status_code=403, detail="permiso_denegado")
-    claims["_token"] = token
-    return claims
+    return {**claims, "_token": token}
 
 
 def require_admin(request: Request) -> dict:
@@ -87,11 +224,16 @@ def normalize_url_path(url_path: str) -> str:
     """
     Devuelve una ruta 'estilo URL' absoluta, sin barras raras ni '..'.
     Es la que se guarda en ficheros_vistas y la que ve la SPA.
+
+    Los ficheros y carpetas ocultos (que empiezan por '.') no se listan y
+    tampoco se pueden pedir a mano: 404, como si no existieran.
     """
     parts = [
         p for p in (url_path or "").replace("\\", "/").split("/")
         if p and p not in (".", "..")
     ]
+    if any(p.startswith(".") for p in parts):
+        raise HTTPException(status_code=404, detail="no_encontrado")
     return "/" + "/".join(parts) if parts else "/"
 
 
@@ -114,24 +256,28 @@ def join_url(carpeta: str, nombre: str) -> str:
 
 # ── PostgREST ───────────────────────────────────────────────────────────────
 
-def _pg(token: str, name: str, payload: dict) -> httpx.Response | None:
+async def _pg(token: str, name: str, payload: dict) -> httpx.Response | None:
     try:
-        return httpx.post(
-            f"{POSTGREST_URL}/rpc/{name}",
+        return await _http.post(
+            f"/rpc/{name}",
             json=payload,
             headers={
                 "Authorization": f"Bearer {token}",
                 "Content-Type": "application/json",
             },
-            timeout=5.0,
         )
     except httpx.HTTPError as e:
         print(f"[teoria] PostgREST {name} error: {e}", flush=True)
         return None
 
 
-def vistos_prefijo(token: str, prefijo: str) -> set[str]:
-    r = _pg(token, "mis_ficheros_vistos", {"p_prefijo": prefijo})
+async def _constante(valor):
+    """Hueco para asyncio.gather cuando una consulta no hace falta."""
+    return valor
+
+
+async def vistos_prefijo(token: str, prefijo: str) -> set[str]:
+    r = await _pg(token, "mis_ficheros_vistos", {"p_prefijo": prefijo})
     if r is None or r.status_code != 200:
         return set()
     try:
@@ -140,11 +286,11 @@ def vistos_prefijo(token: str, prefijo: str) -> set[str]:
         return set()
 
 
-def _asignaciones_carpetas(token: str) -> dict[str, dict]:
+async def _asignaciones_carpetas(token: str) -> dict[str, dict]:
     """Mapa ruta → {oposicion_ids: [uuid...], oposicion_nombres: [str...]}
     tomado de la BD. Una carpeta puede pertenecer a varias oposiciones.
     """
-    r = _pg(token, "listar_carpeta_oposiciones", {})
+    r = await _pg(token, "listar_carpeta_oposiciones", {})
     if r is None or r.status_code != 200:
         return {}
     try:
@@ -167,31 +313,39 @@ def _asignaciones_carpetas(token: str) -> dict[str, dict]:
         return {}
 
 
-def _mis_oposiciones_ids(token: str) -> set[str]:
-    r = _pg(token, "mis_oposiciones_ids", {})
+async def _mis_oposiciones_ids(token: str) -> set[str]:
+    ids = _dato_sesion(token, "mis_oposiciones_ids")
+    if ids is not None:
+        return ids
+    r = await _pg(token, "mis_oposiciones_ids", {})
     if r is None or r.status_code != 200:
         return set()
     try:
-        return {str(x) for x in (r.json() or [])}
+        ids = {str(x) for x in (r.json() or [])}
     except Exception:
         return set()
+    _guardar_dato_sesion(token, "mis_oposiciones_ids", ids)
+    return ids
 
 
 # ── Endpoints API ───────────────────────────────────────────────────────────
 
 @app.get("/api/sesion")
-def api_sesion(request: Request):
+async def api_sesion(request: Request):
     claims = require_teoria(request)
     roles = claims.get("roles") or []
     # El JWT sólo contiene el user_id (claim 'sub'); el username lo pedimos
     # a PostgREST para poder mostrarlo en la cabecera.
-    username = None
-    r = _pg(claims["_token"], "mi_sesion", {})
-    if r is not None and r.status_code == 200:
-        try:
-            username = r.json().get("username")
-        except Exception:
-            pass
+    username = _dato_sesion(claims["_token"], "username")
+    if username is None:
+        r = await _pg(claims["_token"], "mi_sesion", {})
+        if r is not None and r.status_code == 200:
+            try:
+                username = r.json().get("username")
+            except Exception:
+                pass
+        if username is not None:
+            _guardar_dato_sesion(claims["_token"], "username", username)
     return {
         "user_id": claims.get("sub"),
         "username": username,
@@ -200,8 +354,21 @@ def api_sesion(request: Request):
     }
 
 
+def _leer_carpeta(url_path: str) -> tuple[list[tuple[str, int]], list[tuple[str, int, float]]]:
+    """Contenido de la carpeta desde el índice. Puede tocar disco (el jail
+    de resolve_fs hace realpath, y la carpeta puede no estar cargada): se
+    llama en el threadpool."""
+    resolve_fs(url_path)  # jail
+    try:
+        return indice.listar(url_path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="carpeta_no_encontrada")
+    except PermissionError:
+        raise HTTPException(status_code=403, detail="sin_permiso_lectura")
+
+
 @app.get("/api/listar")
-def api_listar(request: Request, ruta: str = "/", oposicion_id: str | None = None):
+async def api_listar(request: Request, ruta: str = "/", oposicion_id: str | None = None):
     """
     Lista una carpeta. Si se pasa `oposicion_id`, filtra la raíz para
     mostrar SOLO carpetas asignadas a esa oposición (filtro estricto:
@@ -214,43 +381,28 @@ def api_listar(request: Request, ruta: str = "/", oposicion_id: str | None = Non
     """
     claims = require_teoria(request)
     url_path = normalize_url_path(ruta)
-    fs = resolve_fs(url_path)
-    if not fs.exists() or not fs.is_dir():
-        raise HTTPException(status_code=404, detail="carpeta_no_encontrada")
 
-    try:
-        entries = list(fs.iterdir())
-    except PermissionError:
-        raise HTTPException(status_code=403, detail="sin_permiso_lectura")
-
-    dirs = sorted(
-        (e for e in entries if e.is_dir() and not e.name.startswith(".")),
-        key=lambda e: e.name.lower(),
-    )
-    files = sorted(
-        (e for e in entries if e.is_file() and not e.name.startswith(".")),
-        key=lambda e: e.name.lower(),
-    )
-
-    vistos = vistos_prefijo(claims["_token"], url_path)
+    token = claims["_token"]
     roles = claims.get("roles") or []
     es_admin = "admin" in roles
 
     # Cargamos asignaciones solo si estamos en la raíz (donde tiene sentido
     # filtrar) o si somos admin (para poder etiquetar cada carpeta con su
     # oposición). Fuera de la raíz no filtramos ni etiquetamos: no aporta.
-    asignaciones = _asignaciones_carpetas(claims["_token"]) if url_path == "/" or es_admin else {}
-    mis_ids = _mis_oposiciones_ids(claims["_token"]) if url_path == "/" and not es_admin else set()
+    # Las RPC son independientes entre sí y de la lectura del disco: van
+    # todas a la vez y el listado tarda un viaje de ida y vuelta, no tres.
+    (dirs, files), vistos, asignaciones, mis_ids = await asyncio.gather(
+        run_in_threadpool(_leer_carpeta, url_path),
+        vistos_prefijo(token, url_path),
+        _asignaciones_carpetas(token) if url_path == "/" or es_admin else _constante({}),
+        _mis_oposiciones_ids(token) if url_path == "/" and not es_admin else _constante(set()),
+    )
 
     carpetas = []
-    for d in dirs:
-        ruta_d = join_url(url_path, d.name)
-        try:
-            n = sum(1 for _ in d.iterdir() if not _.name.startswith("."))
-        except Exception:
-            n = 0
+    for nombre, n in dirs:
+        ruta_d = join_url(url_path, nombre)
         entry = {
-            "nombre": d.name,
+            "nombre": nombre,
             "ruta": ruta_d,
             "num_elementos": n,
         }
@@ -284,16 +436,15 @@ def api_listar(request: Request, ruta: str = "/", oposicion_id: str | None = Non
         carpetas.append(entry)
 
     ficheros = []
-    for f in files:
-        ruta_f = join_url(url_path, f.name)
-        st = f.stat()
-        mime, _ = mimetypes.guess_type(f.name)
+    for nombre, size, mtime in files:
+        ruta_f = join_url(url_path, nombre)
+        mime, _ = mimetypes.guess_type(nombre)
         ficheros.append({
-            "nombre": f.name,
+            "nombre": nombre,
             "ruta": ruta_f,
-            "size": st.st_size,
+            "size": size,
             "mime": mime,
-            "modificado": st.st_mtime,
+            "modificado": mtime,
             "visto": ruta_f in vistos,
         })
 
@@ -319,28 +470,115 @@ def api_listar(request: Request, ruta: str = "/", oposicion_id: str | None = Non
     }
 
 
+def _carpeta_visible(ruta: str, asignaciones: dict[str, dict], mis_ids: set[str],
+                    oposicion_id: str | None, es_admin: bool) -> bool:
+    """Mismo criterio que el filtro de la raíz en /api/listar, aplicado a
+    la carpeta de primer nivel que contiene `ruta`. Los ficheros sueltos
+    en la raíz no se filtran (tampoco en el listado)."""
+    partes = [p for p in ruta.split("/") if p]
+    if len(partes) < 2:
+        return True
+    op_ids = set(asignaciones.get("/" + partes[0], {}).get("oposicion_ids", []))
+    if oposicion_id:
+        return str(oposicion_id) in op_ids
+    if not es_admin:
+        return not op_ids or bool(op_ids & mis_ids)
+    return True
+
+
+@app.get("/api/buscar")
+async def api_buscar(request: Request, q: str = "", limite: int = 20,
+                     oposicion_id: str | None = None):
+    """Búsqueda de texto completo en nombres y contenido de los
+    markdown/texto/PDF. Devuelve los documentos ordenados por relevancia
+    con un fragmento y las posiciones a resaltar en él. Respeta el mismo
+    filtro por oposición que /api/listar en la raíz."""
+    claims = require_teoria(request)
+    q = q.strip()
+    if len(q) < 2:
+        return {"consulta": q, "resultados": [], "indexando": buscador.indexando}
+    limite = max(1, min(limite, 50))
+
+    token = claims["_token"]
+    es_admin = "admin" in (claims.get("roles") or [])
+    asignaciones, mis_ids = await asyncio.gather(
+        _asignaciones_carpetas(token) if oposicion_id or not es_admin else _constante({}),
+        _mis_oposiciones_ids(token) if not es_admin else _constante(set()),
+    )
+    try:
+        resultados = await run_in_threadpool(
+            buscador.buscar, q, limite,
+            lambda r: _carpeta_visible(r, asignaciones, mis_ids, oposicion_id, es_admin),
+        )
+    except BuscadorNoDisponible:
+        raise HTTPException(status_code=503, detail="buscador_no_disponible")
+    for r in resultados:
+        r["mime"] = mimetypes.guess_type(r["nombre"])[0]
+    return {"consulta": q, "resultados": resultados, "indexando": buscador.indexando}
+
+
 @app.get("/api/ver")
 def api_ver(request: Request, ruta: str):
     require_teoria(request)
     url_path = normalize_url_path(ruta)
     fs = resolve_fs(url_path)
-    if not fs.exists() or not fs.is_file():
+    try:
+        st = fs.stat()
+    except OSError:
+        raise HTTPException(status_code=404)
+    if not stat.S_ISREG(st.st_mode):
         raise HTTPException(status_code=404)
 
     # NO se marca como visto automáticamente: el usuario decide con el
     # tick de la tarjeta si ya lo ha estudiado o no. Abrir un fichero
     # para echarle un vistazo no cuenta como "visto".
 
+    cabeceras = {
+        # inline en el navegador cuando el mime sea previsualizable.
+        "Content-Disposition": _disposicion_inline(fs.name),
+        "Cache-Control": CACHE_FICHEROS,
+    }
+    if ENTREGA_FICHEROS == "caddy":
+        # Ya autorizado y dentro de la jaula: Caddy sirve la ruta relativa
+        # a BASE_DIR (ver handle_response en deploy/app/Caddyfile).
+        interna = "/" + fs.relative_to(BASE_DIR).as_posix()
+        return Response(headers={**cabeceras, "X-Accel-Redirect": quote(interna)})
+
+    etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    cabeceras["ETag"] = etag
+    if _no_modificado(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=cabeceras)
     mime, _ = mimetypes.guess_type(fs.name)
+    # FileResponse atiende Range (206) por su cuenta.
     return FileResponse(
         str(fs),
         media_type=mime or "application/octet-stream",
-        filename=fs.name,
-        # inline en el navegador cuando el mime sea previsualizable.
-        headers={"Content-Disposition": f'inline; filename="{fs.name}"'},
+        stat_result=st,
+        headers=cabeceras,
     )
 
 
+def _disposicion_inline(nombre: str) -> str:
+    if nombre.isascii():
+        return f'inline; filename="{nombre}"'
+    return f"inline; filename*=utf-8''{quote(nombre)}"
+
+
+def _no_modificado(request: Request, etag: str, mtime: float) -> bool:
+    """Petición condicional que se puede contestar con 304."""
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        etiquetas = {e.strip().removeprefix("W/") for e in inm.split(",")}
+        return etag in etiquetas or "*" in etiquetas
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return int(mtime) <= parsedate_to_datetime(ims).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
 # ── Lectura y edición de markdown ──────────────────────────────────────────
 
 # Límite de tamaño para servir/aceptar contenido de texto en JSON. Los
@@ -393,6 +631,8 @@ def api_guardar(request: Request, body: dict):
         raise HTTPException(status_code=415, detail="no_es_texto")
 
     fs.write_text(contenido, encoding="utf-8")
+    indice.invalidar(url_path.rsplit("/", 1)[0] or "/")
+    buscador.actualizar(url_path)
     st = fs.stat()
     return {"ruta": url_path, "size": st.st_size, "modificado": st.st_mtime}
 
@@ -426,16 +666,18 @@ def api_crear_md(request: Request, body: dict):
     nombre = _nombre_unico(padre_fs, nombre)
     destino = padre_fs / nombre
     destino.write_text(contenido, encoding="utf-8")
+    indice.invalidar(padre)
+    buscador.actualizar(join_url(padre, nombre))
     return {"ruta": join_url(padre, nombre), "nombre": nombre}
 
 
 @app.post("/api/marcar_visto")
-def api_marcar_visto(request: Request, body: dict):
+async def api_marcar_visto(request: Request, body: dict):
     claims = require_teoria(request)
     # marcar_fichero_visto ahora devuelve { logros_desbloqueados: [...] }
     # cuando el marcado dispara la primera vista del documento.  Reenviamos
     # ese payload al frontend para pintar la notificación de logro.
-    r = _pg(
+    r = await _pg(
         claims["_token"], "marcar_fichero_visto",
         {"p_ruta": normalize_url_path(body.get("ruta", ""))},
     )
@@ -450,9 +692,9 @@ def api_marcar_visto(request: Request, body: dict):
 
 
 @app.post("/api/marcar_no_visto")
-def api_marcar_no_visto(request: Request, body: dict):
+async def api_marcar_no_visto(request: Request, body: dict):
     claims = require_teoria(request)
-    _pg(
+    await _pg(
         claims["_token"], "marcar_fichero_no_visto",
         {"p_ruta": normalize_url_path(body.get("ruta", ""))},
     )
@@ -461,6 +703,13 @@ def api_marcar_no_visto(request: Request, body: dict):
 
 # ── Endpoints de admin ─────────────────────────────────────────────────────
 
+def _borrar_fs(fs: Path) -> None:
+    if fs.is_dir():
+        shutil.rmtree(fs)
+    else:
+        fs.unlink()
+
+
 def _nombre_unico(carpeta: Path, nombre: str) -> str:
     base, ext = os.path.splitext(nombre)
     n = 1
@@ -471,8 +720,9 @@ def _nombre_unico(carpeta: Path, nombre: str) -> str:
     return resultado
 
 
+# Síncrono a propósito: copia y stat en disco, nada que esperar de la red.
 @app.post("/api/subir")
-async def api_subir(
+def api_subir(
     request: Request,
     ruta: str = Form("/"),
     files: list[UploadFile] = File(...),
@@ -493,9 +743,198 @@ async def api_subir(
         with open(target, "wb") as out:
             shutil.copyfileobj(f.file, out)
         subidos.append({"nombre": nombre, "ruta": join_url(url_path, nombre)})
+        buscador.actualizar(join_url(url_path, nombre))
+    indice.invalidar(url_path)
     return {"carpeta": url_path, "subidos": subidos}
 
 
+# ── Subidas reanudables ────────────────────────────────────────────────────
+# Protocolo al estilo tus, para ficheros grandes:
+#   POST   /api/subidas                 {ruta, nombre, tamano} → {id, offset: 0}
+#   GET    /api/subidas/{id}            → {offset, tamano}  (para reanudar)
+#   PATCH  /api/subidas/{id}            cabecera Upload-Offset + bytes crudos
+#                                       → {offset}; 409 si el offset no cuadra
+#   POST   /api/subidas/{id}/finalizar  → {nombre, ruta}
+#   DELETE /api/subidas/{id}            cancela
+# El cuerpo va directo al fichero parcial (sin el spool de UploadFile).
+# Lo recibido antes de un corte se conserva y el cliente sigue desde el
+# offset que devuelve GET. Al finalizar: un fsync, nombre único en el
+# destino (como /api/subir) y rename.
+
+_ID_SUBIDA = re.compile(r"[A-Za-z0-9_-]{16,64}")
+
+
+def _rutas_subida(id_subida: str) -> tuple[Path, Path]:
+    if not _ID_SUBIDA.fullmatch(id_subida):
+        raise HTTPException(status_code=404, detail="subida_no_encontrada")
+    return SUBIDAS_DIR / f"{id_subida}.part", SUBIDAS_DIR / f"{id_subida}.json"
+
+
+def _leer_subida(id_subida: str, claims: dict) -> tuple[Path, dict]:
+    parte, meta_path = _rutas_subida(id_subida)
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="subida_no_encontrada")
+    if meta.get("autor") != claims.get("sub"):
+        raise HTTPException(status_code=404, detail="subida_no_encontrada")
+    return parte, meta
+
+
+def _bloquear_subida(f) -> None:
+    """Cerrojo exclusivo sobre el .part abierto en `f`. Un PATCH que sigue
+    escribiendo (p.ej. tras un corte que el cliente ya dio por perdido)
+    no puede solaparse con el reintento, ni con finalizar o cancelar: el
+    segundo recibe 423 y vuelve a preguntar el offset."""
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        raise HTTPException(status_code=423, detail="subida_en_curso")
+
+
+def _mover_subida(parte: Path, destino: Path) -> None:
+    """rename si SUBIDAS_DIR comparte sistema de ficheros con el destino;
+    si no, copia a un temporal oculto junto al destino y rename, para que
+    nunca se vea el fichero a medio copiar."""
+    try:
+        os.rename(parte, destino)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    tmp = destino.with_name(f".{destino.name}.{secrets.token_hex(4)}.tmp")
+    try:
+        with open(parte, "rb") as src, open(tmp, "xb") as dst:
+            shutil.copyfileobj(src, dst, SUBIDAS_BUFFER)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.rename(tmp, destino)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    parte.unlink()
+
+
+def _purgar_subidas() -> None:
+    limite = time.time() - SUBIDAS_CADUCIDAD_H * 3600
+    for p in SUBIDAS_DIR.glob("*"):
+        try:
+            if p.stat().st_mtime < limite:
+                p.unlink()
+        except OSError:
+            pass
+
+
+@app.post("/api/subidas")
+def api_subida_crear(request: Request, body: dict):
+    claims = require_admin(request)
+    url_path = normalize_url_path(body.get("ruta", "/"))
+    nombre = Path((body.get("nombre") or "").strip()).name  # blinda contra '/'
+    tamano = body.get("tamano")
+    if not nombre or nombre.startswith("."):
+        raise HTTPException(status_code=400, detail="nombre_invalido")
+    if not isinstance(tamano, int) or tamano < 0:
+        raise HTTPException(status_code=400, detail="tamano_invalido")
+    dest_dir = resolve_fs(url_path)
+    if not dest_dir.is_dir():
+        raise HTTPException(status_code=404, detail="carpeta_destino_no_existe")
+
+    SUBIDAS_DIR.mkdir(parents=True, exist_ok=True)
+    _purgar_subidas()
+    id_subida = secrets.token_urlsafe(24)
+    parte, meta_path = _rutas_subida(id_subida)
+    parte.touch(exist_ok=False)
+    meta_path.write_text(json.dumps({
+        "autor": claims.get("sub"),
+        "carpeta": url_path,
+        "nombre": nombre,
+        "tamano": tamano,
+    }), encoding="utf-8")
+    return {"id": id_subida, "offset": 0}
+
+
+@app.get("/api/subidas/{id_subida}")
+def api_subida_estado(request: Request, id_subida: str):
+    claims = require_admin(request)
+    parte, meta = _leer_subida(id_subida, claims)
+    return {"offset": parte.stat().st_size, "tamano": meta["tamano"]}
+
+
+@app.patch("/api/subidas/{id_subida}")
+async def api_subida_trozo(request: Request, id_subida: str):
+    claims = require_admin(request)
+    parte, meta = await run_in_threadpool(_leer_subida, id_subida, claims)
+    try:
+        offset = int(request.headers.get("upload-offset", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="upload_offset_invalido")
+
+    f = await run_in_threadpool(open, parte, "r+b")
+    try:
+        _bloquear_subida(f)
+        actual = os.fstat(f.fileno()).st_size
+        if offset != actual:
+            raise HTTPException(status_code=409, detail="offset_incorrecto")
+        f.seek(actual)
+        buffer = bytearray()
+        try:
+            async for trozo in request.stream():
+                if actual + len(buffer) + len(trozo) > meta["tamano"]:
+                    raise HTTPException(status_code=413, detail="excede_tamano_declarado")
+                buffer += trozo
+                if len(buffer) >= SUBIDAS_BUFFER:
+                    await run_in_threadpool(f.write, bytes(buffer))
+                    actual += len(buffer)
+                    buffer.clear()
+        finally:
+            # También si se corta la conexión: lo recibido cuenta para
+            # reanudar.
+            if buffer:
+                await run_in_threadpool(f.write, bytes(buffer))
+                actual += len(buffer)
+    finally:
+        await run_in_threadpool(f.close)
+    return {"offset": actual}
+
+
+@app.post("/api/subidas/{id_subida}/finalizar")
+def api_subida_finalizar(request: Request, id_subida: str):
+    claims = require_admin(request)
+    parte, meta = _leer_subida(id_subida, claims)
+    # El cerrojo se mantiene hasta después del rename: ningún PATCH
+    # rezagado puede escribir en el fichero ya publicado.
+    with open(parte, "r+b") as f:
+        _bloquear_subida(f)
+        if os.fstat(f.fileno()).st_size != meta["tamano"]:
+            raise HTTPException(status_code=409, detail="subida_incompleta")
+        os.fsync(f.fileno())
+
+        url_path = meta["carpeta"]
+        dest_dir = resolve_fs(url_path)
+        if not dest_dir.is_dir():
+            raise HTTPException(status_code=404, detail="carpeta_destino_no_existe")
+        nombre = _nombre_unico(dest_dir, meta["nombre"])
+        _mover_subida(parte, dest_dir / nombre)
+        _rutas_subida(id_subida)[1].unlink(missing_ok=True)
+    indice.invalidar(url_path)
+    buscador.actualizar(join_url(url_path, nombre))
+    return {"nombre": nombre, "ruta": join_url(url_path, nombre)}
+
+
+@app.delete("/api/subidas/{id_subida}")
+def api_subida_cancelar(request: Request, id_subida: str):
+    claims = require_admin(request)
+    parte, _ = _leer_subida(id_subida, claims)
+    try:
+        with open(parte, "r+b") as f:
+            _bloquear_subida(f)
+            parte.unlink()
+    except FileNotFoundError:
+        pass
+    _rutas_subida(id_subida)[1].unlink(missing_ok=True)
+    return {"ok": True}
+
+
 @app.post("/api/carpeta")
 def api_crear_carpeta(request: Request, body: dict):
     require_admin(request)
@@ -513,98 +952,59 @@ def api_crear_carpeta(request: Request, body: dict):
         raise HTTPException(status_code=409, detail="ya_existe")
 
     nueva.mkdir(parents=False, exist_ok=False)
+    indice.invalidar_cambio(join_url(padre, nombre))
     return {"ruta": join_url(padre, nombre)}
 
 
-@app.post("/api/borrar")
-def api_borrar(request: Request, body: dict):
-    claims = require_admin(request)
-    ruta = normalize_url_path(body.get("ruta", "/"))
+# Los endpoints de borrar y mover son async por las llamadas a PostgREST,
+# pero todo lo que toca disco (realpath del jail, exists, mkdir, rename,
+# rmtree) va en estas funciones síncronas y se ejecuta en el threadpool:
+# sobre un volumen de red cada stat puede tardar, y en el bucle de eventos
+# frenaría todas las peticiones, también las descargas de /api/ver.
+
+def _borrar_ruta(ruta: str) -> None:
+    """Borra `ruta` del disco y avisa a índice y buscador. Lanza
+    HTTPException con el motivo si no se puede."""
     if ruta == "/":
         raise HTTPException(status_code=400, detail="no_puedes_borrar_la_raiz")
-
     fs = resolve_fs(ruta)
     if not fs.exists():
-        raise HTTPException(status_code=404)
-
-    if fs.is_dir():
-        shutil.rmtree(fs)
-    else:
-        fs.unlink()
-
-    _pg(claims["_token"], "borrar_ruta_vistas", {"p_ruta": ruta})
-    return {"borrado": ruta}
-
+        raise HTTPException(status_code=404, detail="no_existe")
+    _borrar_fs(fs)
+    indice.invalidar_cambio(ruta)
+    buscador.borrar(ruta)
 
-@app.post("/api/mover")
-def api_mover(request: Request, body: dict):
-    claims = require_admin(request)
-    origen = normalize_url_path(body.get("origen", ""))
-    destino = normalize_url_path(body.get("destino", ""))
-    if origen == "/" or destino == "/" or origen == destino:
-        raise HTTPException(status_code=400, detail="ruta_invalida")
-
-    src = resolve_fs(origen)
-    dst = resolve_fs(destino)
-    if not src.exists():
-        raise HTTPException(status_code=404, detail="origen_no_existe")
-    if dst.exists():
-        raise HTTPException(status_code=409, detail="destino_ya_existe")
-
-    dst.parent.mkdir(parents=True, exist_ok=True)
-    src.rename(dst)
-    _pg(
-        claims["_token"], "renombrar_ruta_vistas",
-        {"p_origen": origen, "p_destino": destino},
-    )
-    return {"origen": origen, "destino": destino}
-
-
-@app.post("/api/borrar_lote")
-def api_borrar_lote(request: Request, body: dict):
-    """Borra varias rutas de una vez. Devuelve por ruta el resultado
-    para que el frontend pueda avisar de los fallos parcial."""
-    claims = require_admin(request)
-    rutas = body.get("rutas") or []
-    if not isinstance(rutas, list) or not rutas:
-        raise HTTPException(status_code=400, detail="rutas_invalidas")
 
+def _borrar_rutas(rutas: list) -> tuple[list[str], list[dict]]:
     borrados: list[str] = []
     errores: list[dict] = []
     for raw in rutas:
         try:
             ruta = normalize_url_path(str(raw))
-            if ruta == "/":
-                errores.append({"ruta": ruta, "error": "no_puedes_borrar_la_raiz"})
-                continue
-            fs = resolve_fs(ruta)
-            if not fs.exists():
-                errores.append({"ruta": ruta, "error": "no_existe"})
-                continue
-            if fs.is_dir():
-                shutil.rmtree(fs)
-            else:
-                fs.unlink()
-            _pg(claims["_token"], "borrar_ruta_vistas", {"p_ruta": ruta})
+            _borrar_ruta(ruta)
             borrados.append(ruta)
         except HTTPException as e:
             errores.append({"ruta": str(raw), "error": e.detail})
         except Exception as e:
             errores.append({"ruta": str(raw), "error": str(e)})
-    return {"borrados": borrados, "errores": errores}
+    return borrados, errores
 
 
-@app.post("/api/mover_lote")
-def api_mover_lote(request: Request, body: dict):
-    """Mueve varias rutas a la carpeta destino. Conserva el nombre de
-    cada origen. Si ya existe algo con ese nombre, marca el error y
-    continúa con el resto (no se sobrescribe)."""
-    claims = require_admin(request)
-    rutas = body.get("rutas") or []
-    destino_padre = normalize_url_path(body.get("destino", "/"))
-    if not isinstance(rutas, list) or not rutas:
-        raise HTTPException(status_code=400, detail="rutas_invalidas")
+def _mover_ruta(origen: str, destino: str) -> None:
+    src = resolve_fs(origen)
+    dst = resolve_fs(destino)
+    if not src.exists():
+        raise HTTPException(status_code=404, detail="origen_no_existe")
+    if dst.exists():
+        raise HTTPException(status_code=409, detail="destino_ya_existe")
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    src.rename(dst)
+    indice.invalidar_cambio(origen)
+    indice.invalidar_cambio(destino)
+    buscador.mover(origen, destino)
+
 
+def _mover_rutas(rutas: list, destino_padre: str) -> tuple[list[dict], list[dict]]:
     dst_dir = resolve_fs(destino_padre)
     if not dst_dir.exists() or not dst_dir.is_dir():
         raise HTTPException(status_code=404, detail="destino_no_existe")
@@ -638,15 +1038,78 @@ def api_mover_lote(request: Request, body: dict):
             except ValueError:
                 pass
             src.rename(dst)
-            _pg(
-                claims["_token"], "renombrar_ruta_vistas",
-                {"p_origen": origen, "p_destino": destino},
-            )
+            indice.invalidar_cambio(origen)
+            indice.invalidar_cambio(destino)
+            buscador.mover(origen, destino)
             movidos.append({"origen": origen, "destino": destino})
         except HTTPException as e:
             errores.append({"ruta": str(raw), "error": e.detail})
         except Exception as e:
             errores.append({"ruta": str(raw), "error": str(e)})
+    return movidos, errores
+
+
+@app.post("/api/borrar")
+async def api_borrar(request: Request, body: dict):
+    claims = require_admin(request)
+    ruta = normalize_url_path(body.get("ruta", "/"))
+    await run_in_threadpool(_borrar_ruta, ruta)
+    await _pg(claims["_token"], "borrar_ruta_vistas", {"p_ruta": ruta})
+    return {"borrado": ruta}
+
+
+@app.post("/api/mover")
+async def api_mover(request: Request, body: dict):
+    claims = require_admin(request)
+    origen = normalize_url_path(body.get("origen", ""))
+    destino = normalize_url_path(body.get("destino", ""))
+    if origen == "/" or destino == "/" or origen == destino:
+        raise HTTPException(status_code=400, detail="ruta_invalida")
+
+    await run_in_threadpool(_mover_ruta, origen, destino)
+    await _pg(
+        claims["_token"], "renombrar_ruta_vistas",
+        {"p_origen": origen, "p_destino": destino},
+    )
+    return {"origen": origen, "destino": destino}
+
+
+@app.post("/api/borrar_lote")
+async def api_borrar_lote(request: Request, body: dict):
+    """Borra varias rutas de una vez. Devuelve por ruta el resultado
+    para que el frontend pueda avisar de los fallos parcial."""
+    claims = require_admin(request)
+    rutas = body.get("rutas") or []
+    if not isinstance(rutas, list) or not rutas:
+        raise HTTPException(status_code=400, detail="rutas_invalidas")
+
+    borrados, errores = await run_in_threadpool(_borrar_rutas, rutas)
+    # Las vistas se limpian al final, todas a la vez.
+    await asyncio.gather(*(
+        _pg(claims["_token"], "borrar_ruta_vistas", {"p_ruta": r}) for r in borrados
+    ))
+    return {"borrados": borrados, "errores": errores}
+
+
+@app.post("/api/mover_lote")
+async def api_mover_lote(request: Request, body: dict):
+    """Mueve varias rutas a la carpeta destino. Conserva el nombre de
+    cada origen. Si ya existe algo con ese nombre, marca el error y
+    continúa con el resto (no se sobrescribe)."""
+    claims = require_admin(request)
+    rutas = body.get("rutas") or []
+    destino_padre = normalize_url_path(body.get("destino", "/"))
+    if not isinstance(rutas, list) or not rutas:
+        raise HTTPException(status_code=400, detail="rutas_invalidas")
+
+    movidos, errores = await run_in_threadpool(_mover_rutas, rutas, destino_padre)
+    await asyncio.gather(*(
+        _pg(
+            claims["_token"], "renombrar_ruta_vistas",
+            {"p_origen": m["origen"], "p_destino": m["destino"]},
+        )
+        for m in movidos
+    ))
     return {"movidos": movidos, "errores": errores, "destino": destino_padre}
 
 
@@ -655,18 +1118,7 @@ def api_arbol_carpetas(request: Request):
     """Devuelve la lista plana de carpetas del árbol para el selector
     "Mover a…". Solo directorios (sin ficheros) y sin ocultos."""
     require_admin(request)
-    rutas: list[str] = ["/"]
-    for dirpath, dirnames, _files in os.walk(BASE_DIR):
-        # Filtra ocultos in-place para no descender en ellos.
-        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
-        for d in dirnames:
-            full = Path(dirpath) / d
-            try:
-                rel = full.relative_to(BASE_DIR)
-            except ValueError:
-                continue
-            rutas.append("/" + str(rel).replace("\\", "/"))
-    return {"carpetas": rutas}
+    return {"carpetas": indice.carpetas()}
 
 
 # ── Errores JSON ────────────────────────────────────────────────────────────
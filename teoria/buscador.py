@@ -0,0 +1,470 @@
+"""
+Buscador de texto completo sobre /ficheros para el servicio de teoría.
+
+Índice invertido en disco con SQLite FTS5 (biblioteca estándar): por cada
+.md/.markdown/.txt/.pdf se guardan las raíces de sus palabras (stemmer de
+español y plegado de tildes, ver raices.py) y el texto extraído, que sirve
+para construir el fragmento de cada resultado.
+
+  documentos  ruta, mtime_ns, tamaño y texto (zlib) de cada fichero
+  terminos    tabla FTS5 (nombre, raices) con rowid = documentos.id
+
+Actualización:
+  - al arrancar, un hilo recorre el árbol y reindexa solo los ficheros
+    cuyo (mtime_ns, tamaño) no coincide con el guardado; borra los que ya
+    no existen. Se repite cada BUSCADOR_REVISION_S para recoger cambios
+    hechos fuera de la app.
+  - los endpoints que escriben encolan `actualizar`, `borrar` o `mover`;
+    el mismo hilo los atiende (también en mitad del recorrido inicial),
+    así que SQLite tiene un único escritor.
+  - mover solo reescribe rutas: no vuelve a extraer el texto.
+
+Las claves son rutas estilo URL, como en indice.py.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+from pypdf import PdfReader
+
+from raices import plegar, raices, raiz
+
+
+BUSCADOR_DB = os.getenv("BUSCADOR_DB", "/var/lib/aprentix/buscador.sqlite")
+REVISION_S = float(os.getenv("BUSCADOR_REVISION_S", "3600"))
+# PDFs más grandes se indexan solo por nombre (suelen ser escaneos).
+MAX_PDF_BYTES = int(os.getenv("BUSCADOR_MAX_PDF_MB", "100")) * 1024 * 1024
+# Texto que se guarda e indexa por documento.
+MAX_CARACTERES = 2_000_000
+
+EXTENSIONES = {".md", ".markdown", ".txt", ".pdf"}
+
+# Cambiar el stemmer o el esquema obliga a reconstruir el índice.
+_VERSION = 1
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS documentos (
+    id        INTEGER PRIMARY KEY,
+    ruta      TEXT NOT NULL UNIQUE,
+    mtime_ns  INTEGER NOT NULL,
+    tamano    INTEGER NOT NULL,
+    texto     BLOB NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS terminos USING fts5(
+    nombre, raices, tokenize = 'unicode61 remove_diacritics 2'
+);
+"""
+
+# Palabras que no se exigen en la consulta (salvo que no quede otra).
+_VACIAS = {
+    "a", "al", "con", "de", "del", "el", "en", "es", "la", "las", "lo", "los", "o",
+    "para", "por", "que", "se", "su", "sus", "un", "una", "y",
+}
+
+# Para resaltar en el texto original (con tildes y mayúsculas) lo que se
+# buscó plegado.
+_VARIANTES = {
+    "a": "aáàâäã", "e": "eéèêë", "i": "iíìîï", "o": "oóòôöõ", "u": "uúùûü",
+    "n": "nñ", "c": "cç",
+}
+
+logging.getLogger("pypdf").setLevel(logging.ERROR)
+
+
+class BuscadorNoDisponible(RuntimeError):
+    pass
+
+
+class _Parada(Exception):
+    """Se pidió parar en mitad de un recorrido."""
+
+
+def indexable(nombre: str) -> bool:
+    return not nombre.startswith(".") and os.path.splitext(nombre)[1].lower() in EXTENSIONES
+
+
+# ── Extracción de texto ─────────────────────────────────────────────────────
+
+def _texto_pdf(fs: Path) -> str:
+    if fs.stat().st_size > MAX_PDF_BYTES:
+        return ""
+    lector = PdfReader(fs)
+    if lector.is_encrypted and not lector.decrypt(""):
+        return ""
+    partes: list[str] = []
+    total = 0
+    for pagina in lector.pages:
+        t = pagina.extract_text() or ""
+        partes.append(t)
+        total += len(t)
+        if total >= MAX_CARACTERES:
+            break
+    return "\n".join(partes)
+
+
+def extraer_texto(fs: Path) -> str:
+    """Texto plano de un fichero indexable ('' si no se puede extraer)."""
+    if fs.suffix.lower() == ".pdf":
+        texto = _texto_pdf(fs)
+    else:
+        with open(fs, "rb") as f:
+            texto = f.read(MAX_CARACTERES).decode("utf-8", errors="replace")
+    return texto[:MAX_CARACTERES]
+
+
+# ── Consulta ────────────────────────────────────────────────────────────────
+
+def _terminos(consulta: str) -> list[str]:
+    palabras = re.findall(r"\w+", consulta)
+    utiles = [p for p in palabras if plegar(p) not in _VACIAS] or palabras
+    terminos: list[str] = []
+    for p in utiles:
+        r = raiz(p)
+        if r not in terminos:
+            terminos.append(r)
+    return terminos[:10]
+
+
+def _expresion_fts(terminos: list[str]) -> str:
+    """Todos los términos obligatorios; el último como prefijo, para que
+    funcione mientras se escribe."""
+    partes = [f'"{t}"' for t in terminos[:-1]] + [f'"{terminos[-1]}"*']
+    return " ".join(partes)
+
+
+def _patron(terminos: list[str]) -> re.Pattern:
+    alternativas = [
+        "".join(f"[{_VARIANTES[c]}]" if c in _VARIANTES else re.escape(c) for c in t)
+        for t in sorted(terminos, key=len, reverse=True)
+    ]
+    return re.compile(r"(?<!\w)(?:" + "|".join(alternativas) + r")\w*", re.IGNORECASE)
+
+
+def _fragmento(texto: str, terminos: list[str], largo: int = 220) -> tuple[str, list[list[int]]]:
+    """Trozo de `texto` con más términos distintos y las posiciones de las
+    coincidencias dentro de él."""
+    patron = _patron(terminos)
+    coincidencias = []
+    for m in patron.finditer(texto):
+        coincidencias.append(m)
+        if len(coincidencias) >= 200:
+            break
+
+    inicio = 0
+    if coincidencias:
+        mejor = -1
+        for m in coincidencias:
+            desde = max(0, m.start() - largo // 3)
+            distintos = {
+                raiz(c.group()) for c in coincidencias
+                if desde <= c.start() and c.end() <= desde + largo
+            }
+            if len(distintos) > mejor:
+                mejor, inicio = len(distintos), desde
+        # No empezar a mitad de palabra.
+        if inicio > 0:
+            espacio = texto.find(" ", inicio, inicio + 30)
+            if espacio != -1:
+                inicio = espacio + 1
+
+    fin = min(len(texto), inicio + largo)
+    trozo = re.sub(r"\s", " ", texto[inicio:fin])
+    resaltes = [
+        [m.start() - inicio, m.end() - inicio] for m in coincidencias
+        if inicio <= m.start() and m.end() <= fin
+    ]
+    if inicio > 0:
+        trozo = "…" + trozo
+        resaltes = [[a + 1, b + 1] for a, b in resaltes]
+    if fin < len(texto):
+        trozo += "…"
+    return trozo, resaltes
+
+
+# ── Buscador ────────────────────────────────────────────────────────────────
+
+class Buscador:
+    def __init__(self, base: Path, ruta_db: str | Path = BUSCADOR_DB,
+                 revision_s: float = REVISION_S) -> None:
+        self.base = base
+        self.ruta_db = Path(ruta_db)
+        self.revision_s = revision_s
+        self.disponible = False
+        # True mientras dura un recorrido completo (el índice puede estar
+        # incompleto).
+        self.indexando = False
+        self._cola: queue.Queue = queue.Queue()
+        self._local = threading.local()
+        self._hilo: threading.Thread | None = None
+
+    def _disco(self, ruta: str) -> Path:
+        partes = [p for p in ruta.split("/") if p]
+        return self.base.joinpath(*partes) if partes else self.base
+
+    def _conectar(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.ruta_db, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ── Arranque ───────────────────────────────────────────────────────────
+
+    def iniciar(self) -> None:
+        """Crea el esquema y arranca el hilo indexador. Si no se puede
+        abrir la base de datos, el buscador queda desactivado."""
+        try:
+            self.ruta_db.parent.mkdir(parents=True, exist_ok=True)
+            with self._conectar() as conn:
+                if conn.execute("PRAGMA user_version").fetchone()[0] != _VERSION:
+                    conn.executescript(
+                        "DROP TABLE IF EXISTS terminos; DROP TABLE IF EXISTS documentos;"
+                    )
+                conn.executescript(_ESQUEMA)
+                conn.execute(f"PRAGMA user_version = {_VERSION}")
+        except (OSError, sqlite3.Error) as e:
+            print(f"[teoria] buscador desactivado ({e})", flush=True)
+            return
+        self.disponible = True
+        self._hilo = threading.Thread(target=self._bucle, daemon=True, name="buscador")
+        self._hilo.start()
+
+    def parar(self) -> None:
+        if self._hilo is not None:
+            self._cola.put(None)
+            self._hilo.join(timeout=5)
+            self._hilo = None
+
+    # ── Cambios (los llaman los endpoints; no bloquean) ───────────────────
+
+    def actualizar(self, ruta: str) -> None:
+        """Reindexa `ruta` (fichero o carpeta entera) si ha cambiado."""
+        self._cola.put(("actualizar", ruta))
+
+    def borrar(self, ruta: str) -> None:
+        self._cola.put(("borrar", ruta))
+
+    def mover(self, origen: str, destino: str) -> None:
+        self._cola.put(("mover", origen, destino))
+
+    # ── Hilo indexador ─────────────────────────────────────────────────────
+
+    def _bucle(self) -> None:
+        conn = self._conectar()
+        try:
+            while True:
+                self._revisar(conn, "/", completo=True)
+                limite = time.monotonic() + self.revision_s
+                while (restante := limite - time.monotonic()) > 0:
+                    try:
+                        op = self._cola.get(timeout=restante)
+                    except queue.Empty:
+                        break
+                    if op is None:
+                        return
+                    self._aplicar(conn, op)
+        except _Parada:
+            return
+        finally:
+            conn.close()
+
+    def _aplicar(self, conn: sqlite3.Connection, op: tuple) -> None:
+        try:
+            if op[0] == "actualizar":
+                self._revisar(conn, op[1])
+            elif op[0] == "borrar":
+                self._borrar(conn, op[1])
+            elif op[0] == "mover":
+                self._mover(conn, op[1], op[2])
+        except (OSError, sqlite3.Error) as e:
+            print(f"[teoria] buscador: {op[0]} {op[1]} falló ({e})", flush=True)
+
+    def _atender_cola(self, conn: sqlite3.Connection) -> None:
+        """Cambios encolados durante un recorrido largo: se aplican ya."""
+        while True:
+            try:
+                op = self._cola.get_nowait()
+            except queue.Empty:
+                return
+            if op is None:
+                raise _Parada
+            self._aplicar(conn, op)
+
+    def _revisar(self, conn: sqlite3.Connection, ruta: str, completo: bool = False) -> None:
+        """Sincroniza el índice con el disco bajo `ruta`."""
+        t0 = time.monotonic()
+        if completo:
+            self.indexando = True
+        prefijo = ruta.rstrip("/") + "/"
+        conocidos = {
+            r: (m, t) for r, m, t in conn.execute(
+                "SELECT ruta, mtime_ns, tamano FROM documentos "
+                "WHERE ruta = ? OR substr(ruta, 1, ?) = ?",
+                (ruta, len(prefijo), prefijo),
+            )
+        }
+        vistos: set[str] = set()
+        n = 0
+        for r, fs in self._recorrer(ruta):
+            if completo:
+                self._atender_cola(conn)
+            try:
+                st = fs.stat()
+            except OSError:
+                continue
+            vistos.add(r)
+            if conocidos.get(r) == (st.st_mtime_ns, st.st_size):
+                continue
+            self._indexar(conn, r, fs, st)
+            n += 1
+        for r in conocidos.keys() - vistos:
+            self._borrar(conn, r, subarbol=False)
+        if completo:
+            self.indexando = False
+            print(
+                f"[teoria] buscador: {len(vistos)} documentos, {n} reindexados, "
+                f"{len(conocidos.keys() - vistos)} retirados en {time.monotonic() - t0:.1f}s",
+                flush=True,
+            )
+
+    def _recorrer(self, ruta: str):
+        """(ruta, Path) de los ficheros indexables bajo `ruta`, sin ocultos."""
+        fs = self._disco(ruta)
+        if fs.is_file():
+            if indexable(fs.name):
+                yield ruta, fs
+            return
+        for actual, carpetas, ficheros in os.walk(fs):
+            carpetas[:] = sorted(c for c in carpetas if not c.startswith("."))
+            rel = Path(actual).relative_to(self.base).as_posix()
+            url = "/" if rel == "." else "/" + rel
+            for nombre in sorted(ficheros):
+                if indexable(nombre):
+                    yield url.rstrip("/") + "/" + nombre, Path(actual) / nombre
+
+    def _indexar(self, conn: sqlite3.Connection, ruta: str, fs: Path, st: os.stat_result) -> None:
+        try:
+            texto = extraer_texto(fs)
+        except Exception as e:  # noqa: BLE001 — un PDF roto no para el indexador
+            print(f"[teoria] buscador: sin texto de {ruta} ({e})", flush=True)
+            texto = ""
+        nombre = " ".join(raices(os.path.splitext(fs.name)[0]))
+        contenido = " ".join(raices(texto))
+        with conn:
+            fila = conn.execute("SELECT id FROM documentos WHERE ruta = ?", (ruta,)).fetchone()
+            datos = (st.st_mtime_ns, st.st_size, zlib.compress(texto.encode("utf-8"), 6))
+            if fila:
+                doc_id = fila[0]
+                conn.execute(
+                    "UPDATE documentos SET mtime_ns = ?, tamano = ?, texto = ? WHERE id = ?",
+                    (*datos, doc_id),
+                )
+                conn.execute("DELETE FROM terminos WHERE rowid = ?", (doc_id,))
+            else:
+                doc_id = conn.execute(
+                    "INSERT INTO documentos (mtime_ns, tamano, texto, ruta) VALUES (?, ?, ?, ?)",
+                    (*datos, ruta),
+                ).lastrowid
+            conn.execute(
+                "INSERT INTO terminos (rowid, nombre, raices) VALUES (?, ?, ?)",
+                (doc_id, nombre, contenido),
+            )
+
+    def _borrar(self, conn: sqlite3.Connection, ruta: str, subarbol: bool = True) -> None:
+        prefijo = ruta.rstrip("/") + "/"
+        with conn:
+            if subarbol:
+                ids = conn.execute(
+                    "SELECT id FROM documentos WHERE ruta = ? OR substr(ruta, 1, ?) = ?",
+                    (ruta, len(prefijo), prefijo),
+                ).fetchall()
+            else:
+                ids = conn.execute("SELECT id FROM documentos WHERE ruta = ?", (ruta,)).fetchall()
+            conn.executemany("DELETE FROM terminos WHERE rowid = ?", ids)
+            conn.executemany("DELETE FROM documentos WHERE id = ?", ids)
+
+    def _mover(self, conn: sqlite3.Connection, origen: str, destino: str) -> None:
+        prefijo = origen.rstrip("/") + "/"
+        self._borrar(conn, destino)
+        with conn:
+            filas = conn.execute(
+                "SELECT id, ruta FROM documentos WHERE ruta = ? OR substr(ruta, 1, ?) = ?",
+                (origen, len(prefijo), prefijo),
+            ).fetchall()
+            for doc_id, ruta in filas:
+                nueva = destino + ruta[len(origen):]
+                conn.execute("UPDATE documentos SET ruta = ? WHERE id = ?", (nueva, doc_id))
+                if ruta == origen and ruta.rsplit("/", 1)[1] != nueva.rsplit("/", 1)[1]:
+                    # Renombrado: cambia el nombre indexado, no el contenido.
+                    conn.execute(
+                        "UPDATE terminos SET nombre = ? WHERE rowid = ?",
+                        (" ".join(raices(os.path.splitext(nueva.rsplit("/", 1)[1])[0])), doc_id),
+                    )
+        if not filas and indexable(destino.rsplit("/", 1)[1]):
+            # Un .bin renombrado a .md, por ejemplo.
+            self._revisar(conn, destino)
+
+    # ── Búsqueda ───────────────────────────────────────────────────────────
+
+    def _lectura(self) -> sqlite3.Connection:
+        """Una conexión por hilo del threadpool (con WAL las lecturas no
+        esperan al escritor)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.ruta_db, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def buscar(self, consulta: str, limite: int = 20, visible=None) -> list[dict]:
+        """Documentos que contienen todos los términos de `consulta`,
+        ordenados por BM25 (el nombre pesa más que el contenido).
+
+        `visible(ruta)` permite descartar resultados que el usuario no
+        puede ver; los candidatos se leen por páginas de `limite * 5` hasta
+        reunir `limite` visibles o agotarlos.
+        """
+        if not self.disponible:
+            raise BuscadorNoDisponible()
+        terminos = _terminos(consulta)
+        if not terminos:
+            return []
+        conn = self._lectura()
+        expresion = _expresion_fts(terminos)
+        pagina = limite * 5
+
+        resultados = []
+        desde = 0
+        while len(resultados) < limite:
+            filas = conn.execute(
+                "SELECT rowid, bm25(terminos, 4.0, 1.0) AS p FROM terminos "
+                "WHERE terminos MATCH ? ORDER BY p LIMIT ? OFFSET ?",
+                (expresion, pagina, desde),
+            ).fetchall()
+            for doc_id, puntuacion in filas:
+                fila = conn.execute(
+                    "SELECT ruta, texto FROM documentos WHERE id = ?", (doc_id,),
+                ).fetchone()
+                if fila is None or (visible is not None and not visible(fila[0])):
+                    continue
+                fragmento, resaltes = _fragmento(zlib.decompress(fila[1]).decode("utf-8"), terminos)
+                resultados.append({
+                    "ruta": fila[0],
+                    "nombre": fila[0].rsplit("/", 1)[1],
+                    "fragmento": fragmento,
+                    "resaltes": resaltes,
+                    "puntuacion": round(-puntuacion, 3),
+                })
+                if len(resultados) >= limite:
+                    break
+            if len(filas) < pagina:
+                break
+            desde += pagina
+        return resultados
@@ -0,0 +1,358 @@
+"""
+Índice en memoria del árbol de /ficheros para el servicio de teoría.
+
+Guarda por carpeta sus subcarpetas y sus ficheros (tamaño y mtime), sin
+ocultos. Con él, /api/listar no recorre cada subcarpeta para contar sus
+elementos ni hace stat() de cada fichero, y /api/arbol_carpetas no hace
+os.walk de todo el volumen en cada llamada.
+
+Frescura:
+  - inotify (Linux, vía ctypes, sin dependencias): un hilo lee los eventos
+    y descarta la carpeta afectada; se vuelve a leer en la siguiente
+    consulta.
+  - revalidación por stat: una carpeta con más de INDICE_REVALIDAR_S
+    segundos en el índice se compara con el mtime del directorio antes de
+    servirla. Cubre los cambios que inotify no ve (volumen de red
+    modificado desde otra máquina) o su ausencia. No detecta ficheros
+    reescritos en el sitio: eso solo lo avisan inotify o `invalidar`.
+  - los endpoints que escriben llaman a `invalidar` al terminar, para que
+    el siguiente listado ya refleje el cambio sin esperar al evento.
+
+Las claves son rutas estilo URL ('/', '/tema1/apuntes'), las mismas que
+devuelve normalize_url_path.
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+REVALIDAR_S = float(os.getenv("INDICE_REVALIDAR_S", "30"))
+
+
+@dataclass
+class Nodo:
+    carpetas: list[str]
+    # nombre → (tamaño, mtime)
+    ficheros: dict[str, tuple[int, float]]
+    mtime_ns: int
+    revisado: float = field(default_factory=time.monotonic)
+
+    @property
+    def num_elementos(self) -> int:
+        return len(self.carpetas) + len(self.ficheros)
+
+
+def _hija(ruta: str, nombre: str) -> str:
+    return ruta.rstrip("/") + "/" + nombre
+
+
+def _bajo(ruta: str, raiz: str) -> bool:
+    return ruta == raiz or ruta.startswith(raiz.rstrip("/") + "/")
+
+
+# ── inotify ─────────────────────────────────────────────────────────────────
+
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+_MASCARA = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+_CABECERA = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class _Inotify:
+    def __init__(self) -> None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm = libc.inotify_rm_watch
+        self._rm.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        # Cerrar el fd no despierta a un read() bloqueado (y el número se
+        # puede reutilizar): para parar, se escribe en este pipe y leer()
+        # vuelve sin eventos.
+        self._despertar_r, self._despertar_w = os.pipe()
+        self._sondeo = select.poll()
+        self._sondeo.register(self.fd, select.POLLIN)
+        self._sondeo.register(self._despertar_r, select.POLLIN)
+
+    def vigilar(self, ruta: Path) -> int:
+        wd = self._add(self.fd, os.fsencode(ruta), _MASCARA)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch {ruta}")
+        return wd
+
+    def dejar(self, wd: int) -> None:
+        self._rm(self.fd, wd)
+
+    def leer(self):
+        """Bloquea hasta que haya eventos o se llame a `despertar`; genera
+        (wd, mask, nombre), nada si fue por `despertar`."""
+        listos = {fd for fd, _ in self._sondeo.poll()}
+        if self.fd not in listos:
+            return
+        datos = os.read(self.fd, 64 * 1024)
+        off = 0
+        while off < len(datos):
+            wd, mask, _cookie, largo = _CABECERA.unpack_from(datos, off)
+            off += _CABECERA.size
+            nombre = os.fsdecode(datos[off:off + largo].rstrip(b"\0"))
+            off += largo
+            yield wd, mask, nombre
+
+    def despertar(self) -> None:
+        os.write(self._despertar_w, b"\0")
+
+    def cerrar(self) -> None:
+        for fd in (self.fd, self._despertar_r, self._despertar_w):
+            os.close(fd)
+
+
+# ── Índice ──────────────────────────────────────────────────────────────────
+
+class Indice:
+    def __init__(self, base: Path, revalidar_s: float = REVALIDAR_S) -> None:
+        self.base = base
+        self.revalidar_s = revalidar_s
+        self._nodos: dict[str, Nodo] = {}
+        self._lock = threading.Lock()
+        # Sube con cada invalidación: una lectura de disco que empezó antes
+        # no se guarda (podría traer el estado previo al cambio).
+        self._version = 0
+        self._inotify: _Inotify | None = None
+        self._wd_ruta: dict[int, str] = {}
+        self._ruta_wd: dict[str, int] = {}
+
+    def _disco(self, ruta: str) -> Path:
+        partes = [p for p in ruta.split("/") if p]
+        return self.base.joinpath(*partes) if partes else self.base
+
+    # ── Arranque ───────────────────────────────────────────────────────────
+
+    def iniciar(self) -> None:
+        """Arranca inotify (si se puede) y precarga el árbol en segundo
+        plano. Hasta que termine, las carpetas se leen al pedirlas."""
+        try:
+            self._inotify = _Inotify()
+        except (OSError, AttributeError) as e:
+            print(f"[teoria] índice sin inotify ({e}); solo revalidación por stat", flush=True)
+        else:
+            threading.Thread(
+                target=self._bucle_eventos, args=(self._inotify,), daemon=True, name="indice-inotify",
+            ).start()
+        threading.Thread(target=self._precargar, daemon=True, name="indice-precarga").start()
+
+    def parar(self) -> None:
+        """Para el hilo de eventos; él cierra el fd al salir."""
+        ino, self._inotify = self._inotify, None
+        if ino is not None:
+            ino.despertar()
+
+    def _precargar(self) -> None:
+        t0 = time.monotonic()
+        pendientes = ["/"]
+        n = 0
+        while pendientes:
+            ruta = pendientes.pop()
+            try:
+                nodo = self.nodo(ruta)
+            except OSError:
+                continue
+            n += 1
+            pendientes.extend(_hija(ruta, c) for c in nodo.carpetas)
+        print(f"[teoria] índice precargado: {n} carpetas en {time.monotonic() - t0:.1f}s", flush=True)
+
+    # ── Lectura ────────────────────────────────────────────────────────────
+
+    def _escanear(self, ruta: str) -> Nodo:
+        disco = self._disco(ruta)
+        carpetas: list[str] = []
+        ficheros: dict[str, tuple[int, float]] = {}
+        # scandir trae el tipo de cada entrada sin un stat aparte.
+        with os.scandir(disco) as it:
+            mtime_ns = os.stat(disco).st_mtime_ns
+            for e in it:
+                if e.name.startswith("."):
+                    continue
+                try:
+                    if e.is_dir():
+                        carpetas.append(e.name)
+                    elif e.is_file():
+                        st = e.stat()
+                        ficheros[e.name] = (st.st_size, st.st_mtime)
+                except OSError:
+                    continue
+        carpetas.sort(key=str.lower)
+        ficheros = dict(sorted(ficheros.items(), key=lambda kv: kv[0].lower()))
+        return Nodo(carpetas, ficheros, mtime_ns)
+
+    def nodo(self, ruta: str) -> Nodo:
+        """Contenido de una carpeta, del índice o leído del disco.
+
+        Lanza FileNotFoundError / NotADirectoryError / PermissionError
+        como lo haría os.scandir.
+        """
+        with self._lock:
+            nodo = self._nodos.get(ruta)
+            version = self._version
+        ahora = time.monotonic()
+        if nodo is not None:
+            if ahora - nodo.revisado < self.revalidar_s:
+                return nodo
+            try:
+                if os.stat(self._disco(ruta)).st_mtime_ns == nodo.mtime_ns:
+                    nodo.revisado = ahora
+                    return nodo
+            except FileNotFoundError:
+                self.invalidar(ruta)
+                raise
+
+        # Primero el watch y después la lectura: un cambio entre medias
+        # llega como evento y descarta lo leído; al revés se perdería
+        # hasta la siguiente revalidación.
+        self._vigilar(ruta)
+        nodo = self._escanear(ruta)
+        with self._lock:
+            if self._version == version:
+                self._nodos[ruta] = nodo
+        return nodo
+
+    def listar(self, ruta: str) -> tuple[list[tuple[str, int]], list[tuple[str, int, float]]]:
+        """(subcarpetas con su nº de elementos, ficheros con tamaño y mtime),
+        ordenados por nombre sin distinguir mayúsculas."""
+        nodo = self.nodo(ruta)
+        carpetas = []
+        for c in nodo.carpetas:
+            try:
+                n = self.nodo(_hija(ruta, c)).num_elementos
+            except OSError:
+                n = 0
+            carpetas.append((c, n))
+        return carpetas, [(f, t, m) for f, (t, m) in nodo.ficheros.items()]
+
+    def carpetas(self) -> list[str]:
+        """Todas las carpetas del árbol, en el orden de os.walk con los
+        nombres ordenados (cada carpeta seguida de sus hijas directas)."""
+        rutas = ["/"]
+        pendientes = ["/"]
+        while pendientes:
+            ruta = pendientes.pop(0)
+            try:
+                hijas = sorted(self.nodo(ruta).carpetas)
+            except OSError:
+                continue
+            nuevas = [_hija(ruta, c) for c in hijas]
+            rutas.extend(nuevas)
+            pendientes[:0] = nuevas
+        return rutas
+
+    # ── Invalidación ───────────────────────────────────────────────────────
+
+    def invalidar(self, ruta: str, subarbol: bool = False) -> None:
+        """Descarta `ruta` (y con `subarbol`, todo lo que cuelga de ella)."""
+        with self._lock:
+            self._version += 1
+            if subarbol:
+                for r in [r for r in self._nodos if _bajo(r, ruta)]:
+                    del self._nodos[r]
+            else:
+                self._nodos.pop(ruta, None)
+        if subarbol:
+            self._dejar_de_vigilar(ruta)
+
+    def invalidar_cambio(self, ruta: str) -> None:
+        """Tras crear, borrar o mover `ruta`: lo que hubiera debajo ya no
+        está donde estaba y sus carpetas superiores pueden haber cambiado
+        (un mkdir con parents crea varios niveles)."""
+        self.invalidar(ruta, subarbol=True)
+        while ruta != "/":
+            ruta = ruta.rsplit("/", 1)[0] or "/"
+            self.invalidar(ruta)
+
+    def _vaciar(self) -> None:
+        with self._lock:
+            self._version += 1
+            self._nodos.clear()
+        self._dejar_de_vigilar("/")
+
+    # ── inotify ────────────────────────────────────────────────────────────
+
+    def _vigilar(self, ruta: str) -> None:
+        ino = self._inotify
+        if ino is None:
+            return
+        try:
+            wd = ino.vigilar(self._disco(ruta))
+        except OSError:
+            # ENOSPC (max_user_watches) u otra: queda la revalidación.
+            return
+        with self._lock:
+            self._wd_ruta[wd] = ruta
+            self._ruta_wd[ruta] = wd
+
+    def _dejar_de_vigilar(self, raiz: str) -> None:
+        ino = self._inotify
+        with self._lock:
+            rutas = [r for r in self._ruta_wd if _bajo(r, raiz)]
+            wds = [self._ruta_wd.pop(r) for r in rutas]
+            for wd in wds:
+                self._wd_ruta.pop(wd, None)
+        if ino is not None:
+            for wd in wds:
+                ino.dejar(wd)
+
+    def _bucle_eventos(self, ino: _Inotify) -> None:
+        try:
+            self._atender_eventos(ino)
+        finally:
+            ino.cerrar()
+
+    def _atender_eventos(self, ino: _Inotify) -> None:
+        while self._inotify is ino:
+            try:
+                eventos = list(ino.leer())
+            except OSError:
+                return
+            for wd, mask, nombre in eventos:
+                if mask & IN_Q_OVERFLOW:
+                    self._vaciar()
+                    continue
+                with self._lock:
+                    ruta = self._wd_ruta.get(wd)
+                    if mask & IN_IGNORED and ruta is not None:
+                        self._wd_ruta.pop(wd, None)
+                        if self._ruta_wd.get(ruta) == wd:
+                            del self._ruta_wd[ruta]
+                if ruta is None or mask & IN_IGNORED:
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    self.invalidar(ruta, subarbol=True)
+                    continue
+                if nombre.startswith("."):
+                    continue
+                if mask & IN_ISDIR and mask & (IN_DELETE | IN_MOVED_FROM):
+                    self.invalidar(_hija(ruta, nombre), subarbol=True)
+                self.invalidar(ruta)
@@ -0,0 +1,222 @@
+"""
+Stemmer de español (algoritmo Snowball) y plegado de texto para el
+buscador de teoría.
+
+`raiz("Administrativas")` → "administr". La palabra se pliega antes
+(minúsculas, sin tildes) y el algoritmo trabaja con los sufijos también
+plegados, de modo que "Constitución" y "constitucion" dan la misma raíz.
+Se aplica lo mismo al indexar y al consultar, así que basta con que sea
+determinista; no hace falta que la raíz sea una palabra real.
+
+Referencia: https://snowballstem.org/algorithms/spanish/stemmer.html
+"""
+
+from __future__ import annotations
+
+import re
+import unicodedata
+from functools import lru_cache
+
+_VOCALES = set("aeiou")
+
+_PALABRA = re.compile(r"\w+")
+
+
+def plegar(texto: str) -> str:
+    """Minúsculas y sin diacríticos."""
+    descompuesto = unicodedata.normalize("NFKD", texto)
+    return "".join(c for c in descompuesto if not unicodedata.combining(c)).casefold()
+
+
+def _por_largo(*sufijos: str) -> tuple[str, ...]:
+    # Se trabaja sobre la palabra ya plegada: quien busca suele escribir
+    # sin tildes y "constitución" y "constitucion" deben dar la misma raíz.
+    return tuple(sorted({plegar(s) for s in sufijos}, key=len, reverse=True))
+
+
+def _sufijo(palabra: str, sufijos: tuple[str, ...], desde: int = 0) -> str:
+    """El sufijo más largo de `sufijos` con el que acaba `palabra`,
+    empezando en la posición `desde` o después ('' si ninguno)."""
+    for s in sufijos:
+        if palabra.endswith(s) and len(palabra) - len(s) >= desde:
+            return s
+    return ""
+
+
+def _regiones(w: str) -> tuple[int, int, int]:
+    n = len(w)
+    rv = n
+    if n >= 2:
+        if w[1] not in _VOCALES:
+            rv = next((i + 1 for i in range(2, n) if w[i] in _VOCALES), n)
+        elif w[0] in _VOCALES:
+            rv = next((i + 1 for i in range(2, n) if w[i] not in _VOCALES), n)
+        else:
+            rv = min(3, n)
+
+    def _tras(inicio: int) -> int:
+        for i in range(max(inicio, 1), n):
+            if w[i] not in _VOCALES and w[i - 1] in _VOCALES and i - 1 >= inicio:
+                return i + 1
+        return n
+
+    r1 = _tras(0)
+    r2 = _tras(r1)
+    return rv, r1, r2
+
+
+_PRONOMBRES = _por_largo(
+    "me", "se", "sela", "selo", "selas", "selos", "la", "le", "lo", "las", "les", "los", "nos",
+)
+_ANTES_PRONOMBRE_SUF = _por_largo("ando", "iendo", "ar", "er", "ir", "yendo")
+
+
+def _paso0(w: str, rv: int) -> str:
+    pron = _sufijo(w, _PRONOMBRES)
+    if not pron:
+        return w
+    base = w[: -len(pron)]
+    verbo = _sufijo(base, _ANTES_PRONOMBRE_SUF, rv)
+    if not verbo:
+        return w
+    if verbo == "yendo" and not base.endswith("uyendo"):
+        return w
+    return base
+
+
+_P1_BORRAR = _por_largo(
+    "anza", "anzas", "ico", "ica", "icos", "icas", "ismo", "ismos", "able", "ables", "ible",
+    "ibles", "ista", "istas", "oso", "osa", "osos", "osas", "amiento", "amientos", "imiento",
+    "imientos",
+)
+_P1_ADOR = _por_largo(
+    "adora", "ador", "ación", "adoras", "adores", "aciones", "ante", "antes", "ancia", "ancias",
+)
+_P1_LOGIA = _por_largo("logías", "logía")
+_P1_UCION = _por_largo("uciones", "ución")
+_P1_ENCIA = _por_largo("encias", "encia")
+_P1_IDAD = _por_largo("idades", "idad")
+_P1_IVO = _por_largo("iva", "ivo", "ivas", "ivos")
+_P1_TODOS = _por_largo(
+    *_P1_BORRAR, *_P1_ADOR, *_P1_LOGIA, *_P1_UCION, *_P1_ENCIA, *_P1_IDAD, *_P1_IVO,
+    "amente", "mente",
+)
+
+
+def _paso1(w: str, r1: int, r2: int) -> str:
+    s = _sufijo(w, _P1_TODOS)
+    if not s:
+        return w
+    ini = len(w) - len(s)
+    if s in _P1_BORRAR:
+        return w[:ini] if ini >= r2 else w
+    if s in _P1_ADOR:
+        if ini < r2:
+            return w
+        w = w[:ini]
+        if w.endswith("ic") and len(w) - 2 >= r2:
+            w = w[:-2]
+        return w
+    if s in _P1_LOGIA:
+        return w[:ini] + "log" if ini >= r2 else w
+    if s in _P1_UCION:
+        return w[:ini] + "u" if ini >= r2 else w
+    if s in _P1_ENCIA:
+        return w[:ini] + "ente" if ini >= r2 else w
+    if s == "amente":
+        if ini < r1:
+            return w
+        w = w[:ini]
+        previo = _sufijo(w, ("iv", "os", "ic", "ad"))
+        if previo and len(w) - 2 >= r2:
+            w = w[:-2]
+            if previo == "iv" and w.endswith("at") and len(w) - 2 >= r2:
+                w = w[:-2]
+        return w
+    if s == "mente":
+        if ini < r2:
+            return w
+        w = w[:ini]
+        previo = _sufijo(w, ("ante", "able", "ible"))
+        if previo and len(w) - len(previo) >= r2:
+            w = w[: -len(previo)]
+        return w
+    if s in _P1_IDAD:
+        if ini < r2:
+            return w
+        w = w[:ini]
+        previo = _sufijo(w, ("abil", "ic", "iv"))
+        if previo and len(w) - len(previo) >= r2:
+            w = w[: -len(previo)]
+        return w
+    # iva, ivo, ivas, ivos
+    if ini < r2:
+        return w
+    w = w[:ini]
+    if w.endswith("at") and len(w) - 2 >= r2:
+        w = w[:-2]
+    return w
+
+
+_P2A = _por_largo("ya", "ye", "yan", "yen", "yeron", "yendo", "yo", "yó", "yas", "yes", "yais", "yamos")
+_P2B_GU = _por_largo("en", "es", "éis", "emos")
+_P2B = _por_largo(
+    "arían", "arías", "arán", "arás", "aríais", "aría", "aréis", "aríamos", "aremos", "ará",
+    "aré", "erían", "erías", "erán", "erás", "eríais", "ería", "eréis", "eríamos", "eremos",
+    "erá", "eré", "irían", "irías", "irán", "irás", "iríais", "iría", "iréis", "iríamos",
+    "iremos", "irá", "iré", "aba", "ada", "ida", "ía", "ara", "iera", "ad", "ed", "id", "ase",
+    "iese", "aste", "iste", "an", "aban", "ían", "aran", "ieran", "asen", "iesen", "aron",
+    "ieron", "ado", "ido", "ando", "iendo", "ió", "ar", "er", "ir", "as", "abas", "adas",
+    "idas", "ías", "aras", "ieras", "ases", "ieses", "ís", "áis", "abais", "íais", "arais",
+    "ierais", "aseis", "ieseis", "asteis", "isteis", "ados", "idos", "amos", "ábamos",
+    "íamos", "imos", "áramos", "iéramos", "iésemos", "ásemos",
+    *_P2B_GU,
+)
+
+
+def _paso2a(w: str, rv: int) -> str:
+    s = _sufijo(w, _P2A, rv)
+    if s and w[: -len(s)].endswith("u"):
+        return w[: -len(s)]
+    return w
+
+
+def _paso2b(w: str, rv: int) -> str:
+    s = _sufijo(w, _P2B, rv)
+    if not s:
+        return w
+    w = w[: -len(s)]
+    if s in _P2B_GU and w.endswith("gu"):
+        w = w[:-1]
+    return w
+
+
+def _paso3(w: str, rv: int) -> str:
+    s = _sufijo(w, ("os", "a", "o", "i", "e"))
+    if not s or len(w) - len(s) < rv:
+        return w
+    w = w[: -len(s)]
+    if s == "e" and w.endswith("gu") and len(w) - 1 >= rv:
+        w = w[:-1]
+    return w
+
+
+# El vocabulario de unos apuntes es pequeño comparado con su nº de
+# palabras: cachear evita repetir el algoritmo para cada "de" o "ley".
+@lru_cache(maxsize=200_000)
+def raiz(palabra: str) -> str:
+    """Raíz plegada (sin tildes, minúsculas) de una palabra."""
+    w = plegar(palabra)
+    rv, r1, r2 = _regiones(w)
+    w = _paso0(w, rv)
+    tras1 = _paso1(w, r1, r2)
+    if tras1 == w:
+        tras1 = _paso2a(w, rv)
+        if tras1 == w:
+            tras1 = _paso2b(w, rv)
+    return _paso3(tras1, rv)
+
+
+def raices(texto: str) -> list[str]:
+    """Raíces de todas las palabras de `texto`, en orden."""
+    return [raiz(p) for p in _PALABRA.findall(texto)]
@@ -0,0 +1,6 @@
+import sys
+from pathlib import Path
+
+# Los módulos del servicio se importan planos (como en la imagen, que
+# copia app.py, buscador.py… a la misma carpeta).
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
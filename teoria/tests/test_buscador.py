@@ -0,0 +1,35 @@
+from buscador import _expresion_fts, _fragmento, _terminos
+from raices import raiz
+
+
+def test_terminos_sin_palabras_vacias_ni_repetidos():
+    assert _terminos("la Constitución y la constitucion española") == [
+        raiz("constitución"), raiz("española"),
+    ]
+
+
+def test_terminos_solo_vacias_se_conservan():
+    assert _terminos("de la") == [raiz("de"), raiz("la")]
+
+
+def test_expresion_fts_ultimo_termino_como_prefijo():
+    assert _expresion_fts(["constitu", "espanol"]) == '"constitu" "espanol"*'
+
+
+def test_fragmento_al_principio_sin_elipsis():
+    fragmento, resaltes = _fragmento("Constitucion al principio", _terminos("constitución"))
+    assert fragmento == "Constitucion al principio"
+    assert resaltes == [[0, 12]]
+
+
+def test_resaltes_tras_la_elipsis_inicial():
+    texto = "x " * 300 + "La Constitución Española de 1978 establece. " + "y " * 300
+    fragmento, resaltes = _fragmento(texto, _terminos("la Constitución española"))
+    assert fragmento.startswith("…")
+    # Las posiciones son sobre el fragmento devuelto, con la elipsis incluida.
+    assert [fragmento[a:b] for a, b in resaltes] == ["Constitución", "Española"]
+
+
+def test_resalta_variantes_con_y_sin_tilde():
+    fragmento, resaltes = _fragmento("constitucion y Constitución", _terminos("constitución"))
+    assert [fragmento[a:b] for a, b in resaltes] == ["constitucion", "Constitución"]
@@ -0,0 +1,32 @@
+import pytest
+
+from raices import plegar, raices, raiz
+
+
+def test_plegar_quita_tildes_y_mayusculas():
+    assert plegar("Constitución ÑANDÚ") == "constitucion nandu"
+
+
+@pytest.mark.parametrize("a, b", [
+    ("Constitución", "constitucion"),
+    ("CONSTITUCIÓN", "constitución"),
+    ("procedimientos", "procedimiento"),
+    ("Administrativas", "administrativo"),
+    ("recursos", "recurso"),
+])
+def test_misma_raiz(a, b):
+    assert raiz(a) == raiz(b)
+
+
+@pytest.mark.parametrize("palabra, esperada", [
+    ("Constitución", "constitu"),
+    ("procedimientos", "proced"),
+    ("Administrativas", "administr"),
+    ("recursos", "recurs"),
+])
+def test_raices_conocidas(palabra, esperada):
+    assert raiz(palabra) == esperada
+
+
+def test_raices_de_un_texto_en_orden():
+    assert raices("Recursos administrativos") == [raiz("recursos"), raiz("administrativos")]
@@ -908,6 +908,32 @@ async function abrirMarkdown(ruta, nombre) {
   }
 }
 
+/* Enlace desde otra app (p.ej. "Repasa en teoría" al fallar una pregunta
+ * en tests): /teoria/?abrir=<ruta>&seccion=<encabezado>#<carpeta>. La
+ * carpeta va en el hash como siempre; aquí se abre el fichero y, si trae
+ * sección, se baja al encabezado con ese texto. `seccion` puede ser la
+ * ruta de encabezados del pasaje ("Tema 3 › Recursos"): vale el último. */
+async function abrirDesdeEnlace() {
+  const q = new URLSearchParams(location.search);
+  const ruta = q.get('abrir');
+  if (!ruta) return;
+  // Fuera de la URL para que recargar o volver no reabra el fichero.
+  history.replaceState(null, '', location.pathname + location.hash);
+  const nombre = ruta.split('/').pop();
+  if (!esMarkdown(nombre)) {
+    verFichero({ ruta, nombre });
+    return;
+  }
+  await abrirMarkdown(ruta, nombre);
+  const seccion = (q.get('seccion') || '').split(' › ').pop().trim();
+  if (!seccion || MD.ruta !== ruta) return;
+  // El render definitivo llega cuando están marked/purify.
+  await asegurarMarkedYPurify().catch(() => {});
+  const h = [...mdOut().querySelectorAll('h1,h2,h3,h4,h5,h6')]
+    .find(el => el.textContent.trim() === seccion);
+  if (h) h.scrollIntoView({ block: 'start' });
+}
+
 function pedirNuevoMarkdown() {
   modal({
     titulo: 'Nuevo markdown',
@@ -1419,23 +1445,94 @@ function pedirNuevaCarpeta() {
   });
 }
 
+// Subida reanudable (POST/PATCH/finalizar en /api/subidas, ver app.py).
+// Trozos de 8 MB: un corte solo obliga a repetir lo que no llegó. El id
+// se guarda en localStorage, así que volver a elegir el mismo fichero en
+// la misma carpeta continúa donde se quedó aunque se haya recargado.
+const TROZO_SUBIDA = 8 * 1024 * 1024;
+
+async function subirFichero(f, ruta, progreso) {
+  const clave = `aprentix_subida:${ruta}:${f.name}:${f.size}:${f.lastModified}`;
+  let id = localStorage.getItem(clave);
+  let offset = 0;
+  if (id) {
+    try { offset = (await api('GET', `api/subidas/${id}`)).offset; }
+    catch { id = null; }
+  }
+  if (!id) {
+    ({ id, offset } = await api('POST', 'api/subidas', { ruta, nombre: f.name, tamano: f.size }));
+    localStorage.setItem(clave, id);
+  }
+
+  let fallos = 0;
+  while (offset < f.size) {
+    progreso(offset);
+    let r = null;
+    try {
+      r = await fetch(`${API_BASE}api/subidas/${id}`, {
+        method: 'PATCH',
+        headers: {
+          'Authorization': `Bearer ${TOKEN}`,
+          'Content-Type': 'application/offset+octet-stream',
+          'Upload-Offset': String(offset),
+        },
+        body: f.slice(offset, offset + TROZO_SUBIDA),
+      });
+    } catch { /* red caída: se reintenta desde lo que tenga el servidor */ }
+    if (r && r.ok) {
+      offset = (await r.json()).offset;
+      fallos = 0;
+      continue;
+    }
+    if (r && r.status === 401) { deleteCookie(COOKIE_NAME); location.href = LANDING_URL; return null; }
+    // 409: el offset no cuadra; 423: el PATCH anterior aún escribe. En
+    // ambos casos basta con preguntar el offset y seguir.
+    if (r && r.status !== 409 && r.status !== 423 && r.status < 500) {
+      if (r.status === 404) localStorage.removeItem(clave);
+      const data = await r.json().catch(() => ({}));
+      throw new Error(data.error || `HTTP ${r.status}`);
+    }
+    if (++fallos > 5) throw new Error(`${f.name}: subida interrumpida, vuelve a subirlo para continuar`);
+    await new Promise(res => setTimeout(res, 1000 * 2 ** fallos));
+    offset = (await api('GET', `api/subidas/${id}`)).offset;
+  }
+  progreso(f.size);
+  const fin = await api('POST', `api/subidas/${id}/finalizar`);
+  localStorage.removeItem(clave);
+  return fin;
+}
+
 async function subirFicheros(files) {
   if (!files || files.length === 0) return;
-  const fd = new FormData();
-  fd.append('ruta', ESTADO.ruta);
-  for (const f of files) fd.append('files', f, f.name);
+  const ruta = ESTADO.ruta;
+  const total = Array.from(files).reduce((n, f) => n + f.size, 0) || 1;
+  const aviso = document.createElement('div');
+  aviso.className = 'toast';
+  document.body.appendChild(aviso);
+  let hechos = 0;
+  const subidos = [];
   try {
-    const r = await api('POST', 'api/subir', fd, /* isForm */ true);
-    toast(`${r.subidos.length} fichero${r.subidos.length === 1 ? '' : 's'} subido${r.subidos.length === 1 ? '' : 's'}`);
-    recargar();
-    // Tras subir, ofrecemos al admin asignar las oposiciones a los
-    // ficheros recién creados en lote. Si cancela, quedan globales.
-    const subidos = Array.isArray(r.subidos) ? r.subidos : [];
-    if (subidos.length) {
-      pedirOposicionesParaRutas(subidos)
-        .catch(err => toast(`Subida OK, pero fallo asignando oposiciones: ${err.message}`));
+    for (const f of files) {
+      if (!f.name || f.name.startsWith('.')) { hechos += f.size; continue; }
+      const r = await subirFichero(f, ruta, (enviado) => {
+        aviso.textContent = `Subiendo ${f.name}… ${Math.floor(100 * (hechos + enviado) / total)} %`;
+      });
+      if (!r) return;
+      hechos += f.size;
+      subidos.push(r);
     }
-  } catch (e) { toast(`⚠️ ${e.message}`); }
+    toast(`${subidos.length} fichero${subidos.length === 1 ? '' : 's'} subido${subidos.length === 1 ? '' : 's'}`);
+  } catch (e) {
+    toast(`⚠️ ${e.message}`);
+  } finally {
+    aviso.remove();
+  }
+  if (!subidos.length) return;
+  recargar();
+  // Tras subir, ofrecemos al admin asignar las oposiciones a los
+  // ficheros recién creados en lote. Si cancela, quedan globales.
+  pedirOposicionesParaRutas(subidos)
+    .catch(err => toast(`Subida OK, pero fallo asignando oposiciones: ${err.message}`));
 }
 
 // ── Configuración unificada (shared/config.js) ─────────────────────────────
@@ -1554,9 +1651,26 @@ document.addEventListener('click', (e) => {
   document.dispatchEvent(new CustomEvent('aprentix:nav', { detail: { id } }));
 });
 
-/* ── Buscador cliente-side sobre listar() de la ruta actual ─────────
- * En Fase 2 se sustituirá por un buscador global backed by API. Por
- * ahora, cargamos la ruta actual y filtramos por substring del nombre. */
+/* ── Buscador de teoría ─────────────────────────────────────────────
+ * Dos bloques: coincidencias por nombre en la carpeta actual (al
+ * instante, sobre listar()) y, a partir de 2 caracteres, búsqueda de
+ * texto completo en /api/buscar (nombres y contenido de markdown, txt y
+ * PDF en todo el árbol), con el fragmento donde aparece. */
+const BUSCAR_ESPERA_MS = 250;
+
+/* Fragmento con las posiciones [ini, fin) de `resaltes` en <mark>,
+ * escapando todo lo demás. */
+function fragmentoResaltado(texto, resaltes) {
+  let html = '';
+  let pos = 0;
+  for (const [ini, fin] of resaltes || []) {
+    if (ini < pos) continue;
+    html += esc(texto.slice(pos, ini)) + '<mark>' + esc(texto.slice(ini, fin)) + '</mark>';
+    pos = fin;
+  }
+  return html + esc(texto.slice(pos));
+}
+
 async function abrirBuscador() {
   const modal = document.getElementById('teoria-buscar');
   const input = document.getElementById('teoria-buscar-input');
@@ -1590,27 +1704,76 @@ async function abrirBuscador() {
     results.innerHTML = `<li class="muted small">Error: ${esc(err.message)}</li>`;
     return;
   }
-  const pintar = (q) => {
-    const qq = (q || '').trim().toLowerCase();
-    const filtered = qq
+
+  // Resultados de la API para la última consulta; `consulta` descarta
+  // respuestas que lleguen tarde de una consulta anterior.
+  const global = { consulta: '', resultados: [], cargando: false, aviso: '' };
+  let espera = null;
+
+  const pintar = () => {
+    const qq = input.value.trim().toLowerCase();
+    const locales = qq
       ? entries.filter(e => e.nombre.toLowerCase().includes(qq))
       : entries;
-    if (!filtered.length) {
-      results.innerHTML = '<li class="muted small">Sin resultados</li>';
-      return;
-    }
-    results.innerHTML = filtered.slice(0, 60).map((e, i) => `
+    const rutasLocales = new Set(locales.map(e => e.ruta));
+    const remotos = global.resultados
+      .filter(r => !rutasLocales.has(r.ruta))
+      .map(r => ({ ...r, es_carpeta: false }));
+    const filtered = [...locales.slice(0, 60), ...remotos];
+
+    let html = filtered.map((e, i) => {
+      const extra = e.fragmento !== undefined
+        ? `<span class="teoria-buscar-ruta">${esc(e.ruta)}</span>
+           <span class="teoria-buscar-frag">${fragmentoResaltado(e.fragmento, e.resaltes)}</span>`
+        : '';
+      return `
       <li>
-        <button class="teoria-buscar-res" data-idx="${i}">
+        <button class="teoria-buscar-res${extra ? ' con-fragmento' : ''}" data-idx="${i}">
           <span aria-hidden="true">${e.es_carpeta ? '📁' : emojiParaFichero(e.nombre)}</span>
-          <span class="teoria-buscar-nombre">${esc(e.nombre)}</span>
+          <span class="teoria-buscar-texto">
+            <span class="teoria-buscar-nombre">${esc(e.nombre)}</span>
+            ${extra}
+          </span>
         </button>
-      </li>
-    `).join('');
+      </li>`;
+    }).join('');
+    if (global.cargando) {
+      html += '<li class="muted small" style="padding:.5rem 0">Buscando en el contenido…</li>';
+    } else if (global.aviso) {
+      html += `<li class="muted small" style="padding:.5rem 0">${esc(global.aviso)}</li>`;
+    }
+    results.innerHTML = html || '<li class="muted small">Sin resultados</li>';
     results._filtered = filtered;
   };
-  pintar('');
-  input.oninput = () => pintar(input.value);
+
+  const buscarGlobal = async (q) => {
+    const p = new URLSearchParams({ q });
+    if (ESTADO.currentOposicion) p.set('oposicion_id', ESTADO.currentOposicion);
+    try {
+      const data = await api('GET', 'api/buscar?' + p.toString());
+      if (global.consulta !== q) return;
+      global.resultados = data.resultados || [];
+      global.aviso = data.indexando ? 'El índice se está construyendo: pueden faltar resultados.' : '';
+    } catch (err) {
+      if (global.consulta !== q) return;
+      global.resultados = [];
+      global.aviso = `Búsqueda en el contenido no disponible (${err.message}).`;
+    }
+    global.cargando = false;
+    pintar();
+  };
+
+  pintar();
+  input.oninput = () => {
+    const q = input.value.trim();
+    clearTimeout(espera);
+    global.consulta = q;
+    global.resultados = [];
+    global.aviso = '';
+    global.cargando = q.length >= 2;
+    pintar();
+    if (global.cargando) espera = setTimeout(() => buscarGlobal(q), BUSCAR_ESPERA_MS);
+  };
   input.focus();
   results.onclick = async (ev) => {
     const btn = ev.target.closest('.teoria-buscar-res');
@@ -2203,6 +2366,7 @@ async function mount() {
   } catch { pintarUsuario(''); }
   try {
     await cargar(ESTADO.ruta);
+    await abrirDesdeEnlace();
   } catch (err) {
     const g = document.getElementById('grid');
     if (g) g.innerHTML =
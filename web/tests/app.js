@@ -1415,6 +1415,7 @@ function renderPregunta() {
   $("#quiz-progress").textContent = `${posicion} / ${total}`;
   $("#quiz-question").textContent = q.text;
   $("#quiz-explanation").classList.add("hidden");
+  $("#quiz-teoria").classList.add("hidden");
   $("#btn-next").classList.add("hidden");
   $("#btn-edit-q").classList.add("hidden");
   $("#btn-skip").classList.remove("hidden");
@@ -1483,6 +1484,33 @@ function pintarBotonFavQ(activa) {
   btn.textContent = activa ? "⭐" : "☆";
 }
 
+/* Pasajes de los apuntes más parecidos a la pregunta fallada (búsqueda
+ * semántica en teoria_pasajes). Cada uno enlaza al fichero en teoría y a
+ * su sección; sin permiso de teoría ni se pregunta. */
+async function mostrarTeoriaRelacionada(q) {
+  const roles = (state.user && state.user.roles) || [];
+  if (!roles.includes("admin") && !roles.includes("teoria")) return;
+  let pasajes;
+  try {
+    pasajes = await rpc("teoria_para_pregunta", { p_pregunta_id: q.id, p_n: 3 });
+  } catch (_) { return; }
+  // El usuario pudo pasar a la siguiente mientras llegaba la respuesta.
+  if (!pasajes || !pasajes.length || state.quiz.questions[state.qi] !== q) return;
+  const e = $("#quiz-teoria");
+  e.innerHTML = `<div class="quiz-teoria-titulo">📚 Repasa en teoría</div>` + pasajes.map(p => {
+    const carpeta = p.ruta.slice(0, p.ruta.lastIndexOf("/")) || "/";
+    const href = `/teoria/?abrir=${encodeURIComponent(p.ruta)}`
+      + `&seccion=${encodeURIComponent(p.titulo || "")}#${encodeURIComponent(carpeta)}`;
+    const extracto = p.texto.length > 220 ? p.texto.slice(0, 220).trimEnd() + "…" : p.texto;
+    return `<a class="quiz-teoria-item" href="${esc(href)}">
+      <span class="quiz-teoria-sec">${esc(p.titulo || p.ruta.split("/").pop())}</span>
+      <span class="quiz-teoria-ruta">${esc(p.ruta)}</span>
+      <span class="quiz-teoria-txt">${esc(extracto)}</span>
+    </a>`;
+  }).join("");
+  e.classList.remove("hidden");
+}
+
 async function responder(idx, saltada = false) {
   if (state.quiz.answered) return;
   state.quiz.answered = true;
@@ -1512,6 +1540,7 @@ async function responder(idx, saltada = false) {
   $("#btn-edit-q").classList.remove("hidden");
   $("#btn-skip").classList.add("hidden");
   renderQuizTagsInline(q);
+  if (!correcta) mostrarTeoriaRelacionada(q);
 
   if (state.quiz.intentoId) {
     try {